@@ -0,0 +1,21 @@
+"""
+测试公共夹具
+
+客户端是带连字符的单文件脚本，无法直接import，这里按文件路径加载一次供各测试共用。
+第三方依赖都是延迟导入的，只加载模块不会打开音频设备或网络连接。
+"""
+
+import importlib.util
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def xiaozhi():
+    spec = importlib.util.spec_from_file_location("xiaozhi_in_rdk", os.path.join(ROOT, "xiaozhi-in-rdk.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
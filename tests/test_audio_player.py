@@ -0,0 +1,60 @@
+"""AudioPlayer打断后的过期包丢弃：恢复接收后不能误丢下一段回复"""
+
+import types
+
+import pytest
+
+
+@pytest.fixture
+def player(xiaozhi, monkeypatch):
+    # 只测试序列号逻辑，不需要真实的Opus解码器
+    monkeypatch.setattr(xiaozhi, "opuslib", types.SimpleNamespace(Decoder=lambda *args: None))
+    return xiaozhi.AudioPlayer(24000, 60)
+
+
+def play(player, sequences):
+    """模拟接收：未被丢弃的包送入播放队列，返回被接收的序列号"""
+    accepted = []
+    for sequence in sequences:
+        if not player.drop_stale(sequence):
+            player.feed(sequence, b"opus", 0.0)
+            accepted.append(sequence)
+    return accepted
+
+
+def test_in_flight_packets_dropped_after_interrupt(player):
+    play(player, range(1, 31))
+    player.interrupt()
+    assert play(player, range(31, 36)) == []
+    player.resume()
+    # listen stop后仍在途的被打断语音
+    assert play(player, [33, 35]) == []
+    assert player.barge_in_dropped == 7
+
+
+def test_next_segment_with_reset_sequences(player):
+    play(player, range(1, 31))
+    player.interrupt()
+    play(player, [31, 32])
+    player.resume()
+    player.resume(new_segment=True)  # tts start
+    assert play(player, range(1, 11)) == list(range(1, 11))
+
+
+def test_reset_sequences_before_tts_start_after_newer_packet(player):
+    play(player, range(1, 31))
+    player.interrupt()
+    player.resume()
+    # 序列号连续的新回复先于TTS start到达：越过打断点即清除，之后不再按打断点丢包
+    assert play(player, [29, 31, 32]) == [31, 32]
+    player.resume(new_segment=True)
+    assert play(player, range(1, 5)) == [1, 2, 3, 4]
+
+
+def test_stale_point_does_not_outlive_resume(player):
+    play(player, range(1, 31))
+    player.interrupt()
+    player.resume()
+    play(player, [31])
+    # 很久之后（不经TTS start）序列号回到打断点以下也不再被丢弃
+    assert play(player, [10, 11]) == [10, 11]
@@ -0,0 +1,50 @@
+"""AudioSession：每个会话独立的上行序列号、组包加密、下行过滤和协商参数"""
+
+import pytest
+
+
+def hello(session_id, key, nonce, frame_duration=60):
+    return {
+        "type": "hello",
+        "session_id": session_id,
+        "udp": {"server": "127.0.0.1", "port": 8884, "key": key, "nonce": nonce},
+        "audio_params": {"sample_rate": 24000, "frame_duration": frame_duration},
+    }
+
+
+@pytest.fixture
+def sessions(xiaozhi):
+    first = xiaozhi.AudioSession(hello("a", "00112233445566778899aabbccddeeff",
+                                       "01000000aaaaaaaa0000000000000000"),
+                                 {"frame_duration": 20, "bitrate": 24000})
+    second = xiaozhi.AudioSession(hello("b", "ffeeddccbbaa99887766554433221100",
+                                        "01000000bbbbbbbb0000000000000000"))
+    return first, second
+
+
+def test_sequences_are_per_session(sessions):
+    first, second = sessions
+    packets = [first.packet(b"opus") for _ in range(3)] + [second.packet(b"opus")]
+    assert [int.from_bytes(packet[12:16], "big") for packet in packets] == [1, 2, 3, 1]
+    assert (first.sequence, second.sequence) == (3, 1)
+
+
+def test_packet_round_trip(sessions):
+    first, _ = sessions
+    packet = first.packet(b"payload")
+    assert first.accept(packet, 0.0) == 1
+    assert first.decrypt(packet) == b"payload"
+
+
+def test_accept_filters_other_sessions(sessions):
+    first, second = sessions
+    assert first.accept(second.packet(b"opus"), 0.0) is None
+    assert first.receive_stats.stale_session == 1
+    assert first.downlink_loss() is None
+
+
+def test_negotiated_uplink_parameters(sessions):
+    first, second = sessions
+    assert (first.uplink_frame_size, second.uplink_frame_size) == (320, 960)
+    assert first.audio_params["channels"] == 1
+    assert first.address == ("127.0.0.1", 8884)
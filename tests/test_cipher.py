@@ -0,0 +1,44 @@
+"""AesCtrCipher / UplinkPacketBuilder 与逐包新建Cipher的 aes_ctr_encrypt 输出一致"""
+
+import os
+import struct
+
+import pytest
+
+pytest.importorskip("cryptography")
+
+KEY = bytes(range(16))
+
+
+@pytest.mark.parametrize("length", [0, 1, 15, 16, 17, 160, 1275])
+@pytest.mark.parametrize("nonce", [
+    bytes(16),
+    bytes.fromhex("01000000a1b2c3d40000000000000007"),
+    b"\xff" * 15 + b"\xfe",  # 计数器在128位处回绕
+])
+def test_matches_aes_ctr_encrypt(xiaozhi, nonce, length):
+    data = os.urandom(length)
+    cipher = xiaozhi.AesCtrCipher(KEY)
+    assert cipher.apply(nonce, data) == xiaozhi.aes_ctr_encrypt(KEY, nonce, data)
+
+
+def test_cipher_is_reusable_and_symmetric(xiaozhi):
+    cipher = xiaozhi.AesCtrCipher(KEY)
+    nonce = os.urandom(16)
+    for _ in range(3):
+        data = os.urandom(100)
+        encrypted = cipher.apply(nonce, data)
+        assert cipher.apply(nonce, encrypted) == data
+        assert xiaozhi.aes_ctr_decrypt(KEY, nonce, encrypted) == data
+
+
+def test_uplink_packet_builder(xiaozhi):
+    session_nonce = "01000000a1b2c3d4e5f6a7b800000000"
+    builder = xiaozhi.UplinkPacketBuilder(KEY.hex(), session_nonce)
+    for sequence, payload in ((1, b"first"), (0xFFFFFFFF + 2, os.urandom(300)), (3, b"x")):
+        packet = bytes(builder.build(payload, sequence))
+        nonce = packet[:16]
+        assert struct.unpack_from(">H", nonce, 2)[0] == len(payload)
+        assert struct.unpack_from(">I", nonce, 12)[0] == sequence & 0xFFFFFFFF
+        assert nonce[4:12] == bytes.fromhex(session_nonce)[4:12]
+        assert xiaozhi.aes_ctr_decrypt(KEY, nonce, packet[16:]) == payload
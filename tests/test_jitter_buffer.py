@@ -0,0 +1,98 @@
+"""JitterBuffer：重排序、序列号回绕、重复/迟到、丢包判定与重新同步"""
+
+import pytest
+
+FRAME_MS = 60
+
+
+@pytest.fixture
+def buffer(xiaozhi):
+    return xiaozhi.JitterBuffer(FRAME_MS, min_depth=2, max_depth=8)
+
+
+def push_all(buffer, sequences, start=0):
+    """按帧时长等间隔到达（抖动为0，目标深度保持min_depth）"""
+    for index, sequence in enumerate(sequences):
+        buffer.push(sequence, f"frame{sequence}".encode(), start + index * FRAME_MS / 1000)
+
+
+def drain(buffer, flush=False):
+    played = []
+    while True:
+        item = buffer.pop(flush)
+        if item is None:
+            return played
+        played.append(item)
+
+
+def test_prebuffers_to_target_depth(buffer):
+    push_all(buffer, [10])
+    assert buffer.pop() is None
+    assert not buffer.playing
+    push_all(buffer, [11], start=FRAME_MS / 1000)
+    assert buffer.pop() == (b"frame10", None)
+    assert buffer.playing
+
+
+def test_reorders_frames(buffer):
+    push_all(buffer, [1, 3, 2, 4])
+    assert [payload for payload, _ in drain(buffer, flush=True)] == [b"frame1", b"frame2", b"frame3", b"frame4"]
+    assert buffer.stats()["lost"] == 0
+
+
+def test_earlier_frame_during_prebuffer_moves_start(buffer):
+    push_all(buffer, [5, 4])
+    assert buffer.pop() == (b"frame4", None)
+    assert buffer.late == 0
+
+
+def test_sequence_wrap(buffer):
+    sequences = [0xFFFFFFFE, 0xFFFFFFFF, 0, 1]
+    push_all(buffer, [0xFFFFFFFE, 0, 0xFFFFFFFF, 1])
+    assert [payload for payload, _ in drain(buffer, flush=True)] == [f"frame{s}".encode() for s in sequences]
+    assert buffer.lost == buffer.late == 0
+
+
+def test_duplicate_and_late_frames_dropped(buffer):
+    push_all(buffer, [1, 2, 3])
+    assert not buffer.push(2, b"again", 1.0)
+    assert buffer.duplicates == 1
+    drain(buffer)
+    assert not buffer.push(1, b"late", 1.0)
+    assert buffer.late == 1
+
+
+def test_loss_reported_with_fec_payload(buffer):
+    push_all(buffer, [1, 3, 4])
+    assert buffer.pop() == (b"frame1", None)
+    # 帧2缺失且后续已有目标深度的帧：判定丢包，返回下一帧供FEC恢复
+    assert buffer.pop() == (None, b"frame3")
+    assert buffer.pop() == (b"frame3", None)
+    assert buffer.lost == 1
+
+
+def test_waits_for_missing_frame_below_target_depth(buffer):
+    push_all(buffer, [1, 2, 4])
+    assert buffer.pop() == (b"frame1", None)
+    assert buffer.pop() == (b"frame2", None)
+    # 帧3缺失，缓冲中只剩1帧（低于目标深度），继续等待
+    assert buffer.pop() is None
+    assert buffer.pop(flush=True) == (None, b"frame4")
+
+
+def test_resync_on_large_jump(buffer):
+    push_all(buffer, [1, 2, 3])
+    buffer.pop()
+    jump = 3 + buffer.RESYNC_DISTANCE + 10
+    assert buffer.push(jump, b"new", 1.0)
+    assert not buffer.playing
+    assert buffer.depth == 1
+    assert buffer.pop(flush=True) == (b"new", None)
+
+
+def test_capacity_overflow(xiaozhi):
+    buffer = xiaozhi.JitterBuffer(FRAME_MS, min_depth=1)
+    buffer.CAPACITY = 4
+    push_all(buffer, range(6))
+    assert buffer.depth == 4
+    assert buffer.overflows == 2
@@ -0,0 +1,108 @@
+"""ReceiveStats：回绕、重复检测位图、乱序、会话过滤、重新同步、滚动丢包率与首尾丢包"""
+
+import struct
+
+import pytest
+
+CONNECTION_ID = b"\x11\x22\x33\x44"
+
+
+def packet(sequence, payload=b"opus", connection_id=CONNECTION_ID, length=None):
+    length = len(payload) if length is None else length
+    return b"\x01\x00" + struct.pack(">H", length) + connection_id + struct.pack(">II", 0, sequence) + payload
+
+
+@pytest.fixture
+def stats(xiaozhi):
+    return xiaozhi.ReceiveStats(60, CONNECTION_ID)
+
+
+def feed(stats, sequences):
+    return [stats.accept(packet(sequence), index * 0.06) for index, sequence in enumerate(sequences)]
+
+
+def test_in_order_without_loss(stats):
+    assert feed(stats, range(100, 110)) == list(range(100, 110))
+    assert (stats.received, stats.expected, stats.lost) == (10, 10, 0)
+
+
+def test_gap_counts_as_loss_until_filled(stats):
+    feed(stats, [1, 2, 5])
+    assert stats.lost == 2
+    feed(stats, [3])
+    assert stats.lost == 1
+    assert stats.reordered == 1
+
+
+def test_sequence_wrap(stats):
+    feed(stats, [0xFFFFFFFD, 0xFFFFFFFE, 0xFFFFFFFF, 0, 2])
+    assert stats.expected == 6
+    assert stats.lost == 1
+
+
+def test_duplicates_detected_by_bitmap(stats):
+    feed(stats, range(1, 41))
+    assert stats.accept(packet(40), 3.0) is None
+    assert stats.accept(packet(10), 3.0) is None
+    assert stats.duplicates == 2
+    assert stats.received == 40
+
+
+def test_late_packet_inside_window_accepted_once(stats):
+    feed(stats, [1, 2, 4, 5, 6])
+    assert stats.accept(packet(3), 1.0) == 3
+    assert stats.accept(packet(3), 1.0) is None
+    assert (stats.reordered, stats.duplicates, stats.lost) == (1, 1, 0)
+
+
+def test_late_packet_beyond_window_counted_as_reordered(stats):
+    feed(stats, [1] + list(range(3, 3 + stats.WINDOW + 10)))
+    assert stats.accept(packet(2), 10.0) == 2
+    assert stats.reordered == 1
+    assert stats.lost == 0
+
+
+def test_other_session_and_malformed_dropped(stats):
+    assert stats.accept(packet(1, connection_id=b"\x00\x00\x00\x00"), 0.0) is None
+    assert stats.accept(packet(1, length=99), 0.0) is None
+    assert (stats.stale_session, stats.malformed, stats.received) == (1, 1, 0)
+
+
+def test_resync_keeps_prior_expected(stats):
+    feed(stats, [1, 2, 4])
+    far = 4 + stats.MAX_DROPOUT + 1
+    assert stats.accept(packet(far), 1.0) == far
+    stats.accept(packet(far + 1), 1.06)
+    # 旧流期望4个（丢1个），新流从跳变后的序列号重新计数
+    assert stats.expected == 6
+    assert stats.lost == 1
+
+
+def test_rolling_loss_uses_last_interval(stats):
+    window = stats.ROLLING_PACKETS
+    # 第一个区间丢1/5，第二个区间无丢包
+    first = [s for s in range(1, window * 5 // 4 + 1) if s % 5]
+    feed(stats, first)
+    assert stats.loss_fraction == pytest.approx(0.2, abs=0.02)
+    feed(stats, range(first[-1] + 1, first[-1] + 1 + window))
+    assert stats.loss_fraction == 0.0
+    assert stats.lost > 0
+
+
+def test_finish_counts_leading_and_trailing_loss(stats):
+    feed(stats, [3, 4, 5])
+    stats.finish(1, 8)
+    assert stats.expected == 8
+    assert stats.lost == 5
+
+
+def test_finish_without_packets(stats):
+    stats.finish(1, 10)
+    assert stats.lost == 10
+
+
+def test_restart_stream_accepts_reset_sequences(stats):
+    feed(stats, range(1, 31))
+    stats.restart_stream()
+    assert feed(stats, range(1, 11)) == list(range(1, 11))
+    assert (stats.duplicates, stats.expected, stats.lost) == (0, 40, 0)
@@ -0,0 +1,67 @@
+"""PcmRingBuffer：环形回绕、写满丢弃最旧数据、读取超时与关闭"""
+
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def ring(xiaozhi):
+    return xiaozhi.PcmRingBuffer(10)
+
+
+def test_read_write_wraps_around(ring):
+    ring.write(b"abcdef")
+    assert ring.read(4) == b"abcd"
+    ring.write(b"ghijkl")
+    assert ring.read(8) == b"efghijkl"
+    assert ring.stats()["buffered_bytes"] == 0
+
+
+def test_overflow_drops_oldest(ring):
+    ring.write(b"0123456789")
+    ring.write(b"abc")
+    assert ring.read(10) == b"3456789abc"
+    assert (ring.overflows, ring.dropped_bytes) == (1, 3)
+
+
+def test_oversized_write_keeps_newest(ring):
+    ring.write(b"0123456789abcdef")
+    assert ring.read(10) == b"6789abcdef"
+
+
+def test_read_timeout_counts_underflow(ring):
+    ring.write(b"ab")
+    assert ring.read(4, timeout=0.01) is None
+    assert ring.underflows == 1
+    assert ring.read(2) == b"ab"
+
+
+def test_close_wakes_reader(ring):
+    results = []
+    reader = threading.Thread(target=lambda: results.append(ring.read(4, timeout=5)))
+    reader.start()
+    ring.close()
+    reader.join(1)
+    assert not reader.is_alive()
+    assert results == [None]
+
+
+def test_blocking_write_waits_for_space(ring):
+    ring.write(b"01234567")
+    writer = threading.Thread(target=ring.write, args=(b"abcd",), kwargs={"block": True})
+    writer.start()
+    assert ring.read(4, timeout=1) == b"0123"
+    writer.join(1)
+    assert ring.read(8, timeout=1) == b"4567abcd"
+    assert ring.overflows == 0
+
+
+def test_read_time_tracks_capture_time(xiaozhi):
+    ring = xiaozhi.PcmRingBuffer(64000, byte_rate=32000)
+    ring.write(bytes(3200), timestamp=100.0)
+    ring.write(bytes(3200), timestamp=100.1)
+    ring.read(3200)
+    assert ring.read_time == pytest.approx(100.0)
+    ring.read(3200)
+    assert ring.read_time == pytest.approx(100.1)
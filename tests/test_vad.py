@@ -0,0 +1,45 @@
+"""VoiceActivityDetector：稳态低频噪声被吸收进底噪，语音仍能检出"""
+
+import numpy as np
+import pytest
+
+FRAME = 960  # 60ms @ 16kHz
+
+
+@pytest.fixture
+def vad(xiaozhi):
+    return xiaozhi.VoiceActivityDetector()
+
+
+def brown_noise(seconds, level_dbfs, seed=0):
+    """布朗噪声（能量集中在低频、过零率低），按level_dbfs归一化"""
+    rng = np.random.default_rng(seed)
+    spectrum = np.fft.rfft(rng.normal(0, 1, int(seconds * 16000)))
+    frequencies = np.fft.rfftfreq(int(seconds * 16000), 1 / 16000)
+    spectrum /= np.maximum(frequencies, 50.0)  # 50Hz以上功率谱按1/f²衰减（风扇类噪声）
+    noise = np.fft.irfft(spectrum, int(seconds * 16000))
+    noise *= 10 ** (level_dbfs / 20) * 32768 / np.sqrt(np.mean(noise ** 2))
+    return noise.astype(np.int16)
+
+
+def frames(pcm):
+    return [pcm[i:i + FRAME].tobytes() for i in range(0, len(pcm) - FRAME + 1, FRAME)]
+
+
+@pytest.mark.parametrize("level_dbfs", [-45, -40, -30])
+def test_stationary_low_frequency_noise_builds_trailing_silence(vad, level_dbfs):
+    results = [vad.process(frame) for frame in frames(brown_noise(15, level_dbfs))]
+    assert not any(results[-50:])
+    assert vad.trailing_silence_ms >= 3000
+    assert vad.noise_db == pytest.approx(level_dbfs, abs=3)
+
+
+def test_speech_still_detected_over_adapted_noise(vad):
+    for frame in frames(brown_noise(10, -45)):
+        vad.process(frame)
+    t = np.arange(int(2 * 16000)) / 16000
+    voice = 0.1 * 32767 * np.sin(2 * np.pi * 200 * t) * (1 + 0.5 * np.sin(2 * np.pi * 4 * t))
+    pcm = np.clip(voice + brown_noise(2, -45, seed=1), -32768, 32767).astype(np.int16)
+    vad.reset()
+    assert all(vad.process(frame) for frame in frames(pcm))
+    assert vad.speech_detected and vad.trailing_silence_ms == 0
@@ -0,0 +1,23 @@
+"""唤醒词基准场景与模板检测器：场景中总有唤醒词，启动后的第一句也能检出"""
+
+import numpy as np
+
+
+def test_scene_always_contains_wake_words(xiaozhi):
+    for seed in range(5):
+        _, _, spans = xiaozhi.synthesize_wake_word_scene(xiaozhi.WAKE_SCENE_MIN_SECONDS, np.random.default_rng(seed))
+        assert len(spans) >= 3
+
+
+def test_detects_wake_words_from_cold_start(xiaozhi):
+    templates, pcm, spans = xiaozhi.synthesize_wake_word_scene(30, np.random.default_rng(3))
+    detector = xiaozhi.TemplateWakeWordDetector(templates, "你好小智", 0.2)
+    size = xiaozhi.CAPTURE_FRAME_SIZE
+    ends = []
+    for index in range(pcm.size // size):
+        detection = detector.process(pcm[index * size:(index + 1) * size].tobytes())
+        if detection is not None:
+            ends.append((index + 1) * size / 16000 - detection["delay_ms"] / 1000)
+    assert spans[0][0] <= 2.0
+    assert len(ends) == len(spans)
+    assert all(start - 0.2 <= end <= stop + 0.3 for end, (start, stop) in zip(ends, spans))
@@ -17,14 +17,16 @@
 - 加密音频传输
 - MQTT消息通信
 - 键盘交互控制
+- 本地唤醒词（免按键）
 - MCP服务集成（目标检测等）
 
 依赖库:
 - paho-mqtt: MQTT客户端
-- pyaudio: 音频处理
+- pyaudio: 音频处理（无声卡时可用文件音频后端）
 - opuslib: 音频编解码
 - cryptography: 加密解密
 - requests: HTTP请求
+- numpy: 本地VAD等音频信号处理
 
 使用方法:
 1. 确保音频设备正常工作
@@ -38,14 +40,14 @@ MCP服务支持: 基于TROS
 
 import json
 import time
-import requests
-import paho.mqtt.client as mqtt
+import asyncio
 import threading
-import pyaudio
-import opuslib
+import importlib
 import warnings
-import urllib3
 import socket
+import fcntl
+import select
+import signal
 import logging
 import os
 import errno
@@ -53,16 +55,72 @@ import ssl
 import sys
 import termios
 import tty
-import select
 import uuid
 import glob
-
-# 屏蔽警告信息
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+import wave
+import resource
+import tracemalloc
+import struct
+import math
+import argparse
+import collections
+import http.server
+
+# 屏蔽警告信息（OTA请求不校验证书；按消息过滤，无需为此导入urllib3）
+warnings.filterwarnings("ignore", message="Unverified HTTPS request")
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
+class LazyModule:
+    """
+    延迟导入的模块代理：首次访问属性时才真正导入
+
+    第三方库的导入合计需要数百毫秒，推迟到首次使用时导入，启动时可与其他阶段并行。
+    导入后把模块全局变量替换为真实模块，之后的访问没有代理开销；导入耗时记入启动分析。
+    """
+
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._module is None:
+                start = time.monotonic()
+                module = importlib.import_module(self._name)
+                startup_profiler.record(f"导入 {self._name}", start, time.monotonic())
+                globals()[self._alias] = self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._module or self.load(), attr)
+
+def preload_modules(*aliases):
+    """提前导入尚未导入的延迟模块（在线程池中调用，与其他启动阶段并行）"""
+    for alias in aliases:
+        module = globals()[alias]
+        if isinstance(module, LazyModule):
+            try:
+                module.load()
+            except Exception as e:
+                logging.warning(f"预导入 {alias} 失败: {str(e)}")
+
+requests = LazyModule('requests', 'requests')
+mqtt = LazyModule('paho.mqtt.client', 'mqtt')
+pyaudio = LazyModule('pyaudio', 'pyaudio')
+opuslib = LazyModule('opuslib', 'opuslib')
+np = LazyModule('numpy', 'np')
+ciphers = LazyModule('cryptography.hazmat.primitives.ciphers', 'ciphers')
+crypto_backends = LazyModule('cryptography.hazmat.backends', 'crypto_backends')
+
+# PortAudio常量（与pyaudio中的取值相同）：流回调和文件后端共用，只有声卡后端才导入pyaudio，
+# 文件后端在没有libportaudio的机器上也能运行
+PA_INT16 = 8
+PA_CONTINUE = 0
+PA_INPUT_UNDERFLOW = 1
+PA_INPUT_OVERFLOW = 2
+PA_OUTPUT_UNDERFLOW = 4
 
 # ============================================================================
 # 系统配置和环境初始化
@@ -105,7 +163,8 @@ def print_banner():
     print("📋 支持板卡: RDK X3 / RDK X5 / RDK S100")
     print("💡 使用说明:")
     print("   - 按 SPACE 键开始语音输入")
-    print("   - 松开 SPACE 键结束语音输入")
+    print("   - 按其他任意键（如回车）结束语音输入")
+    print("   - 按 's' 键查看延迟统计")
     print("   - 按 'q' 键退出程序")
     print("=" * 60)
 
@@ -115,23 +174,18 @@ def print_banner():
 
 def get_wlan0_ip():
     """
-    获取wlan0接口的IP地址
+    获取wlan0接口的IP地址（SIOCGIFADDR ioctl，无需启动 ip 子进程）
 
     Returns:
         str: IP地址，如果未连接则返回 '127.0.0.1'
     """
     try:
-        import subprocess
-        result = subprocess.run(['ip', 'addr', 'show', 'wlan0'],
-                              capture_output=True, text=True, timeout=2)
-        if result.returncode == 0:
-            for line in result.stdout.split('\n'):
-                if 'inet ' in line:
-                    ip = line.strip().split()[1].split('/')[0]
-                    return ip
-    except:
-        pass
-    return '127.0.0.1'
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            request = struct.pack('256s', b'wlan0')
+            result = fcntl.ioctl(sock.fileno(), 0x8915, request)  # SIOCGIFADDR
+            return socket.inet_ntoa(result[20:24])
+    except OSError:
+        return '127.0.0.1'
 
 def get_system_mac_address():
     """
@@ -180,43 +234,245 @@ def get_system_mac_address():
     # 备用MAC地址
     return '50:cf:14:5a:9f:17'
 
+def get_device_info():
+    """启动阶段：检测MAC地址和wlan0 IP地址"""
+    return device_mac_address(), get_wlan0_ip()
+
+def device_mac_address():
+    """设备MAC地址：MAC_ADDR未指定时首次调用才检测（可能回退到uuid.getnode()）"""
+    global MAC_ADDR
+    if MAC_ADDR is None:
+        MAC_ADDR = get_system_mac_address()
+    return MAC_ADDR
+
+def process_start_monotonic():
+    """进程启动时刻（monotonic时钟），包含解释器启动和模块导入；读取/proc失败时返回当前时刻"""
+    now = time.monotonic()
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            # 进程名之后的第20个字段为启动时刻（开机后的时钟滴答数）
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        return now - max(0.0, uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+    except Exception:
+        return now
+
+class StartupProfiler:
+    """
+    启动阶段计时
+
+    记录各阶段相对进程启动的起止时间（并行阶段会重叠），--profile-startup 时在
+    MQTT就绪后打印时间线。
+    """
+
+    def __init__(self):
+        self.origin = process_start_monotonic()
+        self.phases = []
+        self._lock = threading.Lock()
+
+    def record(self, name, start, end):
+        with self._lock:
+            self.phases.append((name, start, end))
+
+    async def run(self, name, func, *args):
+        """在线程池中执行一个阻塞的启动阶段并计时"""
+        start = time.monotonic()
+        try:
+            return await event_loop.run_in_executor(None, func, *args)
+        finally:
+            self.record(name, start, time.monotonic())
+
+    async def wait(self, name, awaitable):
+        """等待一个异步启动阶段并计时"""
+        start = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            self.record(name, start, time.monotonic())
+
+    def report(self, ready):
+        """打印启动时间线，ready为就绪时刻"""
+        with self._lock:
+            phases = sorted(self.phases, key=lambda phase: phase[1])
+        print("⏱️  启动分析 (相对进程启动, 单位ms)")
+        print(f"   {ljust_display('阶段', 30)}{rjust_display('开始', 8)}{rjust_display('耗时', 10)}")
+        for name, start, end in phases:
+            print(f"   {ljust_display(name, 30)}{(start - self.origin) * 1000:>8.0f}"
+                  f"{(end - start) * 1000:>10.0f}")
+        print(f"   {ljust_display('启动→就绪', 30)}{'':>8}{(ready - self.origin) * 1000:>10.0f}")
+
+startup_profiler = StartupProfiler()
+
 # ============================================================================
 # 全局配置和状态变量
 # ============================================================================
 
 # 服务器配置
 OTA_VERSION_URL = 'https://api.tenclass.net/xiaozhi/ota/'
-MAC_ADDR = get_system_mac_address()
+MAC_ADDR = None  # 设备MAC地址，None表示首次使用时自动检测
+
+# 启动分析：MQTT就绪后打印各启动阶段耗时
+PROFILE_STARTUP = False
+
+# OTA配置缓存：启动时直接使用缓存的MQTT配置连接，后台再刷新
+OTA_CACHE_FILE = os.path.expanduser('~/.cache/xiaozhi-in-rdk/ota_cache.json')
+OTA_CACHE_TTL = 24 * 3600  # 缓存有效期（秒），0表示不使用缓存
+OTA_RETRY_MAX_INTERVAL = 60  # 获取配置失败时指数退避的最大间隔（秒）
+OTA_REFRESH_DELAY = 2  # 使用缓存启动时，延后刷新配置，避免与启动阶段争用CPU（秒）
 
 # 连接配置
 RECONNECT_INTERVAL = 5  # 重连间隔（秒）
 HEARTBEAT_INTERVAL = 30  # 心跳间隔（秒）
+HELLO_TIMEOUT = 3  # 等待hello回复的超时（秒）
+SESSION_IDLE_TIMEOUT = 5  # 会话空闲超时（秒）
+# 终端没有松开事件：按住空格时的自动重复字符被忽略，输入其他任意键结束录音；
+# 设为正数时，超过该时长未再收到空格（自动重复停止）也视为松开（秒，0表示关闭，
+# 需大于终端的自动重复延迟，如X11默认660ms，经SSH时还要加上往返时间）
+KEY_RELEASE_TIMEOUT = 0
+PREWARM = False  # 预热模式：提前在后台建立会话
+PREWARM_RETRY_INTERVAL = 1  # 预热会话结束后重新建立的间隔（秒）
+
+# 下行抖动缓冲深度范围（帧）
+JITTER_MIN_DEPTH = 1
+JITTER_MAX_DEPTH = 8
+
+# 麦克风采集配置：默认每帧采样数（16kHz/60ms）、环形缓冲区容量（按最长帧计）
+# 和输入回调的缓冲大小（20ms，帧时长变短时不增加采集延迟）
+CAPTURE_FRAME_SIZE = 960
+CAPTURE_RING_FRAMES = 16
+MIC_BUFFER_SIZE = 320
+# 上行帧时长（毫秒）：None表示按链路质量为每个会话自动选择20/40/60
+UPLINK_FRAME_DURATION = None
+# 回声消除：auto（realtime监听模式下开启）、on、off；回声尾长、参考信号提前量（毫秒）
+# 和每帧CPU预算（占帧时长的比例）
+AEC_MODE = "auto"
+AEC_TAIL_MS = 200
+AEC_REFERENCE_LEAD_MS = 20
+AEC_CPU_BUDGET = 0.15
+# 编码前的采集预处理（高通去直流、AGC、噪声门），以及每帧CPU预算（占帧时长的比例）
+CAPTURE_DSP = False
+DSP_CPU_BUDGET = 0.05
+
+# 按键输入后端：terminal（终端空格键）、evdev（/dev/input按键）或 gpio（按钮）
+PTT_INPUT = "terminal"
+EVDEV_DEVICE = None  # None表示自动选择第一个带该按键的键盘
+EVDEV_KEY_CODE = 57  # KEY_SPACE
+GPIO_PIN = None
+GPIO_CHIP = "/dev/gpiochip0"
+GPIO_ACTIVE_LOW = True  # 按钮接地、上拉输入
+GPIO_DEBOUNCE_MS = 20
+
+# 监听模式：manual（按住空格说话）、auto（本地VAD自动结束）或 realtime（全双工：按一次开始
+# 连续对话，播放期间继续采集并回声消除，由服务端断句，说话即可打断播放，再按一次结束）
+LISTEN_MODE = "manual"
+# 静音帧处理：off（全部发送）、skip（跳过不发送）、dtx（Opus DTX编码）
+SILENCE_MODE = "off"
+# 自动模式下判定语音结束所需的尾部静音时长，始终无语音时的超时，以及单轮监听的最长时长（毫秒）
+VAD_SILENCE_MS = 800
+VAD_NO_SPEECH_TIMEOUT_MS = 8000
+VAD_MAX_LISTEN_MS = 30000
+# realtime模式下播放期间持续说话多久后本地打断播放（毫秒）
+BARGE_IN_SPEECH_MS = 300
+# 预录缓冲时长（毫秒），0表示关闭；开启后麦克风持续采集
+PREROLL_MS = 0
+
+# 本地唤醒词：引擎（None表示关闭，开启后麦克风持续采集）、唤醒词文本、模板录音和触发阈值；
+# 唤醒前的音频（含唤醒词本身）保留WAKE_WORD_PREROLL_MS毫秒，监听开始时随预录帧一起上传
+WAKE_WORD_ENGINE = None
+WAKE_WORD = "你好小智"
+WAKE_WORD_TEMPLATES = []
+WAKE_WORD_THRESHOLD = 0.2
+WAKE_WORD_PREROLL_MS = 2000
+
+# 上行Opus编码配置：application（voip/audio）、码率（None为自动）、复杂度(0~10)、
+# 带内FEC、预期丢包率(%)和DTX；audio为原先的默认编码参数
+ENCODER_PROFILES = {
+    "voip": {"application": "voip", "bitrate": 24000, "complexity": 5,
+             "fec": True, "loss_perc": 10, "dtx": False},
+    "lossy": {"application": "voip", "bitrate": 32000, "complexity": 5,
+              "fec": True, "loss_perc": 25, "dtx": False},
+    "low_cpu": {"application": "voip", "bitrate": 16000, "complexity": 1,
+                "fec": True, "loss_perc": 10, "dtx": False},
+    "audio": {"application": "audio", "bitrate": None, "complexity": 10,
+              "fec": False, "loss_perc": 0, "dtx": False},
+}
+ENCODER_PROFILE = "voip"
+# 命令行覆盖项（None表示使用配置值）
+OPUS_BITRATE = None
+OPUS_COMPLEXITY = None
+OPUS_LOSS_PERC = None
+# 运行时按丢包率和CPU余量调整编码参数
+ENCODER_ADAPT = True
+
+# Prometheus指标服务端口，0表示关闭
+METRICS_PORT = 0
+
+# 本地控制接口（Unix域套接字，None表示不启用）
+CONTROL_SOCKET = None
+DEFAULT_CONTROL_SOCKET = "/tmp/xiaozhi-in-rdk.sock"
+
+# 音频后端：pyaudio（声卡）或 file（从文件读取麦克风输入、下行PCM写入文件）
+AUDIO_BACKEND = "pyaudio"
+AUDIO_INPUT_FILE = None
+AUDIO_OUTPUT_FILE = None
+# 文件输入节奏：realtime（按实时节奏）或 fast（尽快读取）
+AUDIO_INPUT_PACE = "realtime"
+
+# UDP内核接收缓冲区大小（字节），吸收服务端突发发送
+UDP_RECV_BUFFER_SIZE = 256 * 1024
 
 # 全局状态变量
 mqtt_info = {}
+ota_refresh_task = None
+startup_ready_ms = None
+audio_ready = None
+mqtt_connect_started = None
 last_printed_text = ""
-local_sequence = 0
 listen_state = None
 tts_state = None
 key_state = None
+key_press_pending = False  # 已排队、尚未执行的按下处理（控制接口据此拒绝重复的listen_start）
 audio = None
-udp_socket = None
+udp_transport = None
 conn_state = False
 running = True
 last_heartbeat = 0
-last_listen_stop_time = None
+last_mqtt_message_time = 0
+
+# 事件循环和定时器
+event_loop = None
+shutdown_event = None
+message_queue = None
+heartbeat_timer = None
+idle_timer = None
+key_release_timer = None
+terminal_space_pressed = False
+key_task = None
+line_recording = False
 
 # 线程管理
-recv_audio_thread = None
 send_audio_thread = None
+audio_player = None
+capture_buffer = None
+capture_processor = None
+echo_reference = None
+echo_canceller = None
+wake_word_detector = None
+uplink_encoder = None
+uplink_params = None
+audio_session = None
+hello_sent_at = None
+heartbeat_pending = {}
 mqtt_client = None
-keyboard_thread = None
+mqtt_bridge = None
+mqtt_tls_context = None
 
 # 终端设置
 old_term_settings = None
 
-# 音频和会话配置
-aes_opus_info = {
+# hello回复示例（默认服务器的UDP参数），供基准测试组包使用；实际会话以服务端回复为准
+SAMPLE_HELLO = {
     "type": "hello",
     "version": 3,
     "transport": "udp",
@@ -233,16 +489,39 @@ aes_opus_info = {
         "channels": 1,
         "frame_duration": 60
     },
-    "session_id": "b23ebfe9"
+    "session_id": None
 }
 
-# 会话配置
+# 会话状态机: idle（无会话） -> connecting（已发送hello） -> ready（收到hello回复）
+session_state = "idle"
+session_ready = threading.Event()
+session_lock = threading.Lock()
 
-# 会话结束消息
-goodbye_msg = {
-    "session_id": "b23ebfe9",
-    "type": "goodbye"
-}
+# ============================================================================
+# 事件循环
+# ============================================================================
+
+def call_in_loop(callback, *args):
+    """在事件循环线程中执行callback，可从任意线程（音频线程、线程池）调用"""
+    loop = event_loop
+    if loop is None or loop.is_closed():
+        return
+    try:
+        in_loop = asyncio.get_running_loop() is loop
+    except RuntimeError:
+        in_loop = False
+    if in_loop:
+        callback(*args)
+    else:
+        loop.call_soon_threadsafe(callback, *args)
+
+def request_shutdown():
+    """请求退出程序（任意线程可调用）"""
+    global running
+    running = False
+    # 唤醒等待会话的发送线程
+    session_ready.set()
+    call_in_loop(shutdown_event.set)
 
 # ============================================================================
 # 终端输入处理
@@ -267,54 +546,344 @@ def restore_terminal():
         except:
             pass
 
-def get_char():
-    """非阻塞获取字符输入"""
-    if old_term_settings is None:
-        return None
+def schedule_key_action(action, *args):
+    """
+    按顺序执行按键处理协程
 
-    if select.select([sys.stdin], [], [], 0) == ([sys.stdin], [], []):
-        return sys.stdin.read(1)
-    return None
+    按下处理需要等待hello回复，松开（或VAD结束）必须排在其后执行，
+    否则可能先发送listen stop再发送listen start。
+    """
+    global key_task
+    previous = key_task
 
-def keyboard_listener():
-    """键盘监听线程，处理空格键和退出键"""
-    global running, key_state, last_listen_stop_time
+    async def run_in_order():
+        if previous is not None and not previous.done():
+            await asyncio.wait([previous])
+        try:
+            await action(*args)
+        except Exception as e:
+            logging.error(f"按键处理错误: {str(e)}")
+
+    key_task = event_loop.create_task(run_in_order())
+
+def on_keyboard_input():
+    """终端可读回调（事件循环中执行）：处理空格键和退出键"""
+    global key_release_timer, terminal_space_pressed
+
+    char = sys.stdin.read(1)
+    if char == ' ' and PTT_INPUT != "terminal":
+        # 由evdev/GPIO按键输入处理，终端只响应命令键
+        pass
+    elif char == ' ' and LISTEN_MODE != "manual":
+        ptt_press()
+    elif char == ' ':
+        # 终端没有松开事件：首个空格开始录音，按住时的自动重复字符忽略
+        if not terminal_space_pressed:
+            terminal_space_pressed = True
+            ptt_press()
+        if KEY_RELEASE_TIMEOUT:
+            # 可选：自动重复停止超过设定时长即视为松开
+            if key_release_timer is not None:
+                key_release_timer.cancel()
+            key_release_timer = event_loop.call_later(KEY_RELEASE_TIMEOUT, release_terminal_space)
+    elif terminal_space_pressed:
+        # 录音中输入其他任意字符结束录音
+        release_terminal_space()
+    elif char == 's':
+        print_latency_summary()
+        print_message_latency_summary()
+    elif char == 'q':
+        print("\n👋 退出程序")
+        request_shutdown()
+
+def release_terminal_space():
+    """终端空格键视为松开（输入其他键，或可选的自动重复超时）"""
+    global key_release_timer, terminal_space_pressed
+    if key_release_timer is not None:
+        key_release_timer.cancel()
+        key_release_timer = None
+    terminal_space_pressed = False
+    ptt_release()
+
+def print_input_prompt():
+    print("\n按 ENTER 录音，'q'退出: ", end='', flush=True)
+
+def on_line_input():
+    """简化输入模式（标准输入不是终端）的可读回调：按行处理"""
+    global line_recording
+
+    line = sys.stdin.readline()
+    if not line:
+        # 输入结束，不再监听
+        event_loop.remove_reader(sys.stdin.fileno())
+        return
+    user_input = line.strip()
+    if line_recording:
+        # 录音中任意输入都结束录音
+        line_recording = False
+        ptt_release()
+    elif user_input.lower() == 'q':
+        request_shutdown()
+        return
+    elif user_input.lower() == 's':
+        print_latency_summary()
+        print_message_latency_summary()
+    elif user_input == '' and PTT_INPUT != "terminal":
+        pass
+    elif user_input == '' and LISTEN_MODE != "manual":
+        ptt_press()
+    elif user_input == '':
+        line_recording = True
+        ptt_press()
+        print("🎤 录音中... 按 ENTER 停止")
+        return
+    print_input_prompt()
 
+def start_keyboard_listener():
+    """启动键盘监听：标准输入挂到事件循环，终端为字符模式，否则按行读取"""
     print("🎤 键盘监听已启动...")
-    space_pressed = False
+    if old_term_settings:
+        event_loop.add_reader(sys.stdin.fileno(), on_keyboard_input)
+    else:
+        try:
+            event_loop.add_reader(sys.stdin.fileno(), on_line_input)
+            print_input_prompt()
+        except (OSError, ValueError):
+            # 普通文件或/dev/null不支持事件监听
+            print("⚠️  标准输入不可用，按 Ctrl+C 退出")
 
-    while running:
-        if old_term_settings:
-            # 终端字符模式
-            char = get_char()
-            if char == ' ' and not space_pressed:
-                space_pressed = True
-                on_space_key_press()
-            elif char != ' ' and space_pressed:
-                space_pressed = False
-                on_space_key_release()
-            elif char == 'q':
-                print("\n👋 退出程序")
-                running = False
-                break
+# ============================================================================
+# 按键输入后端
+# ============================================================================
+
+def ptt_press(timestamp=None):
+    """
+    按键按下（任意输入后端，在事件循环中调用）
+
+    Args:
+        timestamp: 按下时刻（time.monotonic()时钟），用于统计按键→开始采集延迟
+    """
+    if LISTEN_MODE == "auto" and key_state == "press":
+        # 自动模式：按一次开始，由本地VAD判断何时结束
+        return
+    if LISTEN_MODE == "realtime" and key_state == "press":
+        # 全双工模式：再按一次结束连续对话
+        interrupt_speaking()
+        schedule_key_action(on_space_key_release)
+        return
+    schedule_key_action(on_space_key_press, timestamp or time.monotonic())
+
+def ptt_release(timestamp=None):
+    """按键松开（任意输入后端，在事件循环中调用）；自动和全双工模式下忽略"""
+    if LISTEN_MODE == "manual":
+        schedule_key_action(on_space_key_release)
+
+class EvdevInput:
+    """
+    Linux evdev按键输入：直接读取 /dev/input/eventX，有真实的按下/松开事件
+
+    无需第三方库；设备fd挂到事件循环上，按键时刻使用内核事件时间戳（CLOCK_MONOTONIC）。
+    读取设备需要root或input用户组权限。
+    """
+
+    EVENT_FORMAT = 'llHHi'  # struct input_event: timeval, type, code, value
+    EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+    EV_KEY = 1
+    EVIOCSCLOCKID = 0x400445a0  # _IOW('E', 0xa0, int)
+
+    def __init__(self, device=None, key_code=57):
+        self.device = device
+        self.key_code = key_code
+        self._fd = None
+        self._monotonic = False
+
+    @classmethod
+    def find_keyboard(cls, key_code):
+        """在 /proc/bus/input/devices 中查找第一个带有指定按键的键盘设备"""
+        word_bits = struct.calcsize('l') * 8
+        with open('/proc/bus/input/devices', 'r') as f:
+            blocks = f.read().split('\n\n')
+        for block in blocks:
+            handlers, keys = [], []
+            for line in block.splitlines():
+                if line.startswith('H: Handlers='):
+                    handlers = line.split('=', 1)[1].split()
+                elif line.startswith('B: KEY='):
+                    keys = line.split('=', 1)[1].split()
+            events = [h for h in handlers if h.startswith('event')]
+            if 'kbd' not in handlers or not events or not keys:
+                continue
+            # 按键位图按long分组，从高位到低位排列
+            index = key_code // word_bits
+            if index < len(keys) and int(keys[-1 - index], 16) >> (key_code % word_bits) & 1:
+                return f"/dev/input/{events[0]}"
+        return None
+
+    def start(self):
+        device = self.device or self.find_keyboard(self.key_code)
+        if device is None:
+            raise RuntimeError("未找到带有该按键的输入设备，请用 --evdev-device 指定")
+        self._fd = os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            # 让内核事件时间戳使用与time.monotonic()相同的时钟
+            fcntl.ioctl(self._fd, self.EVIOCSCLOCKID, struct.pack('i', time.CLOCK_MONOTONIC))
+            self._monotonic = True
+        except OSError:
+            self._monotonic = False
+        event_loop.add_reader(self._fd, self._on_readable)
+        print(f"🔘 evdev按键输入: {device} (键码 {self.key_code})")
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, self.EVENT_SIZE * 64)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # 设备被拔出
+            logging.error(f"evdev设备读取失败: {str(e)}")
+            print("⚠️  按键输入设备已断开")
+            self.close()
+            return
+        for offset in range(0, len(data) - self.EVENT_SIZE + 1, self.EVENT_SIZE):
+            sec, usec, ev_type, code, value = struct.unpack_from(self.EVENT_FORMAT, data, offset)
+            if ev_type != self.EV_KEY or code != self.key_code or value == 2:
+                # value 2 为按住时的自动重复
+                continue
+            timestamp = sec + usec / 1e6
+            if not self._monotonic:
+                timestamp = time.monotonic() - (time.time() - timestamp)
+            if value == 1:
+                ptt_press(timestamp)
+            else:
+                ptt_release(timestamp)
+
+    def close(self):
+        if self._fd is not None:
+            event_loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+class GpioInput:
+    """
+    GPIO按钮输入（按下/松开两个边沿）
+
+    优先使用libgpiod（v2 Python绑定，字符设备接口，内核去抖，事件fd挂到事件循环）；
+    不可用时回退到sysfs（/sys/class/gpio），在独立线程中poll边沿中断，软件去抖。
+    pin为GPIO控制器上的线号（sysfs为全局GPIO编号），而非排针物理编号。
+    """
+
+    SYSFS_ROOT = '/sys/class/gpio'
+
+    def __init__(self, pin, chip='/dev/gpiochip0', active_low=True, debounce_ms=20):
+        self.pin = pin
+        self.chip = chip
+        self.active_low = active_low
+        self.debounce_ms = debounce_ms
+        self._request = None
+        self._value_fd = None
+        self._stop_pipe = None
+        self._thread = None
+
+    def start(self):
+        try:
+            import gpiod
+            if not hasattr(gpiod, 'request_lines'):
+                raise ImportError("需要libgpiod v2")
+        except ImportError:
+            self._start_sysfs()
         else:
-            # 简化输入模式
-            try:
-                print("\n按 ENTER 录音，'q'退出: ", end='', flush=True)
-                user_input = input().strip()
-                if user_input.lower() == 'q':
-                    running = False
-                    break
-                elif user_input == '':
-                    on_space_key_press()
-                    print("🎤 录音中... 按 ENTER 停止")
-                    input()
-                    on_space_key_release()
-            except KeyboardInterrupt:
-                running = False
+            self._start_gpiod(gpiod)
+
+    def _start_gpiod(self, gpiod):
+        import datetime
+        from gpiod.line import Bias, Direction, Edge
+        settings = gpiod.LineSettings(
+            direction=Direction.INPUT, edge_detection=Edge.BOTH, active_low=self.active_low,
+            bias=Bias.PULL_UP if self.active_low else Bias.PULL_DOWN,
+            debounce_period=datetime.timedelta(milliseconds=self.debounce_ms))
+        self._request = gpiod.request_lines(self.chip, consumer="xiaozhi-ptt",
+                                            config={self.pin: settings})
+        event_loop.add_reader(self._request.fd, self._on_gpiod_readable)
+        print(f"🔘 GPIO按键输入: {self.chip} 线 {self.pin} (libgpiod)")
+
+    def _on_gpiod_readable(self):
+        from gpiod import EdgeEvent
+        for event in self._request.read_edge_events():
+            # 事件时间戳默认为CLOCK_MONOTONIC；active_low已由内核换算为逻辑电平
+            timestamp = event.timestamp_ns / 1e9
+            if event.event_type == EdgeEvent.Type.RISING_EDGE:
+                ptt_press(timestamp)
+            else:
+                ptt_release(timestamp)
+
+    def _start_sysfs(self):
+        gpio_dir = f"{self.SYSFS_ROOT}/gpio{self.pin}"
+        if not os.path.exists(gpio_dir):
+            with open(f"{self.SYSFS_ROOT}/export", 'w') as f:
+                f.write(str(self.pin))
+        with open(f"{gpio_dir}/direction", 'w') as f:
+            f.write('in')
+        with open(f"{gpio_dir}/edge", 'w') as f:
+            f.write('both')
+        self._value_fd = os.open(f"{gpio_dir}/value", os.O_RDONLY)
+        self._stop_pipe = os.pipe()
+        self._thread = threading.Thread(target=self._watch_sysfs, daemon=True)
+        self._thread.start()
+        print(f"🔘 GPIO按键输入: gpio{self.pin} (sysfs)")
+
+    def _read_sysfs(self):
+        """读取当前电平（同时清除sysfs的边沿通知）"""
+        os.lseek(self._value_fd, 0, os.SEEK_SET)
+        return os.read(self._value_fd, 2)[:1] == b'1'
+
+    def _watch_sysfs(self):
+        """
+        边沿监听线程：阻塞在poll上，无边沿时不占CPU
+
+        前沿去抖：电平变化立即上报（不增加按键延迟），之后 debounce_ms 内的抖动忽略，
+        窗口结束时再读一次电平，抖动后电平与上报状态不一致时补报。
+        """
+        poller = select.poll()
+        poller.register(self._value_fd, select.POLLPRI | select.POLLERR)
+        poller.register(self._stop_pipe[0], select.POLLIN)
+        pressed = self._read_sysfs() != self.active_low
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, (deadline - time.monotonic()) * 1000)
+            events = poller.poll(timeout)
+            if any(fd == self._stop_pipe[0] for fd, _ in events):
                 break
-
-        time.sleep(0.1)
+            now = time.monotonic()
+            level = self._read_sysfs()
+            if deadline is not None and now < deadline:
+                continue
+            deadline = None
+            if (level != self.active_low) != pressed:
+                pressed = not pressed
+                deadline = now + self.debounce_ms / 1000
+                call_in_loop(ptt_press if pressed else ptt_release, now)
+
+    def close(self):
+        if self._request is not None:
+            event_loop.remove_reader(self._request.fd)
+            self._request.release()
+            self._request = None
+        if self._thread is not None:
+            os.write(self._stop_pipe[1], b'x')
+            self._thread.join(timeout=1)
+            self._thread = None
+            for fd in (*self._stop_pipe, self._value_fd):
+                os.close(fd)
+
+def create_ptt_input():
+    """按配置创建按键输入后端；terminal返回None（由终端输入处理空格键）"""
+    if PTT_INPUT == "evdev":
+        return EvdevInput(EVDEV_DEVICE, EVDEV_KEY_CODE)
+    if PTT_INPUT == "gpio":
+        if GPIO_PIN is None:
+            raise ValueError("GPIO按键输入需要用 --gpio-pin 指定引脚")
+        return GpioInput(GPIO_PIN, GPIO_CHIP, GPIO_ACTIVE_LOW, GPIO_DEBOUNCE_MS)
+    return None
 
 # ============================================================================
 # 配置获取和更新
@@ -372,18 +941,20 @@ def get_system_hardware_info():
 
     return hardware_info
 
-def get_ota_version():
-    """
-    从服务器获取OTA版本信息和MQTT配置
-    包含设备信息上报和配置更新
+def fetch_ota_config(device_id):
     """
-    global mqtt_info
+    上报设备信息并获取MQTT配置
 
+    Args:
+        device_id: 设备MAC地址
+    Returns:
+        dict: 服务器下发的MQTT配置
+    """
     # 获取实际硬件信息
     hardware_info = get_system_hardware_info()
 
     header = {
-        'Device-Id': MAC_ADDR,
+        'Device-Id': device_id,
         'Content-Type': 'application/json'
     }
 
@@ -391,7 +962,7 @@ def get_ota_version():
     post_data = {
         "flash_size": hardware_info["flash_size"],
         "minimum_free_heap_size": hardware_info["minimum_free_heap_size"],
-        "mac_address": MAC_ADDR,
+        "mac_address": device_id,
         "chip_model_name": "rdk",
         "chip_info": {
             "model": "RDK",
@@ -418,18 +989,134 @@ def get_ota_version():
         }
     }
 
+    response = requests.post(OTA_VERSION_URL, headers=header,
+                             data=json.dumps(post_data), timeout=10, verify=False)
+    response.raise_for_status()
+    return response.json()['mqtt']
+
+# MQTT配置中决定连接身份的字段，变化时才需要重连
+OTA_CREDENTIAL_KEYS = ('endpoint', 'client_id', 'username', 'password',
+                       'publish_topic', 'subscribe_topic')
+
+def load_ota_cache():
+    """
+    读取缓存的MQTT配置
+
+    Returns:
+        tuple: (MQTT配置, 缓存时长/秒)；未启用缓存、无缓存、文件损坏或缓存不属于
+               当前OTA地址和设备时返回None
+    """
+    if not OTA_CACHE_TTL:
+        return None
+    try:
+        with open(OTA_CACHE_FILE, 'r') as f:
+            cache = json.load(f)
+        if cache['url'] != OTA_VERSION_URL or cache['device_id'] != device_mac_address():
+            return None
+        return cache['mqtt'], time.time() - cache['fetched_at']
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"OTA配置缓存读取失败: {str(e)}")
+        return None
+
+def save_ota_cache(info):
+    """保存MQTT配置到缓存文件（含凭据，仅当前用户可读；先写临时文件再替换）"""
+    if not OTA_CACHE_TTL:
+        return
     try:
-        response = requests.post(OTA_VERSION_URL, headers=header,
-                               data=json.dumps(post_data), timeout=10, verify=False)
-        response.raise_for_status()
-        mqtt_info = response.json()['mqtt']
+        directory = os.path.dirname(OTA_CACHE_FILE)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = OTA_CACHE_FILE + '.tmp'
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # 已存在的临时文件保留原有权限，显式收紧
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({"url": OTA_VERSION_URL, "device_id": device_mac_address(),
+                       "fetched_at": time.time(), "mqtt": info}, f)
+        os.replace(temp_path, OTA_CACHE_FILE)
+    except Exception as e:
+        logging.warning(f"OTA配置缓存写入失败: {str(e)}")
+
+def ota_credentials_changed(old, new):
+    return any(old.get(key) != new.get(key) for key in OTA_CREDENTIAL_KEYS)
+
+async def fetch_ota_with_backoff(attempts=None):
+    """
+    获取MQTT配置并写入缓存，失败后按指数退避重试（间隔上限 OTA_RETRY_MAX_INTERVAL）
+
+    Args:
+        attempts: 最多尝试次数，None表示直到成功或程序退出
+    Returns:
+        dict: MQTT配置，未获取到时返回None
+    """
+    delay = RECONNECT_INTERVAL
+    attempt = 0
+    while running:
+        try:
+            info = await event_loop.run_in_executor(None, fetch_ota_config, device_mac_address())
+            save_ota_cache(info)
+            return info
+        except Exception as e:
+            print(f"❌ 配置更新失败: {str(e)}")
+            logging.error(f"配置更新失败: {str(e)}")
+        attempt += 1
+        if attempts is not None and attempt >= attempts:
+            return None
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, OTA_RETRY_MAX_INTERVAL)
+    return None
+
+async def get_ota_version():
+    """
+    获取MQTT配置
+
+    缓存有效时直接使用并在后台刷新，启动不再等待服务器；无缓存时等待服务器
+    （指数退避重试）；缓存已过期时先尝试一次，失败则先用过期缓存并在后台继续刷新。
+    """
+    global mqtt_info
+
+    cached = load_ota_cache()
+    if cached is not None and cached[1] < OTA_CACHE_TTL:
+        mqtt_info = cached[0]
+        print(f"✅ 使用缓存配置 ({cached[1] / 60:.0f}分钟前获取)，后台刷新")
+        logging.info("使用缓存的MQTT配置")
+        event_loop.call_later(OTA_REFRESH_DELAY, schedule_ota_refresh)
+        return
+
+    info = await fetch_ota_with_backoff(attempts=1 if cached is not None else None)
+    if info is not None:
+        mqtt_info = info
         print("✅ 配置更新成功")
         logging.info("配置更新成功")
-    except Exception as e:
-        print(f"❌ 配置更新失败: {str(e)}")
-        logging.error(f"配置更新失败: {str(e)}")
-        time.sleep(RECONNECT_INTERVAL)
-        get_ota_version()
+    elif cached is not None and running:
+        mqtt_info = cached[0]
+        print("⚠️  使用过期的缓存配置，后台继续刷新")
+        logging.warning("使用过期的缓存MQTT配置")
+        schedule_ota_refresh()
+
+async def refresh_ota_config():
+    """后台刷新MQTT配置：凭据变化时用新配置重连，否则只更新缓存"""
+    global mqtt_info
+
+    info = await fetch_ota_with_backoff()
+    if info is None:
+        return
+    changed = ota_credentials_changed(mqtt_info, info)
+    mqtt_info = info
+    if changed and mqtt_client is not None:
+        print("🔄 MQTT配置已变化，重新连接")
+        logging.info("MQTT配置已变化，使用新配置重连")
+        await setup_mqtt()
+    else:
+        logging.info("配置刷新完成，MQTT配置未变化")
+
+def schedule_ota_refresh():
+    """在后台刷新配置（已在刷新时不重复启动）"""
+    global ota_refresh_task
+    if ota_refresh_task is None or ota_refresh_task.done():
+        ota_refresh_task = event_loop.create_task(refresh_ota_config())
 
 # ============================================================================
 # 加密解密功能
@@ -437,293 +1124,3102 @@ def get_ota_version():
 
 def aes_ctr_encrypt(key, nonce, plaintext):
     """AES-CTR模式加密"""
-    cipher = Cipher(algorithms.AES(key), modes.CTR(nonce), backend=default_backend())
+    cipher = ciphers.Cipher(ciphers.algorithms.AES(key), ciphers.modes.CTR(nonce),
+                            backend=crypto_backends.default_backend())
     encryptor = cipher.encryptor()
     return encryptor.update(plaintext) + encryptor.finalize()
 
 def aes_ctr_decrypt(key, nonce, ciphertext):
     """AES-CTR模式解密"""
-    cipher = Cipher(algorithms.AES(key), modes.CTR(nonce), backend=default_backend())
+    cipher = ciphers.Cipher(ciphers.algorithms.AES(key), ciphers.modes.CTR(nonce),
+                            backend=crypto_backends.default_backend())
     decryptor = cipher.decryptor()
     plaintext = decryptor.update(ciphertext) + decryptor.finalize()
     return plaintext
 
-# ============================================================================
-# 音频处理
-# ============================================================================
+class AesCtrCipher:
+    """
+    可复用的AES-CTR加解密器
 
+    CTR模式的密钥流即计数器块经AES-ECB加密的结果，因此只需在会话开始时
+    创建一次ECB加密器，之后每个数据包仅生成计数器块并异或，无需每帧重建Cipher对象。
+    与 aes_ctr_encrypt / aes_ctr_decrypt 的输出逐字节一致（128位大端计数器）。
+    """
 
-def send_audio():
-    """音频发送线程 - 录制麦克风音频并发送到服务器"""
-    global aes_opus_info, udp_socket, local_sequence, listen_state, audio, running
+    _COUNTER_MASK = (1 << 128) - 1
 
-    key = aes_opus_info['udp']['key']
-    nonce = aes_opus_info['udp']['nonce']
-    server_ip = aes_opus_info['udp']['server']
-    server_port = aes_opus_info['udp']['port']
+    def __init__(self, key):
+        self._ecb = ciphers.Cipher(ciphers.algorithms.AES(key), ciphers.modes.ECB(),
+                                   backend=crypto_backends.default_backend()).encryptor()
 
-    # 创建Opus编码器
-    encoder = opuslib.Encoder(16000, 1, opuslib.APPLICATION_AUDIO)
+    def apply(self, nonce, data):
+        """用16字节nonce作为初始计数器对data加密/解密（CTR模式加解密相同）"""
+        length = len(data)
+        base = int.from_bytes(nonce, 'big')
+        counters = b''.join(((base + i) & self._COUNTER_MASK).to_bytes(16, 'big')
+                            for i in range((length + 15) >> 4))
+        keystream = self._ecb.update(counters)
+        return (int.from_bytes(data, 'big') ^
+                int.from_bytes(keystream[:length], 'big')).to_bytes(length, 'big')
 
-    mic = None
-    try:
-        # 打开麦克风流
-        with ALSAErrorSuppressor():
-            mic = audio.open(format=pyaudio.paInt16, channels=1, rate=16000,
-                            input=True, frames_per_buffer=960,
-                            stream_callback=None)
+class UplinkPacketBuilder:
+    """
+    上行音频包构建器
 
-        if mic is None:
-            logging.error("无法打开麦克风设备")
-            print("❌ 麦克风设备打开失败")
-            return
+    包格式: nonce(16字节) + 加密Opus数据
+    nonce布局: [0:2]类型/标志 | [2:4]负载长度 | [4:12]会话nonce | [12:16]序列号
 
-        while running and aes_opus_info['session_id']:
-            if listen_state == "stop":
-                time.sleep(0.1)
-                continue
+    密钥和nonce在会话开始时解析一次，nonce头部和整个数据包使用预分配的
+    bytearray，每帧只原地改写长度和序列号字段。
+    """
 
-            # 读取音频数据 (添加 exception_on_overflow=False 防止缓冲区溢出错误)
-            try:
-                data = mic.read(960, exception_on_overflow=False)
-            except IOError as e:
-                if e.errno == pyaudio.paInputOverflowed:
-                    logging.warning("音频输入溢出，跳过此帧")
-                    continue
-                else:
-                    raise
+    MAX_PAYLOAD = 4096
 
-            encoded_data = encoder.encode(data, 960)
+    def __init__(self, key_hex, nonce_hex):
+        self._cipher = AesCtrCipher(bytes.fromhex(key_hex))
+        self._packet = bytearray(16 + self.MAX_PAYLOAD)
+        self._packet[:16] = bytes.fromhex(nonce_hex)
+        self._view = memoryview(self._packet)
 
-            # 构建加密nonce
-            local_sequence += 1
-            new_nonce = (nonce[0:4] + format(len(encoded_data), '04x') +
-                        nonce[8:24] + format(local_sequence, '08x'))
+    def build(self, payload, sequence):
+        """
+        构建一个加密上行包
 
-            # 加密音频数据
-            encrypt_encoded_data = aes_ctr_encrypt(
-                bytes.fromhex(key),
-                bytes.fromhex(new_nonce),
-                bytes(encoded_data)
-            )
+        Returns:
+            memoryview: 指向内部复用缓冲区的视图，在下一次build()前发送完毕即可
+        """
+        length = len(payload)
+        struct.pack_into('>H', self._packet, 2, length)
+        struct.pack_into('>I', self._packet, 12, sequence & 0xFFFFFFFF)
+        self._packet[16:16 + length] = self._cipher.apply(self._view[:16], payload)
+        return self._view[:16 + length]
 
-            # 发送到服务器
-            data = bytes.fromhex(new_nonce) + encrypt_encoded_data
-            try:
-                udp_socket.sendto(data, (server_ip, server_port))
-            except socket.error as e:
-                if e.errno == errno.ENETUNREACH:
-                    restart_audio_streams()
-                    break
-                elif e.errno == errno.EBADF:  # Bad file descriptor - socket已关闭
-                    logging.info("UDP socket已关闭，停止发送")
-                    break
-                else:
-                    raise
-    except Exception as e:
-        # 如果程序正在退出，只记录日志，不打印错误
-        if running:
-            logging.error(f"音频发送错误: {str(e)}")
-            print(f"❌ 录音设备错误: {str(e)}")
-        else:
-            logging.info(f"程序退出时音频发送停止: {str(e)}")
-    finally:
-        if mic is not None:
-            try:
-                mic.stop_stream()
-                mic.close()
-            except:
-                pass
+# ============================================================================
+# 延迟统计
+# ============================================================================
 
-def recv_audio():
-    """音频接收线程 - 接收服务器音频并播放"""
-    global aes_opus_info, udp_socket, audio, running
+class LatencyHistogram:
+    """
+    单个阶段的延迟直方图
 
-    key = aes_opus_info['udp']['key']
-    sample_rate = aes_opus_info['audio_params']['sample_rate']
-    frame_duration = aes_opus_info['audio_params']['frame_duration']
-    frame_num = int(frame_duration / (1000 / sample_rate))
+    固定桶累计计数（用于导出），另保留最近 window 个样本用于计算分位数，内存占用有界。
+    """
 
-    # 创建Opus解码器
-    decoder = opuslib.Decoder(sample_rate, 1)
+    BUCKETS_MS = (5, 10, 20, 50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 10000)
+    # 亚毫秒级的本地处理耗时（如MQTT消息分发）使用更细的桶
+    FINE_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 250, 500, 1000)
+
+    def __init__(self, window=512, buckets=BUCKETS_MS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.total_ms = 0.0
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, value_ms):
+        self.count += 1
+        self.total_ms += value_ms
+        self.recent.append(value_ms)
+        for i, bound in enumerate(self.buckets):
+            if value_ms <= bound:
+                self.bucket_counts[i] += 1
+                break
 
-    spk = None
-    try:
-        # 使用指定采样率打开扬声器
-        with ALSAErrorSuppressor():
-            spk = audio.open(format=pyaudio.paInt16, channels=1, rate=sample_rate,
-                            output=True, frames_per_buffer=frame_num,
-                            stream_callback=None, start=False)
+    def percentile(self, p):
+        """最近样本的第p百分位数（最近秩法），无样本时返回None"""
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        index = min(len(ordered) - 1, max(0, int(-(-p * len(ordered) // 100)) - 1))
+        return ordered[index]
+
+class LatencyStore:
+    """按阶段名称保存延迟直方图，线程安全"""
+
+    def __init__(self, window=512, buckets=LatencyHistogram.BUCKETS_MS):
+        self._window = window
+        self._buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value_ms):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = LatencyHistogram(self._window, self._buckets)
+            histogram.observe(value_ms)
+
+    def snapshot(self):
+        """返回 {阶段: (样本数, p50, p95, p99)}"""
+        with self._lock:
+            return {name: (h.count, h.percentile(50), h.percentile(95), h.percentile(99))
+                    for name, h in self._histograms.items()}
+
+    def histograms(self):
+        with self._lock:
+            return dict(self._histograms)
+
+# 一轮语音交互的时间点（按发生顺序）
+TURN_STAGES = (
+    "wake_word",       # 唤醒词结束（采集时刻），唤醒开始的一轮以此为起点
+    "wake_detected",   # 检测到唤醒词
+    "key_press",       # 按下空格（输入后端上报的按下时刻）
+    "key_handled",     # 按键处理开始
+    "barge_in",        # 播放中按键打断TTS
+    "playback_silenced",  # 打断后扬声器输出静音（按DAC时间）
+    "hello_sent",      # 发送hello
+    "hello_received",  # 收到hello回复
+    "first_capture",   # 监听开始后首帧采集音频
+    "first_uplink",    # 首个上行音频包
+    "listen_stop",     # 发送listen stop
+    "stt",             # 收到STT识别结果
+    "first_llm",       # 首条LLM文本
+    "tts_start",       # TTS start
+    "first_downlink",  # 首个下行音频包
+    "first_pcm",       # 首帧PCM写入扬声器
+)
 
-        if spk is None:
-            logging.error("无法打开音频播放设备")
-            return
+# 统计的延迟区间: (名称, 起点, 终点)
+TURN_SEGMENTS = (
+    ("唤醒词结束→检测", "wake_word", "wake_detected"),
+    ("唤醒→发送hello", "wake_word", "hello_sent"),
+    ("唤醒→首个上行包", "wake_word", "first_uplink"),
+    ("按键→处理按键", "key_press", "key_handled"),
+    ("打断→静音", "barge_in", "playback_silenced"),
+    ("按键→发送hello", "key_press", "hello_sent"),
+    ("hello往返", "hello_sent", "hello_received"),
+    ("按键→开始采集", "key_press", "first_capture"),
+    ("按键→首个上行包", "key_press", "first_uplink"),
+    ("停止→STT", "listen_stop", "stt"),
+    ("STT→首条LLM文本", "stt", "first_llm"),
+    ("停止→TTS开始", "listen_stop", "tts_start"),
+    ("TTS开始→首个下行包", "tts_start", "first_downlink"),
+    ("首个下行包→首帧PCM", "first_downlink", "first_pcm"),
+    ("停止→首帧PCM", "listen_stop", "first_pcm"),
+)
 
-        # 预填充静音数据减少延迟
-        silence = b'\x00' * (frame_num * 2)
-        spk.start_stream()
-        spk.write(silence)
+latency_store = LatencyStore()
+# 各类型MQTT消息从收到到处理完成的耗时
+message_latency_store = LatencyStore(buckets=LatencyHistogram.FINE_BUCKETS_MS)
+current_turn = {}
+turn_count = 0
 
-        while running and aes_opus_info['session_id']:
-            try:
-                # 接收加密音频数据
-                data, server = udp_socket.recvfrom(4096)
-                split_nonce = data[:16]
-                encrypt_data = data[16:]
-
-                # 解密音频数据
-                decrypt_data = aes_ctr_decrypt(
-                    bytes.fromhex(key),
-                    split_nonce,
-                    encrypt_data
-                )
-
-                # 解码并播放
-                spk.write(decoder.decode(decrypt_data, frame_num))
-            except socket.timeout:
-                continue
-            except Exception as e:
-                logging.error(f"音频接收错误: {str(e)}")
-    except Exception as e:
-        logging.error(f"播放流初始化失败: {str(e)}")
-        print(f"❌ 播放设备错误: {str(e)}")
-    finally:
-        if spk is not None:
-            try:
-                spk.stop_stream()
-                spk.close()
-            except:
-                pass
+def begin_turn(press_time=None, stage="key_press"):
+    """
+    开始新一轮交互计时（结束并记录上一轮）
 
-def restart_audio_streams():
-    """重启音频流连接"""
-    global aes_opus_info, recv_audio_thread, send_audio_thread, udp_socket
+    Args:
+        press_time: 起始时刻，默认为当前时刻
+        stage: 起始阶段，按键开始的一轮为key_press，唤醒词开始的为wake_word；
+            全双工模式的后续各轮从stt开始
+    """
+    global current_turn
+    finish_turn()
+    current_turn = {stage: press_time or time.monotonic()}
+
+def mark_turn(stage, timestamp=None):
+    """记录本轮某阶段首次发生的时间（任意线程可调用）"""
+    turn = current_turn
+    if turn and stage not in turn:
+        turn.setdefault(stage, timestamp or time.monotonic())
+
+def record_turn(turn, *stores):
+    """把一轮各区间耗时写入延迟统计，返回 {区间: 毫秒}"""
+    durations = {}
+    for name, start, end in TURN_SEGMENTS:
+        if start in turn and end in turn and turn[end] >= turn[start]:
+            durations[name] = (turn[end] - turn[start]) * 1000
+            for store in stores:
+                store.observe(name, durations[name])
+    return durations
+
+def finish_turn():
+    """本轮结束：把各区间耗时写入延迟直方图"""
+    global current_turn, turn_count
+    turn, current_turn = current_turn, {}
+    if not turn:
+        return
+    turn_count += 1
+    metrics.inc("turns_total")
+    durations = record_turn(turn, latency_store)
+    logging.info(f"第 {turn_count} 轮延迟(ms): "
+                 + ", ".join(f"{k}={v:.0f}" for k, v in durations.items()))
+
+def display_width(text):
+    """终端显示宽度：中日韩字符按两个字符宽度计算"""
+    return sum(2 if ord(c) >= 0x2E80 else 1 for c in text)
+
+def ljust_display(text, width):
+    return text + ' ' * max(1, width - display_width(text))
+
+def rjust_display(text, width):
+    return ' ' * max(1, width - display_width(text)) + text
+
+def print_latency_summary(store=latency_store, title="语音交互延迟统计", turns=None):
+    """打印各区间延迟的 p50/p95/p99"""
+    snapshot = store.snapshot()
+    if not snapshot:
+        print("📈 暂无延迟统计数据")
+        return
+    print(f"📈 {title} (共 {turn_count if turns is None else turns} 轮, 单位ms)")
+    print(f"   {ljust_display('区间', 22)}{'样本':>4}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, _, _ in TURN_SEGMENTS:
+        if name in snapshot:
+            count, p50, p95, p99 = snapshot[name]
+            print(f"   {ljust_display(name, 22)}{count:>6}{p50:>9.0f}{p95:>9.0f}{p99:>9.0f}")
+
+def print_message_latency_summary():
+    """打印各类型MQTT消息处理耗时（收到→处理完成）的 p50/p95/p99"""
+    snapshot = message_latency_store.snapshot()
+    if not snapshot:
+        return
+    print("📨 MQTT消息处理耗时 (收到→处理完成, 单位ms)")
+    print(f"   {ljust_display('类型', 14)}{'样本':>4}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name in sorted(snapshot):
+        count, p50, p95, p99 = snapshot[name]
+        print(f"   {name:<14}{count:>6}{p50:>9.2f}{p95:>9.2f}{p99:>9.2f}")
 
-    # 清理现有连接
-    if udp_socket:
-        udp_socket.close()
-    if recv_audio_thread and recv_audio_thread.is_alive():
-        recv_audio_thread.join(timeout=2)
-    if send_audio_thread and send_audio_thread.is_alive():
-        send_audio_thread.join(timeout=2)
+# ============================================================================
+# 运行指标
+# ============================================================================
 
-    try:
-        # 创建新的UDP连接
-        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        udp_socket.settimeout(1)
-        udp_socket.connect((aes_opus_info['udp']['server'], aes_opus_info['udp']['port']))
+class Metrics:
+    """
+    进程内运行指标，以Prometheus文本格式导出
 
-        # 启动音频线程（接收线程优先）
-        recv_audio_thread = threading.Thread(target=recv_audio, daemon=True)
-        recv_audio_thread.start()
-        time.sleep(0.1)
+    计数器在事件发生处累加；随会话重建的采集缓冲和播放阶段在退役时把计数并入，
+    导出时再加上当前对象的实时值，保证计数单调递增。
+    """
 
-        send_audio_thread = threading.Thread(target=send_audio, daemon=True)
-        send_audio_thread.start()
-    except Exception as e:
-        logging.error(f"UDP连接失败: {str(e)}")
+    COUNTERS = {
+        "uplink_packets_total": "已发送的上行音频包数",
+        "uplink_bytes_total": "已发送的上行字节数（含nonce头）",
+        "downlink_packets_total": "已接收的下行音频包数",
+        "downlink_bytes_total": "已接收的下行字节数（含nonce头）",
+        "decrypt_errors_total": "下行包解密失败次数",
+        "downlink_lost_total": "按序列号估计的下行丢包数",
+        "downlink_reordered_total": "乱序到达的下行包数",
+        "downlink_duplicates_total": "解密前丢弃的重复下行包数",
+        "downlink_stale_session_total": "解密前丢弃的其他会话下行包数",
+        "downlink_malformed_total": "长度字段与实际不符的下行包数",
+        "decode_errors_total": "下行Opus帧解码失败次数",
+        "capture_overflows_total": "采集环形缓冲区满、丢弃最旧数据的次数",
+        "capture_underflows_total": "采集环形缓冲区欠载（读取超时）次数",
+        "capture_input_overflow_flags_total": "声卡输入回调上报的输入溢出（paInputOverflow）次数",
+        "playback_underruns_total": "播放欠载次数",
+        "playback_queue_dropped_total": "下行帧队列溢出丢弃的帧数",
+        "barge_ins_total": "按键打断TTS播放的次数",
+        "barge_in_dropped_total": "打断后丢弃的被打断语音下行包数",
+        "jitter_late_total": "抖动缓冲丢弃的迟到帧数",
+        "jitter_lost_total": "抖动缓冲判定丢失的帧数（FEC/PLC补偿）",
+        "mqtt_reconnects_total": "MQTT重连次数",
+        "mqtt_messages_total": "已接收的MQTT消息数",
+        "heartbeats_total": "已发送的心跳数",
+        "sessions_total": "已建立的会话数",
+        "turns_total": "已完成的语音交互轮数",
+        "wake_word_detections_total": "本地唤醒词检测触发次数",
+    }
 
-# ============================================================================
-# MQTT消息处理
-# ============================================================================
+    def __init__(self):
+        self._counters = dict.fromkeys(self.COUNTERS, 0)
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def _collect(self):
+        """汇总计数器和仪表的当前值，返回 (计数器, {仪表: (说明, 值)})"""
+        with self._lock:
+            counters = dict(self._counters)
+
+        # 加上当前采集缓冲、收包统计和播放阶段的实时计数
+        ring, player, transport = capture_buffer, audio_player, udp_transport
+        player_stats = player.stats() if player is not None else None
+        receiver = transport.get_protocol() if transport is not None else None
+        receive_stats = receiver.receive_stats.stats() if receiver is not None else None
+        if receive_stats is not None:
+            counters["downlink_lost_total"] += receive_stats["lost"]
+            counters["downlink_reordered_total"] += receive_stats["reordered"]
+            counters["downlink_duplicates_total"] += receive_stats["duplicates"]
+            counters["downlink_stale_session_total"] += receive_stats["stale_session"]
+            counters["downlink_malformed_total"] += receive_stats["malformed"]
+        if ring is not None:
+            counters["capture_overflows_total"] += ring.overflows
+            counters["capture_underflows_total"] += ring.underflows
+        if player_stats is not None:
+            counters["playback_underruns_total"] += player_stats["underruns"]
+            counters["playback_queue_dropped_total"] += player_stats["queue_dropped"]
+            counters["jitter_late_total"] += player_stats["late"]
+            counters["jitter_lost_total"] += player_stats["lost"]
+            counters["decode_errors_total"] += player_stats["decode_errors"]
+            counters["barge_in_dropped_total"] += player_stats["barge_in_dropped"]
+
+        now = time.time()
+        gauges = {
+            "mqtt_connected": ("MQTT是否已连接",
+                               int(bool(mqtt_client and mqtt_client.is_connected()))),
+            "session_active": ("当前是否有会话", int(audio_session is not None)),
+            "heartbeat_age_seconds": ("距上次发送心跳的秒数（-1表示尚未发送）",
+                                      round(now - last_heartbeat, 3) if last_heartbeat else -1),
+            "mqtt_message_age_seconds": ("距上次收到MQTT消息的秒数（-1表示尚未收到）",
+                                         round(now - last_mqtt_message_time, 3)
+                                         if last_mqtt_message_time else -1),
+            "mqtt_message_queue_depth": ("等待分发的MQTT消息数",
+                                         message_queue.qsize() if message_queue else 0),
+            "startup_ready_seconds": ("启动到MQTT就绪的耗时（秒，-1表示尚未就绪）",
+                                      round(startup_ready_ms / 1000, 3)
+                                      if startup_ready_ms is not None else -1),
+        }
+        if link_controller.srtt is not None:
+            gauges["link_rtt_ms"] = ("平滑后的链路RTT（QoS1心跳PUBACK与hello往返，毫秒）",
+                                     round(link_controller.srtt, 1))
+        params = uplink_params
+        if params is not None:
+            gauges["uplink_frame_duration_ms"] = ("当前会话协商的上行帧时长（毫秒）", params["frame_duration"])
+        canceller = echo_canceller
+        if canceller is not None:
+            aec_stats = canceller.stats()
+            gauges["aec_erle_db"] = ("回声消除ERLE估计（远端单讲时，dB）", aec_stats["erle_db"])
+            gauges["aec_bypassed"] = ("回声消除是否因超出CPU预算而直通", int(aec_stats["bypassed"]))
+            gauges["aec_cost_ms"] = ("回声消除每帧平均耗时（毫秒）", aec_stats["avg_cost_ms"])
+            gauges["aec_double_talk_blocks"] = ("回声消除判为双讲的块数", aec_stats["double_talk_blocks"])
+            gauges["aec_resets"] = ("回声消除滤波器发散重置次数", aec_stats["resets"])
+        detector = wake_word_detector
+        if detector is not None:
+            wake_stats = detector.stats()
+            gauges["wake_word_cost_ms"] = ("唤醒词检测每帧平均耗时（毫秒）", wake_stats["avg_cost_ms"])
+            if "noise_db" in wake_stats:
+                gauges["wake_word_noise_floor_db"] = ("唤醒词检测底噪估计（dBFS）", wake_stats["noise_db"])
+        processor = capture_processor
+        if processor is not None:
+            dsp_stats = processor.stats()
+            gauges["capture_dsp_gain_db"] = ("采集预处理AGC增益（dB）", dsp_stats["gain_db"])
+            gauges["capture_dsp_noise_floor_db"] = ("采集预处理底噪估计（dBFS）", dsp_stats["noise_db"])
+            gauges["capture_dsp_bypassed"] = ("采集预处理是否因超出CPU预算而直通", int(dsp_stats["bypassed"]))
+            gauges["capture_dsp_overruns"] = ("采集预处理超出CPU预算的帧数", dsp_stats["overruns"])
+            gauges["capture_dsp_cost_ms"] = ("采集预处理每帧平均耗时（毫秒）", dsp_stats["avg_cost_ms"])
+        encoder = uplink_encoder
+        if encoder is not None:
+            encoder_stats = encoder.stats()
+            gauges["uplink_encoder_bitrate"] = ("上行Opus码率（bps，-1为自动）",
+                                                encoder_stats["bitrate"] or -1)
+            gauges["uplink_encoder_complexity"] = ("上行Opus编码复杂度", encoder_stats["complexity"])
+            gauges["uplink_encoder_loss_perc"] = ("上行Opus预期丢包率（%）", encoder_stats["loss_perc"])
+            gauges["uplink_encoder_fec"] = ("上行Opus带内FEC是否开启", int(encoder_stats["fec"]))
+            gauges["uplink_encode_us"] = ("上行每帧平均编码CPU耗时（微秒）", encoder_stats["encode_us"])
+        if receive_stats is not None:
+            gauges["downlink_loss_fraction"] = ("最近一个统计区间的下行丢包率", receive_stats["loss_fraction"])
+            gauges["downlink_interarrival_jitter_ms"] = ("下行到达间隔抖动（RFC 3550，毫秒）",
+                                                         receive_stats["jitter_ms"])
+        if player_stats is not None:
+            gauges["jitter_target_depth"] = ("抖动缓冲目标深度（帧）", player_stats["target_depth"])
+            gauges["jitter_depth"] = ("抖动缓冲当前深度（帧）", player_stats["depth"])
+            gauges["jitter_ms"] = ("下行到达间隔抖动（毫秒）", player_stats["jitter_ms"])
+        return counters, gauges
+
+    def snapshot(self):
+        """返回可JSON序列化的指标快照（控制接口使用）"""
+        counters, gauges = self._collect()
+        return {
+            "counters": counters,
+            "gauges": {name: value for name, (_, value) in gauges.items()},
+            "turn_latency_ms": {name: dict(zip(("count", "p50", "p95", "p99"), values))
+                                for name, values in latency_store.snapshot().items()},
+            "mqtt_message_latency_ms": {name: dict(zip(("count", "p50", "p95", "p99"), values))
+                                        for name, values in message_latency_store.snapshot().items()},
+        }
 
-def on_mqtt_message(client, userdata, msg):
-    """MQTT消息处理回调函数"""
-    global aes_opus_info, udp_socket, tts_state, recv_audio_thread, send_audio_thread, last_printed_text
+    def render(self):
+        """生成Prometheus文本格式（0.0.4）的指标"""
+        counters, gauges = self._collect()
+        lines = []
+        for name, value in counters.items():
+            lines.append(f"# HELP xiaozhi_{name} {self.COUNTERS[name]}")
+            lines.append(f"# TYPE xiaozhi_{name} counter")
+            lines.append(f"xiaozhi_{name} {value}")
+
+        for name, (help_text, value) in gauges.items():
+            lines.append(f"# HELP xiaozhi_{name} {help_text}")
+            lines.append(f"# TYPE xiaozhi_{name} gauge")
+            lines.append(f"xiaozhi_{name} {value}")
+
+        # 语音交互各区间的延迟直方图
+        histograms = latency_store.histograms()
+        lines.append("# HELP xiaozhi_turn_latency_ms 语音交互各区间延迟（毫秒）")
+        lines.append("# TYPE xiaozhi_turn_latency_ms histogram")
+        for name, start, end in TURN_SEGMENTS:
+            histogram = histograms.get(name)
+            if histogram is None:
+                continue
+            label = f'segment="{start}_to_{end}"'
+            lines.extend(self._histogram_lines("xiaozhi_turn_latency_ms", label, histogram))
+
+        # 各类型MQTT消息的处理耗时直方图
+        lines.append("# HELP xiaozhi_mqtt_message_latency_ms MQTT消息从收到到处理完成的耗时（毫秒）")
+        lines.append("# TYPE xiaozhi_mqtt_message_latency_ms histogram")
+        for name, histogram in sorted(message_latency_store.histograms().items()):
+            lines.extend(self._histogram_lines("xiaozhi_mqtt_message_latency_ms",
+                                               f'type="{name}"', histogram))
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _histogram_lines(metric, label, histogram):
+        """一个直方图的累计桶、总和与样本数"""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{{label},le="+Inf"}} {histogram.count}')
+        lines.append(f"{metric}_sum{{{label}}} {histogram.total_ms:.3f}")
+        lines.append(f"{metric}_count{{{label}}} {histogram.count}")
+        return lines
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """GET /metrics 抓取接口"""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 抓取请求不写日志
+        pass
 
+def start_metrics_server(port, host="0.0.0.0"):
+    """在后台线程启动指标HTTP服务"""
     try:
-        message = json.loads(msg.payload)
-        logging.info(f"接收到 MQTT 消息: {message}")
+        server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    except OSError as e:
+        print(f"❌ 指标服务启动失败: {str(e)}")
+        logging.error(f"指标服务启动失败: {str(e)}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"📊 指标服务: http://{host}:{port}/metrics")
+    return server
 
-        message_type = message.get('type')
+metrics = Metrics()
 
-        if message_type == 'hello':
-            handle_hello_message(message)
-        elif message_type == 'tts':
-            handle_tts_message(message)
-        elif message_type == 'stt':
-            handle_stt_message(message)
-        elif message_type == 'llm':
-            handle_llm_message(message)
-        elif message_type == 'goodbye':
-            handle_goodbye_message(message)
+# ============================================================================
+# 接收抖动缓冲
+# ============================================================================
 
-    except Exception as e:
-        print(f"❌ 消息处理错误: {str(e)}")
-        logging.error(f"消息处理错误: {str(e)}")
+def sequence_before(a, b):
+    """32位序列号回绕比较：a 是否早于 b"""
+    return a != b and ((b - a) & 0xFFFFFFFF) < 0x80000000
 
-def handle_hello_message(message):
-    """处理HELLO消息，建立会话连接"""
-    global aes_opus_info
+class JitterEstimator:
+    """
+    到达间隔抖动估计（RFC 3550 第6.4.1节）
 
-    if not aes_opus_info['session_id']:
-        aes_opus_info['session_id'] = message.get('session_id', None)
+    以序列号乘以帧时长作为媒体时钟，J += (|D| - J) / 16，单位毫秒。
+    """
 
-    aes_opus_info['udp'] = message.get('udp', aes_opus_info['udp'])
-    logging.info(f"处理 HELLO 消息完成，session_id: {aes_opus_info['session_id']}")
-    restart_audio_streams()
+    def __init__(self, frame_duration):
+        self.frame_duration = frame_duration
+        self.jitter = 0.0
+        self._last = None
+
+    def update(self, sequence, arrival):
+        """记录一个数据包的到达时间（time.monotonic()秒）"""
+        if self._last is not None:
+            last_sequence, last_arrival = self._last
+            expected_ms = ((sequence - last_sequence) & 0xFFFFFFFF) * self.frame_duration
+            if expected_ms < 0x80000000:
+                deviation = (arrival - last_arrival) * 1000 - expected_ms
+                self.jitter += (abs(deviation) - self.jitter) / 16
+        self._last = (sequence, arrival)
+
+    def restart(self):
+        """音频流中断后重新开始：丢弃参考包（保留抖动估计），流间空档不计入抖动"""
+        self._last = None
+
+class ReceiveStats:
+    """
+    下行收包统计与过滤（RFC 3550 附录A.1/A.8风格）
 
-def handle_tts_message(message):
-    """处理TTS（文本转语音）消息"""
-    global tts_state, last_printed_text
+    解析nonce中的长度（第2~4字节）、连接ID（第4~8字节）和序列号（第12~16字节），
+    在解密之前丢弃其他会话的包、长度不符的包和重复包；统计丢包、乱序和到达间隔抖动。
+    丢包率另按每 ROLLING_PACKETS 个包滚动计算一次（首个区间内为累计丢包率）。
+    """
 
-    tts_state = message['state']
-    if tts_state == 'start':
-        print("🔊 播放中...")
-    elif tts_state == 'sentence_start':
-        # 显示AI回复文本
-        sentence_text = message.get('text', '')
-        if sentence_text and sentence_text != last_printed_text:
-            print(f"🤖 地瓜派: {sentence_text}")
-            last_printed_text = sentence_text
-    elif tts_state == 'stop':
-        print("✅ 播放完成")
-        last_printed_text = ""
+    # 重复检测窗口（包），以最大序列号为基准的位图
+    WINDOW = 64
+    # 序列号前跳超过 MAX_DROPOUT 或后退超过 MAX_MISORDER 视为新的音频流
+    MAX_DROPOUT = 3000
+    MAX_MISORDER = 100
+    ROLLING_PACKETS = 50
+
+    def __init__(self, frame_duration, connection_id):
+        self.connection_id = connection_id
+        self._estimator = JitterEstimator(frame_duration)
+        self._base = None
+        self._highest = None
+        self._seen = 0
+        self._expected_prior = 0
+        self._interval = (0, 0)  # 上次滚动统计时的 (期望包数, 收到包数)
+
+        # 统计计数
+        self.received = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.stale_session = 0
+        self.malformed = 0
+        self._rolling_loss = None
+
+    @property
+    def loss_fraction(self):
+        if self._rolling_loss is not None:
+            return self._rolling_loss
+        expected = self.expected
+        return self.lost / expected if expected else 0.0
+
+    @property
+    def expected(self):
+        if self._highest is None:
+            return self._expected_prior
+        return self._expected_prior + ((self._highest - self._base) & 0xFFFFFFFF) + 1
+
+    @property
+    def lost(self):
+        return max(0, self.expected - self.received)
+
+    def accept(self, data, arrival):
+        """
+        检查一个下行包（解密之前调用）
+
+        Returns:
+            int | None: 包的序列号；应丢弃时返回None
+        """
+        if data[4:8] != self.connection_id:
+            # 已结束会话的迟到包
+            self.stale_session += 1
+            return None
+        length, = struct.unpack_from('>H', data, 2)
+        if length != len(data) - 16:
+            self.malformed += 1
+            return None
+        sequence, = struct.unpack_from('>I', data, 12)
+
+        if self._highest is None:
+            self._restart(sequence)
+        else:
+            ahead = (sequence - self._highest) & 0xFFFFFFFF
+            behind = (self._highest - sequence) & 0xFFFFFFFF
+            if ahead == 0:
+                self.duplicates += 1
+                return None
+            if ahead < self.MAX_DROPOUT:
+                # 按序到达（中间的空缺计为丢包，迟到后补回）
+                self._seen = ((self._seen << ahead) | 1) & ((1 << self.WINDOW) - 1)
+                self._highest = sequence
+            elif behind < self.WINDOW:
+                if self._seen >> behind & 1:
+                    self.duplicates += 1
+                    return None
+                self._seen |= 1 << behind
+                self.reordered += 1
+            elif behind <= self.MAX_MISORDER:
+                # 超出重复检测窗口的迟到包
+                self.reordered += 1
+            else:
+                logging.info(f"下行序列号跳变 {self._highest} -> {sequence}，收包统计重新同步")
+                self._expected_prior = self.expected
+                self._restart(sequence)
+
+        self.received += 1
+        self._estimator.update(sequence, arrival)
+        expected_prior, received_prior = self._interval
+        if self.received - received_prior >= self.ROLLING_PACKETS:
+            expected_interval = self.expected - expected_prior
+            lost_interval = expected_interval - (self.received - received_prior)
+            self._rolling_loss = max(0, lost_interval) / expected_interval if expected_interval else 0.0
+            self._interval = (self.expected, self.received)
+        return sequence
+
+    def _restart(self, sequence):
+        self._base = self._highest = sequence
+        self._seen = 1
+        self._estimator.restart()
+
+    def restart_stream(self):
+        """服务端开始下一段TTS：序列号可能从头开始，清空重复检测窗口（保留累计统计）"""
+        if self._highest is not None:
+            self._expected_prior = self.expected
+            self._base = self._highest = None
+
+    def finish(self, first_sequence, last_sequence):
+        """音频流结束：发送端告知本段的首尾序列号时，补记开头和末尾丢失的包"""
+        if self._highest is None:
+            count = ((last_sequence - first_sequence) & 0xFFFFFFFF) + 1
+            if count <= self.MAX_DROPOUT:
+                self._expected_prior += count
+            return
+        head = (self._base - first_sequence) & 0xFFFFFFFF
+        tail = (last_sequence - self._highest) & 0xFFFFFFFF
+        if head < self.MAX_DROPOUT and tail < self.MAX_DROPOUT:
+            self._expected_prior += head + tail
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "expected": self.expected,
+            "lost": self.lost,
+            "loss_fraction": round(self.loss_fraction, 4),
+            "reordered": self.reordered,
+            "duplicates": self.duplicates,
+            "stale_session": self.stale_session,
+            "malformed": self.malformed,
+            "jitter_ms": round(self._estimator.jitter, 2),
+        }
 
-def handle_stt_message(message):
-    """处理STT（语音转文本）消息"""
-    stt_text = message.get('text', '')
-    if stt_text:
-        print(f"👤 用户: {stt_text}")
+class JitterBuffer:
+    """
+    下行自适应抖动缓冲
 
-def handle_llm_message(message):
-    """处理LLM回复消息"""
-    global last_printed_text
+    以nonce中的序列号为键对Opus帧重新排序。播放前先预缓冲到目标深度，
+    目标深度随测得的抖动在 [min_depth, max_depth] 之间自适应调整；
+    缓冲区中已有目标深度的后续帧而期望帧仍未到达时判定丢包，
+    交由调用方做FEC恢复或PLC补偿。迟到的帧直接丢弃并计数。
+    """
+
+    # 超过该距离的序列号跳变视为新的音频流，重新同步
+    RESYNC_DISTANCE = 64
+    CAPACITY = 256
+
+    def __init__(self, frame_duration, min_depth=1, max_depth=8):
+        self.frame_duration = frame_duration
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.target_depth = min_depth
+        self._estimator = JitterEstimator(frame_duration)
+        self._frames = {}
+        self._next_sequence = None
+        self._playing = False
+
+        # 统计计数
+        self.received = 0
+        self.played = 0
+        self.late = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.overflows = 0
+
+    @property
+    def depth(self):
+        """当前缓冲的帧数"""
+        return len(self._frames)
+
+    @property
+    def playing(self):
+        """是否已完成预缓冲、处于播放状态"""
+        return self._playing
+
+    def push(self, sequence, payload, arrival=None):
+        """
+        放入一个已解密的Opus帧
+
+        Returns:
+            bool: 帧是否被接收（迟到、重复或溢出时返回False）
+        """
+        self.received += 1
+        self._estimator.update(sequence, time.monotonic() if arrival is None else arrival)
+        self._adapt_target()
+
+        if self._next_sequence is not None:
+            if sequence_before(sequence, self._next_sequence):
+                if self._playing:
+                    self.late += 1
+                    return False
+                # 预缓冲阶段收到更早的帧，前移起始序列号
+                self._next_sequence = sequence
+            elif ((sequence - self._next_sequence) & 0xFFFFFFFF) > self.RESYNC_DISTANCE:
+                logging.info(f"下行序列号跳变 {self._next_sequence} -> {sequence}，抖动缓冲重新同步")
+                self.reset()
+                self._next_sequence = sequence
+        else:
+            self._next_sequence = sequence
+
+        if sequence in self._frames:
+            self.duplicates += 1
+            return False
+        if len(self._frames) >= self.CAPACITY:
+            self.overflows += 1
+            return False
+
+        self._frames[sequence] = payload
+        return True
+
+    def pop(self, flush=False):
+        """
+        取出下一个应播放的帧
+
+        Args:
+            flush: 音频流已结束，不再等待缺失帧，直接按顺序播放剩余内容
+
+        Returns:
+            None: 暂无可播放的帧
+            (payload, None): 正常帧
+            (None, fec_payload): 期望帧丢失，fec_payload为下一帧（可用于FEC恢复）或None
+        """
+        if self._next_sequence is None or not self._frames:
+            return None
+
+        if not self._playing:
+            if len(self._frames) < self.target_depth and not flush:
+                return None
+            self._playing = True
+
+        sequence = self._next_sequence
+        payload = self._frames.pop(sequence, None)
+        if payload is None and len(self._frames) < self.target_depth and not flush:
+            # 缺失帧仍可能在途，继续等待
+            return None
+
+        self._next_sequence = (sequence + 1) & 0xFFFFFFFF
+        if payload is not None:
+            self.played += 1
+            return payload, None
+
+        self.lost += 1
+        return None, self._frames.get(self._next_sequence)
+
+    def reset(self):
+        """清空缓冲并回到预缓冲状态（保留抖动估计和统计计数）"""
+        self._estimator.restart()
+        self._frames.clear()
+        self._next_sequence = None
+        self._playing = False
+
+    def _adapt_target(self):
+        """目标深度 = 1 + ceil(2 * 抖动 / 帧时长)，限制在 [min_depth, max_depth]"""
+        depth = 1 + int(-(-2 * self._estimator.jitter // self.frame_duration))
+        self.target_depth = max(self.min_depth, min(self.max_depth, depth))
+
+    def stats(self):
+        """返回抖动缓冲状态，便于在延迟和流畅度之间调参"""
+        return {
+            "target_depth": self.target_depth,
+            "depth": self.depth,
+            "jitter_ms": round(self._estimator.jitter, 2),
+            "received": self.received,
+            "played": self.played,
+            "late": self.late,
+            "lost": self.lost,
+            "duplicates": self.duplicates,
+            "overflows": self.overflows,
+        }
+
+# ============================================================================
+# 上行采集
+# ============================================================================
+
+class PcmRingBuffer:
+    """
+    麦克风采集环形缓冲区
+
+    由PyAudio输入回调写入、编码线程按整帧读取，存储空间在创建时一次性分配。
+    缓冲区写满时丢弃最旧的数据并计入overflows；读取等待超时计入underflows，
+    采集异常不再被静默吞掉。写入时可附带采集时刻，读取后read_time为该帧首个采样的
+    采集时刻（回声消除据此对齐远端参考）。
+    """
+
+    def __init__(self, capacity, byte_rate=32000):
+        self._buffer = bytearray(capacity)
+        self._capacity = capacity
+        self._byte_rate = byte_rate
+        self._read_pos = 0
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._end_time = None  # 缓冲区末尾（最新写入数据之后）对应的采集时刻
+        self.read_time = None
+
+        # 统计计数
+        self.overflows = 0
+        self.dropped_bytes = 0
+        self.underflows = 0
+
+    def write(self, data, block=False, timestamp=None):
+        """
+        写入PCM数据（生产者：输入回调）
+
+        Args:
+            block: 为True时等待消费者腾出空间而不丢弃旧数据（用于非实时的文件输入）
+            timestamp: 数据首个采样的采集时刻（time.monotonic()时钟），默认为当前时刻
+        """
+        length = len(data)
+        end_time = (time.monotonic() if timestamp is None else timestamp) + length / self._byte_rate
+        with self._cond:
+            if length > self._capacity:
+                data = data[-self._capacity:]
+                length = self._capacity
+            if block:
+                self._cond.wait_for(lambda: self._capacity - self._size >= length or self._closed)
+                if self._closed:
+                    return
+            free = self._capacity - self._size
+            if length > free:
+                # 消费者跟不上，丢弃最旧的数据保证延迟有界
+                drop = length - free
+                self._read_pos = (self._read_pos + drop) % self._capacity
+                self._size -= drop
+                self.overflows += 1
+                self.dropped_bytes += drop
+
+            write_pos = (self._read_pos + self._size) % self._capacity
+            first = min(length, self._capacity - write_pos)
+            self._buffer[write_pos:write_pos + first] = data[:first]
+            if first < length:
+                self._buffer[:length - first] = data[first:]
+            self._size += length
+            self._end_time = end_time
+            self._cond.notify_all()
+
+    def read(self, length, timeout=None):
+        """
+        读取一整帧PCM数据（消费者：编码线程）
+
+        Returns:
+            bytes: 长度为length的数据；超时或缓冲区已关闭时返回None
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._size >= length or self._closed, timeout):
+                self.underflows += 1
+                return None
+            if self._size < length:
+                return None
+
+            self.read_time = self._end_time - self._size / self._byte_rate
+            first = min(length, self._capacity - self._read_pos)
+            data = bytes(self._buffer[self._read_pos:self._read_pos + first])
+            if first < length:
+                data += bytes(self._buffer[:length - first])
+            self._read_pos = (self._read_pos + length) % self._capacity
+            self._size -= length
+            self._cond.notify_all()
+            return data
+
+    def close(self):
+        """关闭缓冲区，唤醒等待中的消费者"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def stats(self):
+        return {
+            "buffered_bytes": self._size,
+            "overflows": self.overflows,
+            "dropped_bytes": self.dropped_bytes,
+            "underflows": self.underflows,
+        }
+
+class VoiceActivityDetector:
+    """
+    轻量级本地语音活动检测（能量 + 过零率）
+
+    对整帧PCM用NumPy向量化计算能量(dBFS)和过零率，无逐采样Python循环。
+    噪声底噪在非语音帧上自适应跟踪，语音帧上也以NOISE_RISE_MS的时间常数缓慢上升，
+    持续的低频噪声（风扇、工频哼声）不会一直被判为语音；语音结束后保持hangover帧，避免切掉字尾。
+    """
+
+    NOISE_RISE_MS = 5000  # 语音帧上底噪估计上升的时间常数
+
+    def __init__(self, sample_rate=16000, margin_db=10.0, min_speech_db=-55.0, max_zcr=0.3,
+                 hangover_ms=300):
+        self.sample_rate = sample_rate
+        self.margin_db = margin_db
+        self.min_speech_db = min_speech_db
+        self.max_zcr = max_zcr
+        self.hangover_ms = hangover_ms
+        self.noise_db = -60.0
+        self.reset()
+
+    def reset(self):
+        """开始新一轮监听时清空语音状态（保留底噪估计）"""
+        self.speech_detected = False
+        self.trailing_silence_ms = 0.0
+        self.listening_ms = 0.0
+        self._hangover_ms = 0.0
+
+    def process(self, pcm):
+        """
+        检测一帧PCM（帧长可变）
+
+        Returns:
+            bool: 该帧是否应视为语音（含hangover）
+        """
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+        energy_db = 10.0 * np.log10(np.mean(samples * samples) / (32768.0 ** 2) + 1e-12)
+        zcr = np.count_nonzero(np.diff(np.signbit(samples))) / samples.size
+
+        # 过零率高的帧（嘶声、风噪）需要更高的能量才判为语音
+        above = energy_db - self.noise_db
+        voiced = (energy_db > self.min_speech_db and above > self.margin_db and
+                  (zcr < self.max_zcr or above > 2 * self.margin_db))
+
+        frame_ms = samples.size * 1000 / self.sample_rate
+        if not voiced:
+            # 底噪下降快、上升慢
+            rate = 0.5 if energy_db < self.noise_db else 0.05
+        else:
+            # 语音帧上底噪也缓慢上升，短句内几乎不变，持续数秒的稳态噪声会被吸收进底噪
+            rate = min(1.0, frame_ms / self.NOISE_RISE_MS)
+        self.noise_db += (energy_db - self.noise_db) * rate
+
+        self.listening_ms += frame_ms
+        if voiced:
+            self.speech_detected = True
+            self.trailing_silence_ms = 0.0
+            self._hangover_ms = self.hangover_ms
+            return True
+
+        self.trailing_silence_ms += frame_ms
+        if self._hangover_ms > 0:
+            self._hangover_ms -= frame_ms
+            return True
+        return False
+
+class FrameBudget:
+    """
+    采集处理阶段的每帧CPU预算（采集预处理、回声消除共用）
+
+    每帧耗时连续OVERRUN_LIMIT帧超出预算（帧时长的一定比例）时切换为直通，
+    RETRY_INTERVAL秒后再重试，可选的处理阶段不会拖慢采集。
+    """
+
+    OVERRUN_LIMIT = 3  # 连续超出预算的帧数
+    RETRY_INTERVAL = 30  # 直通后重试间隔（秒）
+
+    def __init__(self, name, ratio, sample_rate=16000, on_resume=None):
+        self.name = name
+        self.ratio = ratio
+        self.sample_rate = sample_rate
+        self.on_resume = on_resume
+        self.bypassed = False
+        self._retry_at = 0.0
+        self._overrun_run = 0
+
+        # 统计计数
+        self.frames = 0
+        self.overruns = 0
+        self.bypasses = 0
+        self.cost_seconds = 0.0
+        self.max_cost_seconds = 0.0
+
+    def should_process(self):
+        """本帧是否处理；直通期满时恢复处理并通知处理阶段重置状态"""
+        if not self.bypassed:
+            return True
+        if time.monotonic() < self._retry_at:
+            return False
+        self.bypassed = False
+        logging.info(f"{self.name}重新启用")
+        if self.on_resume is not None:
+            self.on_resume()
+        return True
+
+    def record(self, cost, samples):
+        """记录一帧（samples个采样）的处理耗时（秒）"""
+        self.frames += 1
+        self.cost_seconds += cost
+        self.max_cost_seconds = max(self.max_cost_seconds, cost)
+        if cost <= self.ratio * samples / self.sample_rate:
+            self._overrun_run = 0
+            return
+        self.overruns += 1
+        self._overrun_run += 1
+        if self._overrun_run >= self.OVERRUN_LIMIT:
+            # 本帧已处理完成，从下一帧起直通
+            self._overrun_run = 0
+            self.bypassed = True
+            self.bypasses += 1
+            self._retry_at = time.monotonic() + self.RETRY_INTERVAL
+            logging.warning(f"{self.name}连续 {self.OVERRUN_LIMIT} 帧超出CPU预算 "
+                            f"({cost * 1000:.2f}ms)，{self.RETRY_INTERVAL}秒内直通")
+            print(f"⚠️ {self.name}超出CPU预算，暂时直通")
+
+    def stats(self):
+        return {
+            "bypassed": self.bypassed,
+            "frames": self.frames,
+            "overruns": self.overruns,
+            "bypasses": self.bypasses,
+            "avg_cost_ms": round(self.cost_seconds / self.frames * 1000, 3) if self.frames else 0,
+            "max_cost_ms": round(self.max_cost_seconds * 1000, 3),
+        }
+
+class CaptureProcessor:
+    """
+    编码前的采集预处理：一阶高通去直流、自动增益控制(AGC)和噪声门
+
+    整帧以NumPy向量运算处理，没有逐采样的Python循环：一阶IIR高通用累加和的闭式解计算，
+    增益在帧内线性过渡以避免拉链噪声。耗时受FrameBudget约束，超出预算时直通。
+    """
+
+    AGC_ATTACK_DB_PER_S = 40.0  # 增益下降速度
+    AGC_RELEASE_DB_PER_S = 6.0  # 增益上升速度
+    AGC_MIN_GAIN_DB = -10.0
+    AGC_MIN_LEVEL_DB = -60.0  # 低于此电平的帧不参与增益调整
+    GATE_ATTENUATION_DB = -20.0  # 关门时相对原始电平的衰减
+    GATE_HOLD_MS = 200
+    NOISE_RISE_MS = 2000  # 底噪估计上升的时间常数
+    PEAK_LIMIT = 0.9 * 32767
+
+    def __init__(self, sample_rate=16000, highpass_hz=80.0, target_dbfs=-20.0, max_gain_db=30.0,
+                 gate_margin_db=8.0, cpu_budget=0.05):
+        self.sample_rate = sample_rate
+        self.r = math.exp(-2 * math.pi * highpass_hz / sample_rate)
+        self.target_dbfs = target_dbfs
+        self.max_gain_db = max_gain_db
+        self.gate_margin_db = gate_margin_db
+        self._tables = {}
+        self.budget = FrameBudget("采集预处理", cpu_budget, sample_rate, on_resume=self.restart)
+        self.restart()
+
+    def restart(self):
+        """清空滤波器、增益和底噪状态"""
+        self._x_prev = 0.0
+        self._y_prev = 0.0
+        self.gain_db = 0.0
+        self.noise_db = -60.0
+        self.gate_open = False
+        self._hold_ms = 0.0
+        self._applied_gain = 1.0
+
+    def _table(self, n):
+        """帧长n对应的R^k、R^-k和帧内增益过渡斜坡（按帧长缓存）"""
+        table = self._tables.get(n)
+        if table is None:
+            k = np.arange(n)
+            table = self._tables[n] = (self.r ** k, self.r ** -k, k / n)
+        return table
+
+    def process(self, pcm):
+        """
+        处理一帧16位PCM，超出CPU预算的直通期间原样返回
+
+        Returns:
+            bytes: 处理后的PCM（长度不变）
+        """
+        if not self.budget.should_process():
+            return pcm
+        start = time.perf_counter()
+        out = self._process(pcm)
+        self.budget.record(time.perf_counter() - start, len(pcm) // 2)
+        return out
+
+    def _process(self, pcm):
+        x = np.frombuffer(pcm, dtype=np.int16).astype(np.float64)
+        n = x.size
+        if not n:
+            return pcm
+        frame_ms = n * 1000 / self.sample_rate
+        powers, inverse, ramp = self._table(n)
+
+        # 一阶高通 y[k] = x[k] - x[k-1] + R*y[k-1] 的闭式解：
+        # y[k] = R^k * (R*y[-1] + Σ_{j≤k} R^-j * (x[j] - x[j-1]))
+        diff = np.diff(x, prepend=self._x_prev)
+        y = powers * (self.r * self._y_prev + np.cumsum(diff * inverse))
+        self._x_prev = x[-1]
+        self._y_prev = y[-1]
+
+        level_db = 10.0 * math.log10(float(np.dot(y, y)) / n / (32768.0 ** 2) + 1e-12)
+
+        # 噪声门：高出底噪gate_margin_db时开门，低于后保持GATE_HOLD_MS再关门
+        above = level_db > self.noise_db + self.gate_margin_db
+        if above:
+            self._hold_ms = self.GATE_HOLD_MS
+        else:
+            self._hold_ms -= frame_ms
+        self.gate_open = self._hold_ms > 0
+        # 底噪估计下降快、上升慢（说话期间也缓慢跟踪，环境噪声变大后不会一直开门）
+        rate = 0.5 if level_db < self.noise_db else min(1.0, frame_ms / self.NOISE_RISE_MS)
+        self.noise_db += (level_db - self.noise_db) * rate
+
+        # AGC：只在语音帧上按目标电平调整增益，下降快、上升慢
+        if above and level_db > self.AGC_MIN_LEVEL_DB:
+            desired = min(max(self.target_dbfs - level_db, self.AGC_MIN_GAIN_DB), self.max_gain_db)
+            speed = self.AGC_ATTACK_DB_PER_S if desired < self.gain_db else self.AGC_RELEASE_DB_PER_S
+            step = speed * frame_ms / 1000
+            self.gain_db += min(max(desired - self.gain_db, -step), step)
+
+        # 关门时不放大底噪，并在原始电平上衰减GATE_ATTENUATION_DB
+        gain_db = self.gain_db if self.gate_open else min(self.gain_db, 0.0) + self.GATE_ATTENUATION_DB
+        gain = 10.0 ** (gain_db / 20)
+        peak = float(np.max(np.abs(y)))
+        if peak * gain > self.PEAK_LIMIT:
+            # 峰值限制只作用于本帧，不改变AGC状态
+            gain = self.PEAK_LIMIT / peak
+
+        # 增益下降时帧内线性过渡，上升（开门、起音）时立即生效
+        start = self._applied_gain if gain < self._applied_gain else gain
+        self._applied_gain = gain
+        if start == gain:
+            y *= gain
+        else:
+            y *= start + (gain - start) * ramp
+        return np.clip(y, -32768, 32767).astype(np.int16).tobytes()
+
+    def stats(self):
+        stats = {
+            "gain_db": round(self.gain_db, 1),
+            "noise_db": round(self.noise_db, 1),
+            "gate_open": self.gate_open,
+        }
+        stats.update(self.budget.stats())
+        return stats
+
+# ============================================================================
+# 回声消除
+# ============================================================================
+
+def aec_enabled():
+    """是否开启回声消除：auto时仅在全双工（realtime）模式下开启"""
+    return AEC_MODE == "on" or (AEC_MODE == "auto" and LISTEN_MODE == "realtime")
+
+def stream_delay(time_info, key):
+    """
+    PyAudio回调time_info中的ADC采集/DAC播放时刻与当前时刻之差（秒）
+
+    部分驱动不提供这些时刻（为0），此时返回0。
+    """
+    delay = abs(time_info.get(key, 0) - time_info.get('current_time', 0))
+    return delay if delay < 1.0 else 0.0
+
+class Resampler:
+    """
+    整数比重采样：插零上采样、加窗sinc低通、抽取，块间保留滤波器状态
+
+    用于把下行播放PCM（通常24kHz）转换为16kHz的回声参考信号。
+    """
+
+    def __init__(self, source_rate, target_rate, taps_per_phase=24):
+        divisor = math.gcd(source_rate, target_rate)
+        self.source_rate = source_rate
+        self.up = target_rate // divisor
+        self.down = source_rate // divisor
+        factor = max(self.up, self.down)
+        taps = taps_per_phase * factor + 1
+        k = np.arange(taps) - (taps - 1) / 2
+        # 截止频率取两侧奈奎斯特频率中较低者的90%，增益补偿插零损失
+        cutoff = 0.9 / factor
+        self._filter = (cutoff * np.sinc(cutoff * k) * np.kaiser(taps, 6.0) * self.up).astype(np.float32)
+        self._history = np.zeros(taps - 1, dtype=np.float32)
+        self._phase = 0
+
+    def process(self, samples):
+        if self.up == self.down:
+            return samples
+        upsampled = np.zeros(samples.size * self.up, dtype=np.float32)
+        upsampled[::self.up] = samples
+        extended = np.concatenate((self._history, upsampled))
+        filtered = np.convolve(extended, self._filter, mode='valid')
+        out = filtered[self._phase::self.down]
+        # 下一块第一个输出采样在上采样序列中的偏移
+        self._phase = (self._phase - upsampled.size) % self.down
+        self._history = extended[-self._history.size:]
+        return out
+
+class EchoReference:
+    """
+    回声消除的远端参考信号
+
+    播放回调写入实际送往扬声器的PCM及其首个采样的播放时刻（按DAC时间换算到time.monotonic()），
+    重采样到16kHz后存入环形缓冲区，并维护“采样序号 ↔ 播放时刻”的对应关系；
+    编码线程按采集时刻读取与之对齐的参考信号。播放中断（会话之间）留下的空档补零。
+    """
+
+    CAPACITY = 16000 * 2  # 2秒
+    RESYNC_MS = 20  # 播放时刻与连续推算值相差超过该值时重新对齐
+
+    def __init__(self, sample_rate=16000):
+        self.sample_rate = sample_rate
+        self._buffer = np.zeros(self.CAPACITY, dtype=np.float32)
+        self._end = 0  # 已写入的采样总数
+        self._anchor_time = None  # 第_anchor_index个采样的播放时刻
+        self._anchor_index = 0
+        self._resampler = None
+        self._lock = threading.Lock()
+
+        # 统计计数
+        self.gaps = 0
+        self.resyncs = 0
+
+    def write(self, pcm, sample_rate, play_time):
+        """写入一次播放回调输出的PCM（播放回调线程）"""
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+        if self._resampler is None or self._resampler.source_rate != sample_rate:
+            self._resampler = Resampler(sample_rate, self.sample_rate)
+        samples = self._resampler.process(samples)[-self.CAPACITY:]
+
+        with self._lock:
+            if self._anchor_time is None:
+                self._anchor_time, self._anchor_index = play_time, self._end
+            else:
+                expected = self._anchor_time + (self._end - self._anchor_index) / self.sample_rate
+                gap = int(round((play_time - expected) * self.sample_rate))
+                if 0 < gap < self.CAPACITY and gap * 1000 > self.RESYNC_MS * self.sample_rate:
+                    # 播放中断后重新开始：空档补零，保持时间轴连续
+                    self.gaps += 1
+                    self._store(np.zeros(gap, dtype=np.float32))
+                elif abs(gap) * 1000 > self.RESYNC_MS * self.sample_rate:
+                    self.resyncs += 1
+                    self._buffer[:] = 0
+                    self._anchor_time, self._anchor_index = play_time, self._end
+            self._store(samples)
+
+    def _store(self, samples):
+        position = self._end % self.CAPACITY
+        first = min(samples.size, self.CAPACITY - position)
+        self._buffer[position:position + first] = samples[:first]
+        self._buffer[:samples.size - first] = samples[first:]
+        self._end += samples.size
+
+    def read(self, start_time, count):
+        """读取从start_time开始播放的count个参考采样（编码线程），缓冲范围之外的部分为0"""
+        out = np.zeros(count, dtype=np.float32)
+        with self._lock:
+            if self._anchor_time is None:
+                return out
+            first = self._anchor_index + int(round((start_time - self._anchor_time) * self.sample_rate))
+            low = max(first, self._end - self.CAPACITY)
+            high = min(first + count, self._end)
+            if low < high:
+                out[low - first:high - first] = self._buffer[np.arange(low, high) % self.CAPACITY]
+        return out
+
+    def stats(self):
+        return {"gaps": self.gaps, "resyncs": self.resyncs}
+
+class EchoCanceller:
+    """
+    分块频域回声消除（PBFDAF：分段块频域NLMS，重叠保留法）
+
+    以BLOCK_SIZE个采样为一块：远端参考按块做FFT，回声路径按tail_ms分成若干段频域权重，
+    回声估计、误差和权重更新都是整块的NumPy向量运算。步长按各频点远端功率归一化，
+    并以误差功率作正则项，近端说话时自适应自动变慢；滤波器收敛后误差远大于回声估计的块
+    判为双讲，暂停自适应。每块只对一段权重做时域约束（轮换），以较小代价消除循环卷积的偏差。
+
+    参考信号按采集时刻从EchoReference读取，并提前lead_ms，使时间戳误差不会让回声领先于参考。
+    """
+
+    BLOCK_SIZE = 320  # 20ms，采集帧长（20/40/60ms）均为其整数倍
+    STEP_SIZE = 0.5
+    FAR_ACTIVE_DB = -50.0  # 远端低于此电平的块不做自适应
+    CONVERGED_ERLE_DB = 6.0  # ERLE超过该值后启用双讲判决
+    DOUBLE_TALK_RATIO = 4.0  # 误差能量超过回声估计能量的倍数
+    DOUBLE_TALK_MAX_BLOCKS = 50  # 连续判为双讲的最多块数，之后强制自适应（回声路径可能已变化）
+    DIVERGENCE_BLOCKS = 25  # 连续多少块输出能量大于输入时重置滤波器
+
+    def __init__(self, reference, tail_ms=200, lead_ms=20, cpu_budget=0.15, sample_rate=16000):
+        block = self.BLOCK_SIZE
+        self.reference = reference
+        self.lead = lead_ms / 1000
+        self.sample_rate = sample_rate
+        self.partitions = max(1, math.ceil(tail_ms * sample_rate / 1000 / block))
+        self._zeros = np.zeros(block)
+        far_active = (32768.0 * 10 ** (self.FAR_ACTIVE_DB / 20)) ** 2
+        self._far_threshold = far_active
+        # 频域正则项：约为远端处于自适应门限电平时单段的功率
+        self._regularization = 2 * block * far_active
+        self.budget = FrameBudget("回声消除", cpu_budget, sample_rate, on_resume=self.reset)
+
+        # 统计计数
+        self.resets = 0
+        self.double_talk_blocks = 0
+        self.reset()
+
+    def reset(self):
+        """清空滤波器权重和远端历史"""
+        bins = self.BLOCK_SIZE + 1
+        self._weights = np.zeros((self.partitions, bins), dtype=np.complex128)
+        self._far_spectra = np.zeros((self.partitions, bins), dtype=np.complex128)
+        self._far_prev = np.zeros(self.BLOCK_SIZE)
+        self._error_power = np.zeros(bins)
+        self._blocks = 0
+        self._double_talk_run = 0
+        self._diverging = 0
+        self._near_energy = 0.0
+        self._out_energy = 0.0
+        self.erle_db = 0.0
+
+    def process(self, pcm, capture_time):
+        """
+        消除一帧采集PCM中的回声
+
+        Args:
+            pcm: 16位PCM，长度为BLOCK_SIZE的整数倍
+            capture_time: 首个采样的采集时刻（time.monotonic()时钟），None时原样返回
+        """
+        near = np.frombuffer(pcm, dtype=np.int16).astype(np.float64)
+        if capture_time is None or near.size % self.BLOCK_SIZE or not self.budget.should_process():
+            return pcm
+        start = time.perf_counter()
+        far = self.reference.read(capture_time - self.lead, near.size).astype(np.float64)
+        out = np.empty_like(near)
+        for offset in range(0, near.size, self.BLOCK_SIZE):
+            end = offset + self.BLOCK_SIZE
+            out[offset:end] = self._process_block(near[offset:end], far[offset:end])
+        self.budget.record(time.perf_counter() - start, near.size)
+        return np.clip(out, -32768, 32767).astype(np.int16).tobytes()
+
+    def _process_block(self, near, far):
+        block = self.BLOCK_SIZE
+        spectrum = np.fft.rfft(np.concatenate((self._far_prev, far)))
+        self._far_prev = far
+        self._far_spectra = np.roll(self._far_spectra, 1, axis=0)
+        self._far_spectra[0] = spectrum
+
+        echo = np.fft.irfft((self._weights * self._far_spectra).sum(axis=0))[block:]
+        error = near - echo
+        near_energy = float(np.dot(near, near))
+        error_energy = float(np.dot(error, error))
+        self._blocks += 1
+
+        if float(np.dot(far, far)) / block > self._far_threshold:
+            echo_energy = float(np.dot(echo, echo))
+            double_talk = (self.erle_db > self.CONVERGED_ERLE_DB and
+                           error_energy > self.DOUBLE_TALK_RATIO * echo_energy and
+                           self._double_talk_run < self.DOUBLE_TALK_MAX_BLOCKS)
+            if double_talk:
+                self._double_talk_run += 1
+                self.double_talk_blocks += 1
+            else:
+                self._double_talk_run = 0
+                self._adapt(error)
+                # 只在远端单讲的块上估计ERLE
+                self._near_energy = 0.9 * self._near_energy + 0.1 * near_energy
+                self._out_energy = 0.9 * self._out_energy + 0.1 * min(error_energy, near_energy)
+                self.erle_db = 10 * math.log10((self._near_energy + 1.0) / (self._out_energy + 1.0))
+
+            if error_energy > 2 * near_energy:
+                self._diverging += 1
+                if self._diverging >= self.DIVERGENCE_BLOCKS:
+                    logging.warning("回声消除滤波器发散，重置")
+                    self.resets += 1
+                    self.reset()
+            else:
+                self._diverging = 0
+
+        # 输出不比输入更响（未收敛或发散时不引入额外失真）
+        return error if error_energy <= near_energy else near
+
+    def _adapt(self, error):
+        block = self.BLOCK_SIZE
+        error_spectrum = np.fft.rfft(np.concatenate((self._zeros, error)))
+        # 误差只占半个FFT窗，按段数放大到与远端功率之和可比的量级
+        power = (error_spectrum.real ** 2 + error_spectrum.imag ** 2) * 2 * self.partitions
+        self._error_power = np.maximum(power, 0.5 * self._error_power + 0.5 * power)
+        far_power = (self._far_spectra.real ** 2 + self._far_spectra.imag ** 2).sum(axis=0)
+        gradient = error_spectrum / (far_power + self._error_power + self._regularization)
+        self._weights += self.STEP_SIZE * np.conj(self._far_spectra) * gradient
+
+        # 轮换约束一段权重：时域后半段置零，保证线性卷积
+        index = self._blocks % self.partitions
+        weights = np.fft.irfft(self._weights[index])
+        weights[block:] = 0
+        self._weights[index] = np.fft.rfft(weights)
+
+    def stats(self):
+        stats = {
+            "erle_db": round(self.erle_db, 1),
+            "partitions": self.partitions,
+            "double_talk_blocks": self.double_talk_blocks,
+            "resets": self.resets,
+        }
+        stats.update(self.budget.stats())
+        return stats
+
+# ============================================================================
+# 唤醒词检测
+# ============================================================================
+#
+# 唤醒词引擎是可插拔的：WAKE_WORD_ENGINES 中的每个工厂函数返回一个检测器对象，需提供
+#   process(pcm)  输入一帧16kHz 16位单声道PCM（帧长可变），检测到唤醒词时返回
+#                 {"name", "score", "duration_ms", "delay_ms"}（delay_ms为唤醒词结束
+#                 到本帧末尾的时长），否则返回None
+#   reset()       清空匹配状态（开始监听、会话结束后调用）
+#   stats()       返回统计字典（至少含 detections、frames、avg_cost_ms）
+# 检测器在采集线程中对未监听期间的每一帧调用，必须足够轻量，不得阻塞。
+
+def mel_filterbank(sample_rate, fft_size, bands, low_hz=60.0, high_hz=None):
+    """三角Mel滤波器组，返回 (fft_size // 2 + 1, bands) 的权重矩阵"""
+    high_hz = high_hz or sample_rate / 2
+    to_mel = lambda hz: 2595.0 * np.log10(1.0 + hz / 700.0)
+    edges_mel = np.linspace(to_mel(low_hz), to_mel(high_hz), bands + 2)
+    edges = 700.0 * (10.0 ** (edges_mel / 2595.0) - 1.0)
+    freqs = np.arange(fft_size // 2 + 1) * sample_rate / fft_size
+    lower, center, upper = edges[:-2], edges[1:-1], edges[2:]
+    rising = (freqs[:, None] - lower) / (center - lower)
+    falling = (upper - freqs[:, None]) / (upper - center)
+    return np.maximum(0.0, np.minimum(rising, falling)).astype(np.float32)
+
+class MfccExtractor:
+    """
+    流式MFCC特征提取：25ms汉明窗、10ms帧移，每次调用把可用的整窗一次性向量化计算
+
+    分窗、FFT、Mel滤波和DCT均为矩阵运算，预加重折算为Mel滤波器的频域权重（能量仍按
+    原始信号计算）；跨调用保留不足一窗的尾部采样。
+    倒谱减去按指数滑动平均跟踪的均值（CMN），抵消麦克风和房间的频响差异。
+    """
+
+    WINDOW = 400
+    HOP = 160
+    FFT_SIZE = 512
+    BANDS = 26
+    COEFFS = 12  # c1~c12，c0（能量）单独输出
+    PRE_EMPHASIS = 0.97
+
+    def __init__(self, sample_rate=16000, cmn_seconds=3.0):
+        self.sample_rate = sample_rate
+        self._window = np.hamming(self.WINDOW).astype(np.float32)
+        freqs = np.arange(self.FFT_SIZE // 2 + 1) * 2 * np.pi / self.FFT_SIZE
+        emphasis = 1 + self.PRE_EMPHASIS ** 2 - 2 * self.PRE_EMPHASIS * np.cos(freqs)
+        self._mel = mel_filterbank(sample_rate, self.FFT_SIZE, self.BANDS) * emphasis[:, None].astype(np.float32)
+        n = np.arange(self.BANDS)
+        k = np.arange(1, self.COEFFS + 1)
+        self._dct = np.cos(np.pi / self.BANDS * (n[:, None] + 0.5) * k).astype(np.float32)
+        self._decay = math.exp(-self.HOP / (cmn_seconds * sample_rate))
+        self.reset()
+
+    def reset(self):
+        self._tail = np.zeros(0, dtype=np.float32)
+        self.mean = None
+
+    def skip(self):
+        """跳过一段PCM（不提取特征），下一段从新窗口开始"""
+        self._tail = np.zeros(0, dtype=np.float32)
+
+    def process(self, pcm):
+        """
+        提取一段PCM中所有完整窗的特征
+
+        Returns:
+            (features, energy_db): 形状为 (帧数, COEFFS) 的倒谱和每帧能量(dBFS)
+        """
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+        buffer = np.concatenate((self._tail, samples))
+        count = (buffer.size - self.WINDOW) // self.HOP + 1 if buffer.size >= self.WINDOW else 0
+        self._tail = buffer[count * self.HOP:]
+        if not count:
+            return np.zeros((0, self.COEFFS), dtype=np.float32), np.zeros(0, dtype=np.float32)
+
+        frames = np.lib.stride_tricks.sliding_window_view(buffer, self.WINDOW)[::self.HOP][:count]
+        spectrum = np.fft.rfft(frames * self._window, self.FFT_SIZE)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        energy_db = 10.0 * np.log10(power.sum(axis=1) / (self.FFT_SIZE * self.WINDOW) + 1e-12)
+        cepstra = np.log(power @ self._mel + 1e-10) @ self._dct
+
+        # 整批更新CMN均值：与逐帧指数平均等价的衰减量
+        batch_mean = cepstra.mean(axis=0)
+        if self.mean is None:
+            self.mean = batch_mean
+        else:
+            self.mean = self.mean + (1.0 - self._decay ** count) * (batch_mean - self.mean)
+        return cepstra - self.mean, energy_db
+
+class TemplateWakeWordDetector:
+    """
+    参考唤醒词引擎：MFCC模板匹配（流式子序列DTW，NumPy向量化）
+
+    用几段录制的唤醒词作模板，每10ms特征帧对所有模板的所有帧同时做一步DTW：
+    每个模板帧可由上一特征帧的同一帧（慢读）、前一帧或前两帧（快读）到达，
+    选加入本步后平均代价最小的前驱，模板首帧随时开始新路径；路径走到模板末帧时的
+    平均余弦距离低于阈值即为候选，得分连续几帧不再下降后触发。
+
+    各模板首尾相接存放，之间隔两个代价恒为无穷的填充帧，前驱直接用错位切片读取，
+    不需要逐模板处理边界。能量不高于底噪（自适应跟踪）的静音持续超过HOLD_MS后不再提取
+    特征、直接清空路径（音节间的短暂停顿照常匹配），常驻运行时大部分时间只有一次能量计算。
+    """
+
+    MIN_ENERGY_DB = -60.0  # 低于此能量的帧总是视为静音
+    GATE_MARGIN_DB = 6.0  # 高出底噪不足该分贝数的帧视为静音
+    HOLD_MS = 300  # 静音持续超过该时长后停止匹配
+    TRIM_DB = 30.0  # 模板首尾低于峰值能量该分贝数的帧裁掉
+    CONFIRM_HOPS = 5  # 候选得分连续不再下降的特征帧数
+    REFRACTORY_MS = 1000  # 触发后的不应期
+    PAD = 2  # 模板之间的填充帧数（最大跳步）
+
+    def __init__(self, templates, name="wake_word", threshold=0.2, sample_rate=16000):
+        """
+        Args:
+            templates: 唤醒词录音列表（16kHz 16位单声道PCM）
+            name: 唤醒词文本，检测结果和listen detect消息中使用
+            threshold: 触发阈值（平均余弦距离，越小越严格）
+        """
+        self.name = name
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.extractor = MfccExtractor(sample_rate)
+
+        extracted = [self._template_features(pcm) for pcm in templates]
+        extracted = [(f, mean) for f, mean in extracted if len(f) >= 10]
+        if not extracted:
+            raise ValueError("唤醒词模板为空或有效语音过短")
+        features = [f for f, _ in extracted]
+        # 以模板语音段的倒谱均值作为实时CMN的初值：启动后的第一句唤醒词
+        # 不会以自身开头几帧为均值做归一化
+        self.extractor.mean = np.mean([mean for _, mean in extracted], axis=0)
+        lengths = np.array([len(f) for f in features])
+        padding = np.zeros((self.PAD, MfccExtractor.COEFFS), dtype=np.float32)
+        self._templates = np.concatenate([part for f in features for part in (padding, f)])
+        starts = np.cumsum(lengths + self.PAD) - lengths
+        self._ends = starts + lengths - 1
+
+        # 以下掩码均对应去掉开头填充后的行（DTW一步只更新这些行）
+        size = len(self._templates) - self.PAD
+        self._first = np.zeros(size, dtype=bool)
+        self._first[starts - self.PAD] = True
+        self._padding = np.ones(size, dtype=bool)
+        for start, length in zip(starts, lengths):
+            self._padding[start - self.PAD:start - self.PAD + length] = False
+        self._max_length = np.zeros(size)
+        for start, length in zip(starts, lengths):
+            self._max_length[start - self.PAD:start - self.PAD + length] = length * 2
+        self.max_duration_ms = int(lengths.max() * 2 * MfccExtractor.HOP * 1000 / sample_rate)
+
+        # 统计计数
+        self.detections = 0
+        self.frames = 0
+        self.active_hops = 0
+        self.best_score = float('inf')
+        self.cost_seconds = 0.0
+        self.noise_db = self.MIN_ENERGY_DB
+        self._silence_ms = self.HOLD_MS
+        self.reset()
+
+    def _template_features(self, pcm):
+        """
+        提取模板特征：裁掉首尾静音，以语音段均值做CMN，按行归一化
+
+        Returns:
+            (features, mean): 归一化后的特征和语音段CMN前的倒谱均值（无有效语音时features为空）
+        """
+        extractor = MfccExtractor(self.sample_rate)
+        cepstra, energy_db = extractor.process(pcm)
+        if not len(cepstra):
+            return cepstra, None
+        voiced = np.flatnonzero(energy_db > max(energy_db.max() - self.TRIM_DB, self.MIN_ENERGY_DB))
+        if not voiced.size:
+            return cepstra[:0], None
+        # 实时流的CMN均值只在有声帧上更新，模板同样只用裁剪后的语音段求均值
+        cepstra = cepstra[voiced[0]:voiced[-1] + 1]
+        mean = cepstra.mean(axis=0)
+        cepstra = cepstra - mean
+        features = (cepstra / (np.linalg.norm(cepstra, axis=1, keepdims=True) + 1e-9)).astype(np.float32)
+        return features, mean + extractor.mean
+
+    def reset(self):
+        """清空所有匹配路径和候选"""
+        self._cost = np.full(len(self._templates), np.inf)
+        self._length = np.zeros(len(self._templates))
+        self._candidate = None
+        self._refractory_hops = 0
+        self._hops = 0
+
+    def process(self, pcm):
+        start = time.perf_counter()
+        try:
+            return self._process(pcm)
+        finally:
+            self.frames += 1
+            self.cost_seconds += time.perf_counter() - start
+
+    def _process(self, pcm):
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32)
+        hops = samples.size // MfccExtractor.HOP
+        energy = 10.0 * math.log10(np.dot(samples, samples) / max(samples.size, 1) / 32768.0 ** 2 + 1e-12)
+        gate_db = max(self.MIN_ENERGY_DB, self.noise_db + self.GATE_MARGIN_DB)
+        # 底噪下降快、上升慢；持续的高电平（如风扇启动）只会缓慢抬高底噪，不影响短时语音
+        rate = 0.5 if energy < self.noise_db else 0.05 if energy < gate_db else 0.005
+        self.noise_db += (energy - self.noise_db) * rate
+        if energy >= gate_db:
+            self._silence_ms = 0
+        else:
+            self._silence_ms += samples.size * 1000 / self.sample_rate
+            if self._silence_ms > self.HOLD_MS and self._candidate is None:
+                # 持续静音：不提取特征，路径全部作废
+                self._hops += hops
+                self._refractory_hops = max(0, self._refractory_hops - hops)
+                self.extractor.skip()
+                self._cost.fill(np.inf)
+                return None
+
+        features, _ = self.extractor.process(pcm)
+        norms = np.linalg.norm(features, axis=1, keepdims=True) + 1e-9
+        # 一次矩阵乘法得到所有特征帧与所有模板帧的余弦距离
+        distances = 1.0 - (features / norms) @ self._templates[self.PAD:].T
+        detection = None
+        for index in range(len(features)):
+            self._hops += 1
+            self.active_hops += 1
+            self._step(distances[index])
+            if self._refractory_hops:
+                self._refractory_hops -= 1
+                continue
+            found = self._check(len(features) - 1 - index)
+            if found is not None:
+                detection = found
+        return detection
+
+    def _step(self, distance):
+        """所有模板帧同时前进一步DTW"""
+        cost, length = self._cost, self._length
+        pad = self.PAD
+        stay_cost, advance_cost, skip_cost = cost[pad:], cost[pad - 1:-1], cost[:-pad]
+        stay_length, advance_length, skip_length = length[pad:], length[pad - 1:-1], length[:-pad]
+
+        stay = (stay_cost + distance) / (stay_length + 1)
+        advance = (advance_cost + distance) / (advance_length + 1)
+        skip = (skip_cost + distance) / (skip_length + 1)
+        use_advance = advance < stay
+        new_cost = np.where(use_advance, advance_cost, stay_cost)
+        new_length = np.where(use_advance, advance_length, stay_length)
+        use_skip = skip < np.minimum(stay, advance)
+        new_cost = np.where(use_skip, skip_cost, new_cost)
+        new_length = np.where(use_skip, skip_length, new_length)
+
+        # 模板首帧总是开始一条新路径（唤醒词可从任意时刻开始），填充帧保持无穷代价
+        new_cost[self._first] = 0.0
+        new_length[self._first] = 0.0
+        new_cost += distance
+        new_length += 1
+        new_cost[self._padding | (new_length > self._max_length)] = np.inf
+        cost[pad:] = new_cost
+        length[pad:] = new_length
+
+    def _check(self, remaining_hops):
+        """检查模板末帧得分：候选得分连续CONFIRM_HOPS帧不再下降后触发"""
+        scores = self._cost[self._ends] / self._length[self._ends]
+        best = int(np.argmin(scores))
+        score = float(scores[best])
+        self.best_score = min(self.best_score, score)
+        candidate = self._candidate
+        if score < self.threshold and (candidate is None or score < candidate["score"]):
+            self._candidate = {"score": score, "hop": self._hops,
+                               "length": int(self._length[self._ends[best]])}
+            return None
+        if candidate is None or self._hops - candidate["hop"] < self.CONFIRM_HOPS:
+            return None
+
+        self._candidate = None
+        self._cost.fill(np.inf)
+        self._refractory_hops = self.REFRACTORY_MS * self.sample_rate // 1000 // MfccExtractor.HOP
+        self.detections += 1
+        hop_ms = MfccExtractor.HOP * 1000 / self.sample_rate
+        return {
+            "name": self.name,
+            "score": round(candidate["score"], 3),
+            "duration_ms": int(candidate["length"] * hop_ms),
+            "delay_ms": int((self._hops - candidate["hop"] + remaining_hops) * hop_ms),
+        }
+
+    def stats(self):
+        return {
+            "detections": self.detections,
+            "frames": self.frames,
+            "active_hops": self.active_hops,
+            "best_score": round(self.best_score, 3) if self.best_score != float('inf') else None,
+            "noise_db": round(self.noise_db, 1),
+            "avg_cost_ms": round(self.cost_seconds / self.frames * 1000, 3) if self.frames else 0,
+            "template_frames": len(self._templates) - self.PAD * len(self._ends),
+        }
+
+def load_wake_word_templates(paths):
+    """读取唤醒词模板录音（WAV或16kHz裸PCM）"""
+    if not paths:
+        raise ValueError("模板唤醒词引擎需要用 --wake-template 指定至少一段唤醒词录音")
+    return [load_pcm_file(path, 16000) for path in paths]
+
+# 唤醒词引擎名称 -> 工厂函数（按当前配置创建检测器）
+WAKE_WORD_ENGINES = {
+    "template": lambda: TemplateWakeWordDetector(load_wake_word_templates(WAKE_WORD_TEMPLATES),
+                                                 WAKE_WORD, WAKE_WORD_THRESHOLD),
+}
+
+def create_wake_word_detector():
+    """按配置创建唤醒词检测器；未启用时返回None"""
+    if WAKE_WORD_ENGINE is None:
+        return None
+    return WAKE_WORD_ENGINES[WAKE_WORD_ENGINE]()
+
+# ============================================================================
+# 下行播放
+# ============================================================================
+
+class FrameQueue:
+    """
+    网络接收线程与播放回调之间的有界帧队列
+
+    基于collections.deque：append/popleft在CPython中是原子操作，
+    生产者和消费者各占一端，无需额外加锁。队列满时丢弃最旧的帧并计数。
+    """
+
+    def __init__(self, capacity=64):
+        self._items = collections.deque(maxlen=capacity)
+        self.capacity = capacity
+        self.high_water = 0
+        self.dropped = 0
+
+    def put(self, item):
+        """放入一帧（生产者：网络接收线程）"""
+        if len(self._items) >= self.capacity:
+            self.dropped += 1
+        self._items.append(item)
+        size = len(self._items)
+        if size > self.high_water:
+            self.high_water = size
+
+    def get_nowait(self):
+        """取出一帧，队列为空时返回None（消费者：播放回调）"""
+        try:
+            return self._items.popleft()
+        except IndexError:
+            return None
+
+    def clear(self):
+        self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+class AudioPlayer:
+    """
+    下行播放阶段
+
+    使用音频后端的回调模式输出流：回调中把网络线程送来的帧转入抖动缓冲，
+    按序解码（丢包时FEC/PLC补偿）后输出。网络接收不再被扬声器写入阻塞。
+
+    打断（interrupt）后，下一次回调清空队列、抖动缓冲和待输出PCM并输出静音；
+    被打断语音的后续下行包按序列号丢弃，直到发送listen stop或服务端开始下一段TTS（resume）。
+    恢复后只在新音频到达前丢弃被打断语音的迟到包：收到更新的包或下一段TTS开始时
+    清除打断点，服务端每段TTS重置序列号时新回复不会被误丢。
+    """
+
+    def __init__(self, sample_rate, frame_duration, echo_reference=None):
+        self.sample_rate = sample_rate
+        self.frame_duration = frame_duration
+        self.echo_reference = echo_reference
+        self.frame_num = int(frame_duration / (1000 / sample_rate))
+        self.queue = FrameQueue()
+        self.jitter_buffer = JitterBuffer(frame_duration, JITTER_MIN_DEPTH, JITTER_MAX_DEPTH)
+        self._decoder = opuslib.Decoder(sample_rate, 1)
+        self._pcm = bytearray()
+        self._last_arrival = 0.0
+        self._stream = None
+        self._interrupt_at = None
+        self._discarding = False
+        self._highest_sequence = None
+        self._stale_sequence = None
+
+        # 统计计数
+        self.underruns = 0
+        self.output_underflows = 0
+        self.decode_errors = 0
+        self.barge_in_dropped = 0
+
+    def start(self):
+        """打开并启动回调模式输出流"""
+        with ALSAErrorSuppressor():
+            self._stream = audio.open(format=PA_INT16, channels=1,
+                                      rate=self.sample_rate, output=True,
+                                      frames_per_buffer=self.frame_num,
+                                      stream_callback=self._callback)
+        return self._stream is not None
+
+    def stop(self):
+        """停止并关闭输出流"""
+        if self._stream is not None:
+            try:
+                self._stream.stop_stream()
+                self._stream.close()
+            except:
+                pass
+            self._stream = None
+
+    def feed(self, sequence, payload, arrival):
+        """网络接收线程调用：放入一个已解密的Opus帧"""
+        if self._highest_sequence is None or sequence_before(self._highest_sequence, sequence):
+            self._highest_sequence = sequence
+        self._last_arrival = arrival
+        self.queue.put((sequence, payload, arrival))
+
+    def drop_stale(self, sequence):
+        """
+        丢弃被打断语音的下行包（在解密前调用）
+
+        打断后到恢复接收前的包全部丢弃；恢复后丢弃不晚于其最大序列号的迟到包，
+        直到收到打断点之后的包或下一段TTS开始。
+
+        Returns:
+            bool: 包是否被丢弃
+        """
+        if self._discarding:
+            if self._stale_sequence is None or sequence_before(self._stale_sequence, sequence):
+                self._stale_sequence = sequence
+        elif self._stale_sequence is None:
+            return False
+        elif sequence_before(self._stale_sequence, sequence):
+            # 新的音频已经到达，不再需要打断点
+            self._stale_sequence = None
+            return False
+        elif ((self._stale_sequence - sequence) & 0xFFFFFFFF) >= JitterBuffer.RESYNC_DISTANCE:
+            return False
+        self.barge_in_dropped += 1
+        return True
+
+    def interrupt(self):
+        """打断播放（事件循环中调用）：丢弃已缓冲和在途的被打断语音"""
+        self._discarding = True
+        self._stale_sequence = self._highest_sequence
+        self._interrupt_at = time.monotonic()
+
+    def resume(self, new_segment=False):
+        """
+        恢复接收下行音频
+
+        在发送listen stop和收到TTS start时调用：新的回复只会在listen stop之后开始，
+        而UDP音频可能先于MQTT的TTS start到达，不能等到TTS start才恢复。
+
+        Args:
+            new_segment: 服务端已开始下一段TTS（序列号可能从头开始），清除打断点
+        """
+        self._discarding = False
+        if new_segment:
+            self._stale_sequence = None
+            self._highest_sequence = None
+
+    def _decode(self, frame):
+        payload, fec_payload = frame
+        try:
+            if payload is not None:
+                return self._decoder.decode(payload, self.frame_num)
+            if fec_payload is not None:
+                # 下一帧携带的带内FEC可恢复丢失帧
+                return self._decoder.decode(fec_payload, self.frame_num, decode_fec=True)
+        except Exception as e:
+            # 损坏的帧按丢包处理，不能让异常中断播放回调
+            self.decode_errors += 1
+            logging.error(f"音频解码错误: {str(e)}")
+        # 空数据触发Opus丢包补偿(PLC)
+        return self._decoder.decode(b'', self.frame_num)
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        """PyAudio输出回调：返回frame_count个采样，同时作为回声消除的远端参考"""
+        out, flag = self._render(frame_count, time_info, status)
+        if self.echo_reference is not None:
+            self.echo_reference.write(out, self.sample_rate,
+                                      time.monotonic() + stream_delay(time_info, 'output_buffer_dac_time'))
+        return out, flag
+
+    def _render(self, frame_count, time_info, status):
+        if status & PA_OUTPUT_UNDERFLOW:
+            self.output_underflows += 1
+
+        if self._interrupt_at is not None:
+            # 打断：清空全部待播放音频，本次回调起输出静音
+            self._interrupt_at = None
+            self.queue.clear()
+            self.jitter_buffer.reset()
+            self._pcm.clear()
+            self._last_arrival = 0.0
+            mark_turn("playback_silenced",
+                      time.monotonic() + stream_delay(time_info, 'output_buffer_dac_time'))
+            return b'\x00' * (frame_count * 2), PA_CONTINUE
+
+        while True:
+            item = self.queue.get_nowait()
+            if item is None:
+                break
+            self.jitter_buffer.push(*item)
+
+        # 超过目标缓冲时长未收到新包，视为音频流结束，不再等待缺失帧
+        idle_ms = (time.monotonic() - self._last_arrival) * 1000
+        flush = idle_ms > (self.jitter_buffer.target_depth + 2) * self.frame_duration
+
+        needed = frame_count * 2
+        while len(self._pcm) < needed:
+            frame = self.jitter_buffer.pop(flush)
+            if frame is None:
+                break
+            self._pcm += self._decode(frame)
+
+        if len(self._pcm) >= needed:
+            out = bytes(self._pcm[:needed])
+            del self._pcm[:needed]
+            mark_turn("first_pcm")
+            return out, PA_CONTINUE
+
+        if self.jitter_buffer.playing and not flush:
+            # 正在播放但下一帧尚未就绪
+            self.underruns += 1
+        elif flush and self._last_arrival:
+            logging.info(f"下行播放统计: {self.stats()}")
+            self.jitter_buffer.reset()
+            self._last_arrival = 0.0
+        out = bytes(self._pcm) + b'\x00' * (needed - len(self._pcm))
+        self._pcm.clear()
+        return out, PA_CONTINUE
+
+    def stats(self):
+        """返回播放阶段统计（含抖动缓冲状态）"""
+        stats = self.jitter_buffer.stats()
+        stats.update({
+            "queue_depth": len(self.queue),
+            "queue_high_water": self.queue.high_water,
+            "queue_dropped": self.queue.dropped,
+            "underruns": self.underruns,
+            "output_underflows": self.output_underflows,
+            "decode_errors": self.decode_errors,
+            "barge_in_dropped": self.barge_in_dropped,
+        })
+        return stats
+
+# ============================================================================
+# 音频后端
+# ============================================================================
+
+class PyAudioBackend:
+    """声卡音频后端（PyAudio）"""
+
+    # 采集数据由声卡时钟驱动
+    realtime = True
+
+    def __init__(self):
+        with ALSAErrorSuppressor():
+            self._pa = pyaudio.PyAudio()
+
+    def open(self, **kwargs):
+        return self._pa.open(**kwargs)
+
+    def terminate(self):
+        self._pa.terminate()
+
+def load_pcm_file(path, rate):
+    """
+    读取WAV或裸PCM文件，返回指定采样率的16位单声道PCM
+
+    裸PCM文件按16位小端单声道、采样率已为rate处理；WAV文件自动混合为单声道
+    并线性插值重采样。
+    """
+    if not path.lower().endswith('.wav'):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    with wave.open(path, 'rb') as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError(f"仅支持16位WAV文件: {path}")
+        channels = wav.getnchannels()
+        source_rate = wav.getframerate()
+        samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    if source_rate != rate:
+        positions = np.arange(0, len(samples), source_rate / rate)
+        samples = np.interp(positions, np.arange(len(samples)), samples)
+    return samples.astype(np.int16).tobytes()
+
+class PcmFileWriter:
+    """
+    PCM输出文件（.wav 写WAV，其他扩展名写裸PCM）
+
+    同时在 <文件名>.timestamps.csv 中记录每块数据的写入时间（相对后端启动的毫秒数）
+    和在文件中的字节偏移，便于离线计算首包延迟和播放间隙。
+    """
+
+    def __init__(self, path, rate, start):
+        self._start = start
+        self._offset = 0
+        if path.lower().endswith('.wav'):
+            self._file = wave.open(path, 'wb')
+            self._file.setnchannels(1)
+            self._file.setsampwidth(2)
+            self._file.setframerate(rate)
+            self._write = self._file.writeframes
+        else:
+            self._file = open(path, 'wb')
+            self._write = self._file.write
+        self._timestamps = open(os.path.splitext(path)[0] + '.timestamps.csv', 'w')
+        self._timestamps.write("time_ms,offset_bytes,length_bytes\n")
+
+    def write(self, pcm):
+        elapsed_ms = (time.monotonic() - self._start) * 1000
+        self._write(pcm)
+        self._timestamps.write(f"{elapsed_ms:.1f},{self._offset},{len(pcm)}\n")
+        self._offset += len(pcm)
+
+    def close(self):
+        self._file.close()
+        self._timestamps.close()
+
+class FileStream:
+    """
+    文件音频后端的回调模式流，行为与PyAudio回调流一致
+
+    后台线程按帧周期调用回调：输入流把文件中的PCM交给回调（文件读完后输入静音），
+    输出流从回调取PCM写入文件（只写入非全零的数据块，欠载补的静音不写入）。
+    """
+
+    def __init__(self, backend, rate, frames_per_buffer, stream_callback, source=None, sink=None):
+        self._backend = backend
+        self.rate = rate
+        self.frames_per_buffer = frames_per_buffer
+        self._callback = stream_callback
+        self._source = source
+        self._sink = sink
+        self._active = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        frame_count = self.frames_per_buffer
+        frame_bytes = frame_count * 2
+        period = frame_count / self.rate
+        offset = 0
+        deadline = time.monotonic()
+
+        while self._active:
+            now = time.monotonic()
+            time_info = {"input_buffer_adc_time": now, "current_time": now,
+                         "output_buffer_dac_time": now}
+            if self._source is not None:
+                data = self._source[offset:offset + frame_bytes]
+                offset += len(data)
+                # 非实时模式只对文件数据加速，读完后按实时节奏输入静音
+                paced = self._backend.realtime or len(data) < frame_bytes
+                if len(data) < frame_bytes:
+                    data += bytes(frame_bytes - len(data))
+                _, flag = self._callback(data, frame_count, time_info, 0)
+            else:
+                # 下行由网络节奏驱动，输出始终按实时节奏拉取
+                out, flag = self._callback(None, frame_count, time_info, 0)
+                if self._sink is not None and out.count(0) != len(out):
+                    self._sink.write(out)
+                paced = True
+            if flag != PA_CONTINUE:
+                break
+
+            if paced:
+                deadline += period
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # 落后时不追赶，避免连续突发
+                    deadline = time.monotonic()
+            else:
+                deadline = time.monotonic()
+        self._active = False
+
+    def is_active(self):
+        return self._active
+
+    def stop_stream(self):
+        self._active = False
+        if self._thread is not threading.current_thread():
+            self._thread.join(timeout=1)
+
+    def close(self):
+        self.stop_stream()
+
+class FileAudioBackend:
+    """
+    无声卡音频后端：麦克风输入来自WAV/PCM文件，下行PCM写入文件并记录时间戳
+
+    接口与PyAudio一致（open/terminate），send_audio()和AudioPlayer无需区分后端。
+    realtime为False时按最快速度读取输入文件，采集缓冲区写满时阻塞等待而不丢帧。
+    每次打开输入流都从文件开头回放，便于按轮次重放同一段录音。
+    """
+
+    def __init__(self, input_path=None, output_path=None, realtime=True, input_pcm=None):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.realtime = realtime
+        self._input_pcm = input_pcm
+        self._writer = None
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def open(self, format=None, channels=1, rate=16000, input=False, output=False,
+             frames_per_buffer=1024, stream_callback=None):
+        if format not in (None, PA_INT16) or channels != 1 or stream_callback is None:
+            raise ValueError("文件音频后端仅支持16位单声道回调模式流")
+
+        if input:
+            source = self._input_pcm
+            if source is None:
+                source = load_pcm_file(self.input_path, rate) if self.input_path else b''
+            return FileStream(self, rate, frames_per_buffer, stream_callback, source=source)
+
+        with self._lock:
+            if self._writer is None and self.output_path:
+                self._writer = PcmFileWriter(self.output_path, rate, self._start)
+        return FileStream(self, rate, frames_per_buffer, stream_callback, sink=self._writer)
+
+    def terminate(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+def create_audio_backend():
+    """按配置创建音频后端"""
+    if AUDIO_BACKEND == "file":
+        return FileAudioBackend(AUDIO_INPUT_FILE, AUDIO_OUTPUT_FILE,
+                                realtime=AUDIO_INPUT_PACE == "realtime")
+    return PyAudioBackend()
+
+
+# ============================================================================
+# Opus编码配置
+# ============================================================================
+
+def read_cpu_times():
+    """读取 /proc/stat 中的系统CPU时间，返回 (空闲, 总计)，不可用时返回None"""
+    try:
+        with open('/proc/stat', 'r') as f:
+            fields = [int(value) for value in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    # user nice system idle iowait irq softirq steal ...
+    return fields[3] + fields[4], sum(fields[:8])
+
+def encoder_profile():
+    """当前编码配置：ENCODER_PROFILES中的配置叠加命令行覆盖项"""
+    profile = dict(ENCODER_PROFILES[ENCODER_PROFILE])
+    for key, value in (("bitrate", OPUS_BITRATE), ("complexity", OPUS_COMPLEXITY),
+                       ("loss_perc", OPUS_LOSS_PERC)):
+        if value is not None:
+            profile[key] = value
+    return profile
+
+class OpusUplinkEncoder:
+    """
+    上行Opus编码器
+
+    按编码配置设置应用类型、码率、复杂度、带内FEC、预期丢包率和DTX
+    （opuslib的部分属性setter有误，统一直接调用ctl）。开启自适应时每 ADAPT_INTERVAL 帧调整一次：
+    预期丢包率跟随所属会话(AudioSession)测得的丢包率（同一Wi-Fi链路，以下行丢包近似上行），丢包时开启FEC；
+    编码CPU占帧时长比例超过 CPU_BUDGET 或系统CPU占用超过 SYSTEM_BUSY 时降低复杂度，
+    余量充足时逐步恢复到配置值。
+    """
+
+    ADAPT_INTERVAL = 50  # 帧
+    CPU_BUDGET = 0.10
+    SYSTEM_BUSY = 0.90
+    MAX_LOSS_PERC = 30
+    FEC_LOSS_THRESHOLD = 0.01
+
+    def __init__(self, profile, dtx=False, adaptive=True, sample_rate=16000):
+        self.profile = profile
+        self.adaptive = adaptive
+        self.sample_rate = sample_rate
+        application = (opuslib.APPLICATION_VOIP if profile["application"] == "voip"
+                       else opuslib.APPLICATION_AUDIO)
+        self._encoder = opuslib.Encoder(sample_rate, 1, application)
+        self.session = None
+        self.bitrate = None
+        self.set_bitrate(profile["bitrate"])
+        self.complexity = profile["complexity"]
+        self.fec = profile["fec"]
+        self.loss_perc = profile["loss_perc"]
+        self._ctl(opuslib.api.ctl.set_complexity, self.complexity)
+        self._ctl(opuslib.api.ctl.set_inband_fec, int(self.fec))
+        self._ctl(opuslib.api.ctl.set_packet_loss_perc, self.loss_perc)
+        if dtx or profile["dtx"]:
+            self._ctl(opuslib.api.ctl.set_dtx, 1)
+
+        # 编码耗时统计
+        self.frames = 0
+        self.cpu_seconds = 0.0
+        self._interval_frames = 0
+        self._interval_cpu = 0.0
+        self._interval_audio = 0.0
+        self._cpu_times = read_cpu_times()
+
+    def _ctl(self, request, value):
+        opuslib.api.encoder.encoder_ctl(self._encoder.encoder_state, request, value)
+
+    def set_bitrate(self, bitrate):
+        """设置码率（bps），None为自动"""
+        if bitrate != self.bitrate:
+            self.bitrate = bitrate
+            self._ctl(opuslib.api.ctl.set_bitrate, bitrate if bitrate is not None else -1000)  # OPUS_AUTO
+
+    def encode(self, pcm, frame_size):
+        start = time.thread_time()
+        packet = self._encoder.encode(pcm, frame_size)
+        elapsed = time.thread_time() - start
+        self.frames += 1
+        self.cpu_seconds += elapsed
+        self._interval_frames += 1
+        self._interval_cpu += elapsed
+        self._interval_audio += frame_size / self.sample_rate
+        if self.adaptive and self._interval_frames >= self.ADAPT_INTERVAL:
+            self._adapt()
+        return packet
+
+    def _adapt(self):
+        cpu_ratio = self._interval_cpu / self._interval_audio
+        self._interval_frames = 0
+        self._interval_cpu = 0.0
+        self._interval_audio = 0.0
+
+        system_busy = 0.0
+        cpu_times = read_cpu_times()
+        if cpu_times is not None and self._cpu_times is not None:
+            idle = cpu_times[0] - self._cpu_times[0]
+            total = cpu_times[1] - self._cpu_times[1]
+            system_busy = 1 - idle / total if total > 0 else 0.0
+        self._cpu_times = cpu_times
+
+        # 复杂度：按本线程编码耗时和系统CPU余量调整
+        complexity = self.complexity
+        if (cpu_ratio > self.CPU_BUDGET or system_busy > self.SYSTEM_BUSY) and complexity > 0:
+            complexity -= 1
+        elif (cpu_ratio < self.CPU_BUDGET / 4 and system_busy < self.SYSTEM_BUSY - 0.2 and
+              complexity < self.profile["complexity"]):
+            complexity += 1
+        if complexity != self.complexity:
+            logging.info(f"编码复杂度 {self.complexity} -> {complexity} "
+                         f"(编码CPU {cpu_ratio:.1%}, 系统CPU {system_busy:.0%})")
+            self.complexity = complexity
+            self._ctl(opuslib.api.ctl.set_complexity, complexity)
+
+        # 预期丢包率和FEC：跟随测得的丢包率，不低于配置值
+        session = self.session
+        loss = session.downlink_loss() if session is not None else None
+        if loss is None:
+            return
+        loss_perc = min(self.MAX_LOSS_PERC, max(self.profile["loss_perc"], int(-(-loss * 100 // 1))))
+        fec = self.profile["fec"] or loss >= self.FEC_LOSS_THRESHOLD
+        if loss_perc != self.loss_perc or fec != self.fec:
+            logging.info(f"编码预期丢包率 {self.loss_perc}% -> {loss_perc}%，FEC {'开' if fec else '关'} "
+                         f"(测得丢包率 {loss:.1%})")
+            self.loss_perc, self.fec = loss_perc, fec
+            self._ctl(opuslib.api.ctl.set_packet_loss_perc, loss_perc)
+            self._ctl(opuslib.api.ctl.set_inband_fec, int(fec))
+
+    def stats(self):
+        return {
+            "bitrate": self.bitrate,
+            "complexity": self.complexity,
+            "fec": self.fec,
+            "loss_perc": self.loss_perc,
+            "frames": self.frames,
+            "encode_us": round(self.cpu_seconds / self.frames * 1e6, 1) if self.frames else 0,
+        }
+
+def create_uplink_encoder():
+    """按当前编码配置创建上行编码器（客户端发送线程和压测虚拟设备共用）"""
+    return OpusUplinkEncoder(encoder_profile(), dtx=SILENCE_MODE == "dtx", adaptive=ENCODER_ADAPT)
+
+# ============================================================================
+# 链路质量自适应
+# ============================================================================
+
+class LinkQualityController:
+    """
+    按链路质量为每个会话选择上行帧时长和码率
+
+    RTT取自QoS1心跳的PUBACK往返和hello往返（RFC 6298平滑），丢包率和到达间隔抖动
+    取自上一个会话的下行收包统计。链路好时用短帧降低延迟，链路差时用长帧减少每包开销、
+    并降低码率；选择结果和依据通过hello的audio_params协商，同时写入日志和指标。
+    """
+
+    # 质量等级 -> 上行帧时长（毫秒）
+    FRAME_DURATIONS = {"good": 20, "fair": 40, "poor": 60, "unknown": 60}
+    # 判定阈值：(RTT毫秒, 丢包率, 抖动毫秒)
+    GOOD = (100, 0.01, 15)
+    POOR = (300, 0.05, 40)
+    POOR_BITRATE_SCALE = 0.75
+    MIN_BITRATE = 12000
+
+    def __init__(self, announce=True):
+        """announce: 选择变化时是否打印（压测的虚拟设备只写日志）"""
+        self.announce = announce
+        self.srtt = None
+        self.rttvar = None
+        self.rtt_samples = 0
+        self.loss = None
+        self.jitter_ms = None
+        self.decision = None
+
+    def observe_rtt(self, rtt_ms):
+        """记录一个RTT样本（毫秒）"""
+        self.rtt_samples += 1
+        if self.srtt is None:
+            self.srtt = rtt_ms
+            self.rttvar = rtt_ms / 2
+        else:
+            self.rttvar += (abs(self.srtt - rtt_ms) - self.rttvar) / 4
+            self.srtt += (rtt_ms - self.srtt) / 8
+
+    def observe_downlink(self, stats):
+        """记录一个会话的下行收包统计（丢包率、到达间隔抖动）"""
+        if stats["expected"]:
+            self.loss = stats["lost"] / stats["expected"]
+            self.jitter_ms = stats["jitter_ms"]
+
+    def tier(self):
+        if self.srtt is None and self.loss is None:
+            return "unknown"
+        measured = (self.srtt or 0, self.loss or 0, self.jitter_ms or 0)
+        if any(value >= limit for value, limit in zip(measured, self.POOR)):
+            return "poor"
+        if self.srtt is not None and all(value < limit for value, limit in zip(measured, self.GOOD)):
+            return "good"
+        return "fair"
+
+    def decide(self, bitrate, frame_duration=None):
+        """
+        为新会话选择上行参数
+
+        Args:
+            bitrate: 编码配置的码率（None为自动）
+            frame_duration: 固定帧时长（毫秒），None表示自动选择
+
+        Returns:
+            dict: frame_duration、bitrate、tier及选择依据
+        """
+        tier = self.tier()
+        if tier == "poor" and bitrate is not None:
+            bitrate = max(self.MIN_BITRATE, int(bitrate * self.POOR_BITRATE_SCALE))
+        decision = {
+            "frame_duration": frame_duration or self.FRAME_DURATIONS[tier],
+            "bitrate": bitrate,
+            "tier": tier if frame_duration is None else "fixed",
+            "rtt_ms": round(self.srtt, 1) if self.srtt is not None else None,
+            "rtt_samples": self.rtt_samples,
+            "loss": round(self.loss, 4) if self.loss is not None else None,
+            "jitter_ms": self.jitter_ms,
+        }
+        previous, self.decision = self.decision, decision
+        logging.info(f"上行参数选择: {decision}")
+        changed = previous is None or (previous["frame_duration"], previous["bitrate"]) != (
+            decision["frame_duration"], decision["bitrate"])
+        if changed and self.announce:
+            print(f"📶 链路{self.describe()}")
+        return decision
+
+    def describe(self):
+        """一行说明当前选择及其依据"""
+        d = self.decision
+        measured = []
+        if d["rtt_ms"] is not None:
+            measured.append(f"RTT {d['rtt_ms']:.0f}ms")
+        if d["loss"] is not None:
+            measured.append(f"丢包 {d['loss']:.1%}")
+            measured.append(f"抖动 {d['jitter_ms']:.0f}ms")
+        bitrate = f"{d['bitrate'] // 1000}kbps" if d["bitrate"] else "自动"
+        return (f"{d['tier']} ({', '.join(measured) or '尚无测量'}) → "
+                f"帧时长 {d['frame_duration']}ms, 码率 {bitrate}")
+
+link_controller = LinkQualityController()
+
+# ============================================================================
+# 会话音频状态
+# ============================================================================
+
+class AudioSession:
+    """
+    一个会话的音频传输状态，由服务端的hello回复创建
+
+    持有会话ID、UDP地址、密钥和nonce、下行音频参数、发送hello时协商的上行参数（帧时长、码率），
+    以及本会话的上行序列号、上行组包器(UplinkPacketBuilder)、下行解密器(AesCtrCipher)和
+    下行收包统计(ReceiveStats)。客户端发送线程和压测虚拟设备都经由它组包和收包，
+    一个进程内可以同时存在多个会话。上行编码器跨会话复用，由编码线程调用attach_encoder()切换。
+    """
+
+    DEFAULT_AUDIO_PARAMS = {"format": "opus", "sample_rate": 24000, "channels": 1, "frame_duration": 60}
+    DEFAULT_UPLINK = {"frame_duration": 60, "bitrate": None}
+
+    def __init__(self, hello, uplink=None):
+        """
+        Args:
+            hello: 服务端的hello回复（含session_id、udp和下行audio_params）
+            uplink: 发送hello时选择的上行参数（LinkQualityController.decide()的结果），None为默认值
+        """
+        self.session_id = hello.get('session_id')
+        self.udp = hello['udp']
+        self.audio_params = dict(self.DEFAULT_AUDIO_PARAMS, **hello.get('audio_params', {}))
+        self.uplink = uplink or self.DEFAULT_UPLINK
+        self.sequence = 0
+        self.encoder = None
+        self._builder = UplinkPacketBuilder(self.udp['key'], self.udp['nonce'])
+        self._cipher = AesCtrCipher(bytes.fromhex(self.udp['key']))
+        self.receive_stats = ReceiveStats(self.audio_params['frame_duration'],
+                                          bytes.fromhex(self.udp['nonce'])[4:8])
+
+    @property
+    def address(self):
+        return (self.udp['server'], self.udp['port'])
+
+    @property
+    def uplink_frame_size(self):
+        """协商的上行帧长（16kHz采样数）"""
+        return self.uplink["frame_duration"] * 16
+
+    def attach_encoder(self, encoder):
+        """在编码线程中调用：按本会话的码率配置编码器，自适应改用本会话的下行丢包率"""
+        encoder.set_bitrate(self.uplink["bitrate"])
+        encoder.session = self
+        self.encoder = encoder
+
+    def packet(self, encoded_data):
+        """为一帧已编码音频分配下一个上行序列号，返回加密后的数据包"""
+        self.sequence += 1
+        # 包构建器复用内部缓冲区，复制一份交给调用方发送
+        return bytes(self._builder.build(encoded_data, self.sequence))
+
+    def accept(self, data, arrival):
+        """解密之前过滤下行包：返回序列号，其他会话的包、重复包和过期包返回None"""
+        return self.receive_stats.accept(data, arrival)
+
+    def decrypt(self, data):
+        return self._cipher.apply(data[:16], data[16:])
+
+    def downlink_loss(self):
+        """最近一个统计区间的下行丢包率，尚未收到下行包时返回None"""
+        if not self.receive_stats.received:
+            return None
+        return self.receive_stats.loss_fraction
+
+# ============================================================================
+# 音频处理
+# ============================================================================
+
+
+def send_audio():
+    """
+    音频发送线程（常驻） - 从采集环形缓冲区取整帧，编码加密后发送到服务器
+
+    开启预录(PREROLL_MS > 0)时麦克风持续采集，未在监听期间把编码后的帧保存在
+    预录缓冲中；监听开始后先以线速补发预录帧（序列号连续），再发送实时帧，
+    避免会话建立前说出的第一个字被截掉。未开启预录时仅在会话期间打开麦克风。
+
+    开启唤醒词时麦克风同样持续采集，未在监听期间的每帧交给唤醒词检测器；预录缓冲改存
+    原始PCM，到监听开始才编码补发（含唤醒词本身），常驻运行时不做Opus编码。
+    """
+    global listen_state, audio, running
+    global capture_buffer, capture_processor, echo_canceller, uplink_encoder
+    global wake_word_detector
+
+    # 当前帧长，随会话协商的上行参数变化
+    frame_size = CAPTURE_FRAME_SIZE
+    frame_bytes = frame_size * 2
+    frame_timeout = frame_size / 16000 * 4
+
+    # 创建Opus编码器
+    encoder = uplink_encoder = create_uplink_encoder()
+
+    # 回声消除和采集预处理：VAD和编码器都使用处理后的音频；回声消除要求线性的回声路径，
+    # 必须在AGC/噪声门之前
+    canceller = echo_canceller = (
+        EchoCanceller(echo_reference, AEC_TAIL_MS, AEC_REFERENCE_LEAD_MS, AEC_CPU_BUDGET)
+        if echo_reference is not None else None)
+    processor = capture_processor = CaptureProcessor(cpu_budget=DSP_CPU_BUDGET) if CAPTURE_DSP else None
+
+    # 本地VAD：自动模式判断语音结束，realtime模式判断打断，静音帧抑制
+    vad = VoiceActivityDetector() if LISTEN_MODE != "manual" or SILENCE_MODE != "off" else None
+    pending_silence = None
+    vad_listening = False
+    barge_in_speech_ms = 0.0
+
+    # 唤醒词检测器（main中按配置创建）
+    wake = wake_word_detector
+
+    # 预录缓冲：最近preroll_ms毫秒的已编码帧（开启唤醒词时为原始PCM）
+    preroll_ms = max(PREROLL_MS, WAKE_WORD_PREROLL_MS if wake is not None else 0)
+    preroll = collections.deque(maxlen=max(1, preroll_ms * 16 // frame_size))
+
+    # 当前会话（AudioSession），会话变化时切换上行参数和编码器
+    session = None
+    applied_session = None
+
+    mic = None
+    ring = None
+    input_flags = {"overflow": 0, "underflow": 0}
+
+    def open_mic():
+        """以回调模式打开麦克风流，写入预分配的采集环形缓冲区"""
+        nonlocal mic, ring
+        global capture_buffer
+
+        ring = PcmRingBuffer(CAPTURE_FRAME_SIZE * 2 * CAPTURE_RING_FRAMES)
+        capture_buffer = ring
+        target = ring
+        # 非实时的文件输入以缓冲区满作为背压，不丢帧
+        block = not audio.realtime
+
+        def mic_callback(in_data, frame_count, time_info, status):
+            """输入回调：只把数据写入环形缓冲区"""
+            if status & PA_INPUT_OVERFLOW:
+                input_flags["overflow"] += 1
+                metrics.inc("capture_input_overflow_flags_total")
+            if status & PA_INPUT_UNDERFLOW:
+                input_flags["underflow"] += 1
+            target.write(in_data, block,
+                         time.monotonic() - stream_delay(time_info, 'input_buffer_adc_time'))
+            return None, PA_CONTINUE
+
+        with ALSAErrorSuppressor():
+            mic = audio.open(format=PA_INT16, channels=1, rate=16000,
+                            input=True, frames_per_buffer=MIC_BUFFER_SIZE,
+                            stream_callback=mic_callback)
+        return mic is not None
+
+    def close_mic():
+        """关闭麦克风流并记录采集异常统计"""
+        nonlocal mic, ring
+        global capture_buffer
+
+        if ring is not None:
+            # 先摘下全局引用，指标抓取不再把已关闭缓冲区的计数重复计入
+            if capture_buffer is ring:
+                capture_buffer = None
+            ring.close()
+        if mic is not None:
+            try:
+                mic.stop_stream()
+                mic.close()
+            except:
+                pass
+        if ring is not None:
+            stats = ring.stats()
+            metrics.inc("capture_overflows_total", ring.overflows)
+            metrics.inc("capture_underflows_total", ring.underflows)
+            stats.update({"input_overflow_flags": input_flags["overflow"],
+                          "input_underflow_flags": input_flags["underflow"]})
+            if stats["overflows"] or stats["underflows"] or input_flags["overflow"]:
+                logging.warning(f"麦克风采集异常统计: {stats}")
+        mic = None
+        ring = None
+
+    def send_frame(encoded_data):
+        """加密并发送一帧已编码的音频"""
+        packet = session.packet(encoded_data)
+        call_in_loop(send_datagram, packet)
+        metrics.inc("uplink_packets_total")
+        metrics.inc("uplink_bytes_total", len(packet))
+        mark_turn("first_uplink")
+
+    def transmit(frames):
+        """依次发送若干已编码帧（UDP错误由事件循环中的AudioReceiver处理）"""
+        for encoded_data in frames:
+            send_frame(encoded_data)
+
+    try:
+        while running:
+            session = audio_session
+            active = session is not None
+            if not active and not preroll_ms:
+                # 无会话且未开启预录和唤醒词：释放麦克风，等待会话建立
+                if mic is not None:
+                    close_mic()
+                session_ready.wait()
+                continue
+
+            if mic is None and not open_mic():
+                logging.error("无法打开麦克风设备")
+                print("❌ 麦克风设备打开失败")
+                return
+
+            if session is not applied_session:
+                applied_session = session
+                if session is None:
+                    # 会话已结束：编码自适应不再参考旧会话的丢包率
+                    encoder.session = None
+                else:
+                    # 新会话协商了上行帧时长和码率（预录缓冲中的旧帧保留，Opus帧自带时长）
+                    frame_size = session.uplink_frame_size
+                    frame_bytes = frame_size * 2
+                    frame_timeout = frame_size / 16000 * 4
+                    preroll = collections.deque(preroll, maxlen=max(1, preroll_ms * 16 // frame_size))
+                    session.attach_encoder(encoder)
+
+            # 读取一整帧音频，超时计入欠载
+            data = ring.read(frame_bytes, timeout=frame_timeout)
+            if data is None:
+                continue
+            if canceller is not None:
+                data = canceller.process(data, ring.read_time)
+            if processor is not None:
+                data = processor.process(data)
+
+            if not active or listen_state != "start":
+                vad_listening = False
+                pending_silence = None
+                if wake is not None:
+                    preroll.append(data)
+                    detection = wake.process(data)
+                    if detection is not None:
+                        captured = ring.read_time if ring.read_time is not None else time.monotonic()
+                        end_time = captured + (frame_size / 16000) - detection["delay_ms"] / 1000
+                        call_in_loop(on_wake_word, detection, end_time)
+                elif preroll_ms:
+                    preroll.append(encoder.encode(data, frame_size))
+                continue
+            mark_turn("first_capture")
+
+            frames = []
+            if preroll:
+                # 监听刚开始：先补发预录帧
+                if wake is not None:
+                    frames.extend(encoder.encode(pcm, len(pcm) // 2) for pcm in preroll)
+                    wake.reset()
+                else:
+                    frames.extend(preroll)
+                preroll.clear()
+
+            if vad is not None:
+                if not vad_listening:
+                    vad.reset()
+                    vad_listening = True
+                is_speech = vad.process(data)
+
+                if LISTEN_MODE == "realtime":
+                    # 全双工：播放期间（回声消除后）持续检测到说话，本地立即打断播放
+                    if tts_state in ('start', 'sentence_start') and vad.trailing_silence_ms == 0:
+                        barge_in_speech_ms += frame_size / 16
+                        if barge_in_speech_ms >= BARGE_IN_SPEECH_MS:
+                            barge_in_speech_ms = 0.0
+                            call_in_loop(interrupt_speaking)
+                    else:
+                        barge_in_speech_ms = 0.0
+
+                if LISTEN_MODE == "auto" and key_state == "press" and (
+                        (vad.speech_detected and vad.trailing_silence_ms >= VAD_SILENCE_MS) or
+                        (not vad.speech_detected and vad.listening_ms >= VAD_NO_SPEECH_TIMEOUT_MS) or
+                        vad.listening_ms >= VAD_MAX_LISTEN_MS):
+                    # 尾部静音足够长（或始终没有说话、监听超过最长时长），自动结束监听
+                    transmit(frames)
+                    call_in_loop(schedule_key_action, on_vad_end)
+                    continue
+
+                if SILENCE_MODE == "skip":
+                    if not is_speech:
+                        # 保留最近一帧静音，语音起始时补发，避免切掉起音
+                        transmit(frames)
+                        pending_silence = data
+                        continue
+                    if pending_silence is not None:
+                        frames.append(encoder.encode(pending_silence, len(pending_silence) // 2))
+                        pending_silence = None
+
+            encoded_data = encoder.encode(data, frame_size)
+            if not (SILENCE_MODE == "dtx" and len(encoded_data) <= 2):
+                # DTX静音帧（仅TOC字节）无需发送
+                frames.append(encoded_data)
+
+            # 加密并发送到服务器
+            transmit(frames)
+    except Exception as e:
+        # 如果程序正在退出，只记录日志，不打印错误
+        if running:
+            logging.error(f"音频发送错误: {str(e)}")
+            print(f"❌ 录音设备错误: {str(e)}")
+        else:
+            logging.info(f"程序退出时音频发送停止: {str(e)}")
+    finally:
+        close_mic()
+
+def retire_player(player):
+    """停止播放阶段并把其统计并入运行指标（阻塞，在线程池中执行）"""
+    global audio_player
+    player.stop()
+    if audio_player is player:
+        audio_player = None
+    stats = player.stats()
+    metrics.inc("playback_underruns_total", stats["underruns"])
+    metrics.inc("playback_queue_dropped_total", stats["queue_dropped"])
+    metrics.inc("jitter_late_total", stats["late"])
+    metrics.inc("jitter_lost_total", stats["lost"])
+    metrics.inc("decode_errors_total", stats["decode_errors"])
+    metrics.inc("barge_in_dropped_total", stats["barge_in_dropped"])
+    logging.info(f"下行播放统计: {stats}")
+
+def retire_receive_stats(receive_stats):
+    """会话的UDP传输关闭：把收包统计并入运行指标"""
+    stats = receive_stats.stats()
+    metrics.inc("downlink_lost_total", stats["lost"])
+    metrics.inc("downlink_reordered_total", stats["reordered"])
+    metrics.inc("downlink_duplicates_total", stats["duplicates"])
+    metrics.inc("downlink_stale_session_total", stats["stale_session"])
+    metrics.inc("downlink_malformed_total", stats["malformed"])
+    link_controller.observe_downlink(stats)
+    logging.info(f"下行收包统计: {stats}")
+
+class AudioReceiver(asyncio.DatagramProtocol):
+    """
+    下行音频接收（事件循环中执行）：只负责收包和解密，解码播放交给回调模式的播放阶段
+
+    每包解密只需几微秒，直接在回调中完成比切换到线程池开销更小。
+    """
+
+    def __init__(self, player, session):
+        self.player = player
+        self.session = session
+        self.receive_stats = session.receive_stats
+        self.retired = None
+        self.reconnecting = False
+
+    def datagram_received(self, data, addr):
+        if len(data) <= 16 or self.player is None:
+            return
+        metrics.inc("downlink_packets_total")
+        metrics.inc("downlink_bytes_total", len(data))
+        # 解密之前丢弃其他会话的包、重复包和被打断语音的包
+        arrival = time.monotonic()
+        sequence = self.session.accept(data, arrival)
+        if sequence is None or self.player.drop_stale(sequence):
+            return
+        mark_turn("first_downlink")
+
+        # 解密后交给播放阶段
+        try:
+            payload = self.session.decrypt(data)
+        except Exception as e:
+            metrics.inc("decrypt_errors_total")
+            logging.error(f"音频解密错误: {str(e)}")
+            return
+        self.player.feed(sequence, payload, arrival)
+
+    def error_received(self, exc):
+        logging.error(f"UDP错误: {str(exc)}")
+        if getattr(exc, 'errno', None) == errno.ENETUNREACH and audio_session is self.session:
+            # 网络切换后重建UDP连接（同一会话，收包统计延续到新连接）
+            self.reconnecting = True
+            event_loop.create_task(open_audio_transport())
+
+    def connection_lost(self, exc):
+        if not self.reconnecting:
+            retire_receive_stats(self.receive_stats)
+        if self.player is not None:
+            self.retired = event_loop.run_in_executor(None, retire_player, self.player)
+            self.player = None
+
+def send_datagram(packet):
+    """发送一个UDP包（事件循环中执行）"""
+    transport = udp_transport
+    if transport is not None and not transport.is_closing():
+        transport.sendto(packet)
+
+async def open_audio_transport():
+    """
+    建立会话的音频传输：打开播放阶段，并以DatagramProtocol接收下行音频
+
+    发送线程常驻，只重建UDP传输和播放阶段；打开播放设备可能阻塞，放到线程池中执行。
+    """
+    global udp_transport, audio_player
+
+    # 启动时音频初始化与MQTT连接并行，预热模式下会话可能先于音频就绪
+    await audio_ready.wait()
+    close_audio_transport()
+    session = audio_session
+    if session is None:
+        # 等待期间会话已结束
+        return
+    player = AudioPlayer(session.audio_params['sample_rate'],
+                         session.audio_params['frame_duration'], echo_reference)
+    try:
+        if not await event_loop.run_in_executor(None, player.start):
+            logging.error("无法打开音频播放设备")
+            player = None
+    except Exception as e:
+        logging.error(f"播放流初始化失败: {str(e)}")
+        print(f"❌ 播放设备错误: {str(e)}")
+        player = None
+
+    try:
+        transport, _ = await event_loop.create_datagram_endpoint(
+            lambda: AudioReceiver(player, session),
+            remote_addr=session.address)
+        transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                                      UDP_RECV_BUFFER_SIZE)
+    except Exception as e:
+        logging.error(f"UDP连接失败: {str(e)}")
+        if player is not None:
+            event_loop.run_in_executor(None, retire_player, player)
+        return
+
+    udp_transport = transport
+    audio_player = player
+
+def close_audio_transport():
+    """关闭当前会话的UDP传输，播放阶段随之退役"""
+    global udp_transport
+    if udp_transport is not None:
+        udp_transport.close()
+        udp_transport = None
+
+# ============================================================================
+# MQTT消息处理
+# ============================================================================
+
+def on_mqtt_message(client, userdata, msg):
+    """
+    MQTT消息回调：只解析JSON并放入分发队列，处理由dispatch_mqtt_messages完成
+
+    回调在MQTT网络读取路径上执行，保持轻量，保活和后续报文的读取不会被消息处理拖慢。
+    """
+    global last_mqtt_message_time
+
+    last_mqtt_message_time = time.time()
+    metrics.inc("mqtt_messages_total")
+    try:
+        message = json.loads(msg.payload)
+    except Exception as e:
+        logging.error(f"MQTT消息解析错误: {str(e)}")
+        return
+    logging.info(f"接收到 MQTT 消息: {message}")
+    call_in_loop(message_queue.put_nowait, (time.monotonic(), message))
+
+def handle_hello_message(message):
+    """处理HELLO消息，建立会话连接"""
+    global audio_session, session_state
+
+    with session_lock:
+        if session_state != "connecting":
+            logging.warning(f"忽略非预期的 HELLO 消息 (会话状态: {session_state})")
+            return
+        # 下行音频参数以服务端回复为准（帧时长可能随上行协商变化）
+        audio_session = AudioSession(message, uplink_params)
+
+    mark_turn("hello_received")
+    if hello_sent_at is not None:
+        # 服务端回显：hello往返作为RTT样本
+        link_controller.observe_rtt((time.monotonic() - hello_sent_at) * 1000)
+    logging.info(f"处理 HELLO 消息完成，session_id: {audio_session.session_id}")
+    event_loop.create_task(start_session_audio())
+
+async def start_session_audio():
+    """建立会话的音频传输后进入ready状态"""
+    global session_state
+
+    await open_audio_transport()
+    with session_lock:
+        if session_state != "connecting":
+            # 等待期间会话已结束
+            return
+        session_state = "ready"
+        session_ready.set()
+    metrics.inc("sessions_total")
+
+def handle_tts_message(message):
+    """处理TTS（文本转语音）消息"""
+    global tts_state, last_printed_text
+
+    tts_state = message['state']
+    if tts_state == 'start':
+        # 播放期间不计入会话空闲时间
+        cancel_idle_timer()
+        if audio_player is not None:
+            audio_player.resume(new_segment=True)
+        session = audio_session
+        if session is not None:
+            session.receive_stats.restart_stream()
+        mark_turn("tts_start")
+        print("🔊 播放中...")
+    elif tts_state == 'sentence_start':
+        # 显示AI回复文本
+        sentence_text = message.get('text', '')
+        if sentence_text:
+            mark_turn("first_llm")
+        if sentence_text and sentence_text != last_printed_text:
+            print(f"🤖 地瓜派: {sentence_text}")
+            last_printed_text = sentence_text
+    elif tts_state == 'stop':
+        print("✅ 播放完成")
+        last_printed_text = ""
+        if key_state != "press":
+            arm_idle_timer()
+            finish_turn()
+        elif LISTEN_MODE == "realtime":
+            # 全双工模式下每段回复结束即为一轮
+            finish_turn()
+
+def handle_stt_message(message):
+    """处理STT（语音转文本）消息"""
+    if LISTEN_MODE == "realtime" and key_state == "press" and (not current_turn or "stt" in current_turn):
+        # 全双工模式：服务端每识别出一句开始新的一轮（没有按键和listen stop）
+        begin_turn(stage="stt")
+    mark_turn("stt")
+    stt_text = message.get('text', '')
+    if stt_text:
+        print(f"👤 用户: {stt_text}")
+
+def handle_llm_message(message):
+    """处理LLM回复消息"""
+    global last_printed_text
 
     llm_text = message.get('text', '')
+    if llm_text:
+        mark_turn("first_llm")
     if llm_text and llm_text != last_printed_text:
         print(f"🤖 地瓜派: {llm_text}")
         last_printed_text = llm_text
 
 def handle_goodbye_message(message):
     """处理GOODBYE消息，结束会话"""
-    global aes_opus_info, udp_socket
+    global audio_session, session_state
+
+    with session_lock:
+        if audio_session is None or message.get('session_id') != audio_session.session_id:
+            return
+        audio_session = None
+        session_state = "idle"
+        session_ready.clear()
+    cancel_idle_timer()
+
+    close_audio_transport()
+    if key_state != "press":
+        finish_turn()
+    print("👋 会话结束")
+    logging.info("会话已结束")
+
+    if PREWARM and running:
+        event_loop.call_later(PREWARM_RETRY_INTERVAL, open_session)
+
+# 消息类型 -> 处理函数（在事件循环中执行，不得阻塞；耗时操作另建任务或放到线程池）
+MESSAGE_HANDLERS = {
+    'hello': handle_hello_message,
+    'tts': handle_tts_message,
+    'stt': handle_stt_message,
+    'llm': handle_llm_message,
+    'goodbye': handle_goodbye_message,
+}
 
-    if message.get('session_id') == aes_opus_info['session_id']:
-        aes_opus_info['session_id'] = None
-        if udp_socket:
-            udp_socket.close()
-        print("👋 会话结束")
-        logging.info("会话已结束")
+async def dispatch_mqtt_messages():
+    """按到达顺序分发MQTT消息，并按类型记录从收到到处理完成的耗时"""
+    while True:
+        received_at, message = await message_queue.get()
+        message_type = message.get('type')
+        handler = MESSAGE_HANDLERS.get(message_type)
+        if handler is None:
+            continue
+        try:
+            handler(message)
+        except Exception as e:
+            print(f"❌ 消息处理错误: {str(e)}")
+            logging.error(f"消息处理错误: {str(e)}")
+        message_latency_store.observe(message_type, (time.monotonic() - received_at) * 1000)
 
 # ============================================================================
 # MQTT连接管理
 # ============================================================================
 
+class MqttLoopBridge:
+    """
+    把paho MQTT客户端的网络读写挂到asyncio事件循环上，替代loop_start()的网络线程
+
+    socket可读/可写时由事件循环调用loop_read/loop_write，每秒调用一次loop_misc
+    处理保活；paho的回调因此都在事件循环线程中执行。连接和重连会阻塞，放在线程池中执行，
+    socket注册通过call_in_loop转回事件循环线程。
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._fd = None
+        self._misc_task = event_loop.create_task(self._misc_loop())
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def _on_socket_open(self, client, userdata, sock):
+        call_in_loop(self._add_reader, sock, sock.fileno())
+
+    def _add_reader(self, sock, fd):
+        self._fd = fd
+        event_loop.add_reader(fd, self._on_readable, sock)
+
+    def _on_readable(self, sock):
+        self.client.loop_read()
+        # TLS层可能已缓存后续报文，事件循环不会再通知可读
+        while (isinstance(sock, ssl.SSLSocket) and self.client.socket() is sock
+               and sock.pending()):
+            self.client.loop_read()
+
+    def _on_socket_close(self, client, userdata, sock):
+        # socket随后即被关闭，按注册时的fd注销
+        call_in_loop(self._remove, sock.fileno())
+
+    def _remove(self, fd):
+        if fd == -1 or fd != self._fd:
+            fd = self._fd
+        if fd is not None:
+            event_loop.remove_reader(fd)
+            event_loop.remove_writer(fd)
+            self._fd = None
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        call_in_loop(event_loop.add_writer, sock.fileno(), client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        call_in_loop(event_loop.remove_writer, sock.fileno())
+
+    async def _misc_loop(self):
+        while True:
+            self.client.loop_misc()
+            await asyncio.sleep(1)
+
+    def close(self):
+        self._misc_task.cancel()
+        self._remove(self._fd)
+
 def on_mqtt_connect(client, userdata, flags, rc):
     """MQTT连接成功回调"""
+    global mqtt_connect_started
+
     if rc == 0:
         print("✅ MQTT连接成功")
+        if mqtt_connect_started is not None:
+            startup_profiler.record("MQTT连接→CONNACK", mqtt_connect_started, time.monotonic())
+            mqtt_connect_started = None
+        check_startup_ready()
         result = client.subscribe(mqtt_info['subscribe_topic'], qos=0)
         logging.info(f"MQTT连接成功，订阅结果: {result}")
+        # 连接后立即发一次心跳，为首个会话的上行参数选择提供RTT样本
+        publish_heartbeat()
+        if PREWARM:
+            # 预热模式：用户按键前就在后台建立会话
+            open_session()
     else:
         print(f"❌ MQTT连接失败，错误码: {rc}")
         logging.error(f"MQTT连接失败，错误码: {rc}")
+        if rc in (4, 5):
+            # 用户名密码错误或未授权：缓存的凭据可能已失效
+            schedule_ota_refresh()
+
+def check_startup_ready():
+    """MQTT已连接且音频已初始化时即为就绪：记录启动→就绪耗时（只记录一次）"""
+    global startup_ready_ms
+
+    if (startup_ready_ms is not None or not audio_ready.is_set()
+            or not (mqtt_client and mqtt_client.is_connected())):
+        return
+    ready = time.monotonic()
+    startup_ready_ms = (ready - startup_profiler.origin) * 1000
+    print(f"⏱️  启动→就绪: {startup_ready_ms:.0f}ms")
+    logging.info(f"启动→就绪耗时: {startup_ready_ms:.0f}ms")
+    if PROFILE_STARTUP:
+        startup_profiler.report(ready)
 
 def on_mqtt_disconnect(client, userdata, rc):
     """MQTT断开连接回调"""
-    global running
-
     # 如果程序正在退出，不尝试重连
     if not running:
         logging.info("程序退出，跳过MQTT重连")
@@ -731,110 +4227,283 @@ def on_mqtt_disconnect(client, userdata, rc):
 
     print("⚠️  MQTT断开，重连中...")
     logging.warning("MQTT连接断开，正在尝试重连...")
-    time.sleep(RECONNECT_INTERVAL)
-    try:
-        if running:  # 再次检查running状态
-            client.reconnect()
-    except:
-        pass
+    event_loop.call_later(RECONNECT_INTERVAL, reconnect_mqtt)
+
+def reconnect_mqtt():
+    """在线程池中重连MQTT，失败后间隔RECONNECT_INTERVAL再试"""
+    if not running:
+        return
+    metrics.inc("mqtt_reconnects_total")
 
-def setup_mqtt():
+    def on_done(future):
+        if future.exception() is not None and running:
+            logging.warning(f"MQTT重连失败: {str(future.exception())}")
+            event_loop.call_later(RECONNECT_INTERVAL, reconnect_mqtt)
+
+    event_loop.run_in_executor(None, mqtt_client.reconnect).add_done_callback(on_done)
+
+def create_mqtt_client(info):
+    """按OTA下发的配置创建MQTT客户端（TLS，不校验服务器证书）"""
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=info['client_id'])
+    client.username_pw_set(info['username'], info['password'])
+    client.tls_set_context(context=get_mqtt_tls_context())
+    return client
+
+def get_mqtt_tls_context():
+    """
+    MQTT使用的TLS上下文，所有连接共用
+
+    不校验服务器证书，因此不用create_default_context()加载系统CA证书，创建更快。
+    """
+    global mqtt_tls_context
+    if mqtt_tls_context is None:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        mqtt_tls_context = context
+    return mqtt_tls_context
+
+def mqtt_endpoint(info):
+    """解析MQTT服务地址，endpoint可带端口（如本地测试服务 "127.0.0.1:8883"），默认8883"""
+    host, _, port = info['endpoint'].partition(':')
+    return host, int(port or 8883)
+
+async def setup_mqtt():
     """设置MQTT连接"""
-    global mqtt_client
+    global mqtt_client, mqtt_bridge, mqtt_connect_started
 
-    # 清理旧连接
+    # 清理旧连接（解除回调，避免旧连接断开时触发重连）
     if mqtt_client:
+        mqtt_client.on_connect = None
+        mqtt_client.on_disconnect = None
         try:
-            mqtt_client.loop_stop()
             mqtt_client.disconnect()
+            mqtt_client.loop_write()
         except:
             pass
+    if mqtt_bridge:
+        mqtt_bridge.close()
 
-    # 创建新客户端
-    mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1,
-                             client_id=mqtt_info['client_id'])
-    mqtt_client.username_pw_set(mqtt_info['username'], mqtt_info['password'])
-
-    # SSL/TLS配置
-    ssl_context = ssl.create_default_context()
-    ssl_context.check_hostname = False
-    ssl_context.verify_mode = ssl.CERT_NONE
-
-    mqtt_client.tls_set_context(context=ssl_context)
+    # 创建新客户端，网络读写由事件循环驱动
+    mqtt_client = create_mqtt_client(mqtt_info)
     mqtt_client.on_connect = on_mqtt_connect
     mqtt_client.on_disconnect = on_mqtt_disconnect
     mqtt_client.on_message = on_mqtt_message
+    mqtt_client.on_publish = on_mqtt_publish
+    heartbeat_pending.clear()
+    mqtt_bridge = MqttLoopBridge(mqtt_client)
+
+    if startup_ready_ms is None:
+        mqtt_connect_started = time.monotonic()
 
     try:
-        mqtt_client.connect(mqtt_info['endpoint'], 8883, 60)
-        mqtt_client.loop_start()
+        await event_loop.run_in_executor(None, mqtt_client.connect, *mqtt_endpoint(mqtt_info), 60)
         logging.info("MQTT连接已初始化")
     except Exception as e:
         print(f"❌ MQTT初始化失败: {str(e)}")
         logging.error(f"MQTT连接初始化失败: {str(e)}")
+        event_loop.call_later(RECONNECT_INTERVAL, reconnect_mqtt)
 
 # ============================================================================
 # 心跳和会话管理
 # ============================================================================
 
+def publish_heartbeat():
+    """以QoS1发送心跳，PUBACK往返时间作为链路RTT样本"""
+    global last_heartbeat
+
+    try:
+        info = mqtt_client.publish(mqtt_info['publish_topic'],
+                                   json.dumps({"type": "heartbeat"}), qos=1)
+        if len(heartbeat_pending) > 16:
+            # 长期未确认的心跳不再等待
+            heartbeat_pending.clear()
+        heartbeat_pending[info.mid] = time.monotonic()
+        last_heartbeat = time.time()
+        metrics.inc("heartbeats_total")
+        logging.info("心跳已发送")
+    except Exception as e:
+        logging.error(f"心跳发送失败: {str(e)}")
+
+def on_mqtt_publish(client, userdata, mid):
+    """QoS1消息收到PUBACK（事件循环中执行）"""
+    sent_at = heartbeat_pending.pop(mid, None)
+    if sent_at is not None:
+        link_controller.observe_rtt((time.monotonic() - sent_at) * 1000)
+
 def send_heartbeat():
-    """心跳和会话超时检查线程"""
-    global last_heartbeat, running, last_listen_stop_time
+    """发送心跳，并安排下一次（事件循环定时器）"""
+    global heartbeat_timer
 
-    while running:
-        # 发送心跳
-        if (time.time() - last_heartbeat > HEARTBEAT_INTERVAL and
-            mqtt_client and mqtt_client.is_connected()):
-            try:
-                mqtt_client.publish(mqtt_info['publish_topic'],
-                                  json.dumps({"type": "heartbeat"}))
-                last_heartbeat = time.time()
-                logging.info("心跳已发送")
-            except Exception as e:
-                logging.error(f"心跳发送失败: {str(e)}")
+    if mqtt_client and mqtt_client.is_connected():
+        publish_heartbeat()
+
+    heartbeat_timer = event_loop.call_later(HEARTBEAT_INTERVAL, send_heartbeat)
 
-        # 检查会话超时
-        if (last_listen_stop_time is not None and
-            time.time() - last_listen_stop_time > 5):
-            logging.info("会话超时，关闭会话")
-            handle_goodbye_message(goodbye_msg)
-            last_listen_stop_time = None
+def arm_idle_timer():
+    """开始计算会话空闲时间，超时后关闭会话（预热模式保持会话常开）"""
+    global idle_timer
+    cancel_idle_timer()
+    if not PREWARM:
+        idle_timer = event_loop.call_later(SESSION_IDLE_TIMEOUT, on_session_idle)
 
-        time.sleep(1)
+def cancel_idle_timer():
+    global idle_timer
+    if idle_timer is not None:
+        idle_timer.cancel()
+        idle_timer = None
+
+def on_session_idle():
+    global idle_timer
+    idle_timer = None
+    logging.info("会话超时，关闭会话")
+    close_session()
 
 # ============================================================================
 # 用户交互处理
 # ============================================================================
 
-def on_space_key_press():
-    """空格键按下处理 - 开始录音"""
-    global key_state, listen_state, aes_opus_info
+async def on_space_key_press(press_time=None, stage="key_press"):
+    """空格键按下处理 - 开始录音（唤醒词检测也走这条路径）"""
+    global key_state, key_press_pending
 
+    key_press_pending = False
+    if key_state == "press":
+        # 多个输入源几乎同时按下，只处理第一次
+        return
     key_state = "press"
+    cancel_idle_timer()
+    begin_turn(press_time, stage)
+    mark_turn("key_handled")
+    interrupt_speaking()
     logging.info("开始监听")
 
-    if not aes_opus_info['session_id']:
+    if not session_ready.is_set():
         print("🔗 连接会话...")
-        send_hello_message()
-        time.sleep(0.5)
+        open_session()
+        # 等待hello回复事件，而不是固定睡眠
+        if not await event_loop.run_in_executor(None, session_ready.wait, HELLO_TIMEOUT):
+            print("❌ 会话建立超时，请重试")
+            logging.error("等待 HELLO 回复超时")
+            abandon_session()
+            key_state = "release"
+            return
+        if not running:
+            return
 
-    print("🎤 倾听中...")
+    if LISTEN_MODE == "realtime":
+        print("🎤 连续对话中，再按一次结束...")
+    else:
+        print("🎤 倾听中...")
     send_listen_message("start")
 
-def on_space_key_release():
+async def on_space_key_release():
     """空格键松开处理 - 结束录音"""
-    global key_state, last_listen_stop_time
+    global key_state
 
+    if key_state != "press":
+        return
     key_state = "release"
-    print("⏹️  等待回复...")
+    print("⏹️  结束连续对话" if LISTEN_MODE == "realtime" else "⏹️  等待回复...")
     logging.info("结束监听")
 
     send_listen_message("stop")
-    last_listen_stop_time = time.time()
+    mark_turn("listen_stop")
+    if audio_player is not None:
+        audio_player.resume()
+    arm_idle_timer()
 
-def send_hello_message():
-    """发送HELLO消息建立会话"""
-    hello_msg = {
+def on_wake_word(detection, end_time):
+    """
+    检测到唤醒词（事件循环中调用）：等同于按下空格键
+
+    Args:
+        detection: 检测器返回的结果
+        end_time: 唤醒词结束的采集时刻（time.monotonic()时钟）
+    """
+    metrics.inc("wake_word_detections_total")
+    logging.info(f"检测到唤醒词: {detection}")
+    if key_state == "press":
+        # 已在监听或全双工对话中
+        return
+    print(f"👂 唤醒词「{detection['name']}」(得分 {detection['score']:.2f})")
+    schedule_key_action(on_wake_word_press, detection, end_time, time.monotonic())
+
+async def on_wake_word_press(detection, end_time, detected_at):
+    """唤醒后开始监听，并告知服务器本轮由唤醒词触发"""
+    await on_space_key_press(end_time, stage="wake_word")
+    mark_turn("wake_detected", detected_at)
+    if key_state == "press":
+        send_wake_word_message(detection["name"])
+
+def interrupt_speaking(reason=None):
+    """
+    打断正在播放的TTS：立即静音本地播放，并发送ABORT让服务端停止下发
+
+    Returns:
+        bool: 是否有正在播放的TTS被打断
+    """
+    global tts_state
+
+    if tts_state not in ('start', 'sentence_start'):
+        return False
+    tts_state = "abort"
+    mark_turn("barge_in")
+    metrics.inc("barge_ins_total")
+    player = audio_player
+    if player is not None:
+        player.interrupt()
+    send_abort_message(reason)
+    print("✋ 打断播放")
+    logging.info("打断TTS播放")
+    return True
+
+def open_session():
+    """
+    建立会话：idle状态下发送hello并进入connecting状态
+
+    已在建立中或已就绪时直接返回，可被按键、预热等多处安全调用。
+    """
+    global session_state
+
+    with session_lock:
+        if session_state != "idle":
+            return
+        session_state = "connecting"
+        session_ready.clear()
+    send_hello_message()
+
+def abandon_session():
+    """放弃尚未就绪的会话（hello超时），回到idle状态"""
+    global session_state
+
+    with session_lock:
+        if session_state == "connecting":
+            session_state = "idle"
+
+def close_session():
+    """主动结束当前会话：通知服务器并释放本地资源"""
+    session = audio_session
+    if session is None:
+        return
+    goodbye_msg = build_goodbye_message(session.session_id)
+    try:
+        mqtt_client.publish(mqtt_info['publish_topic'], json.dumps(goodbye_msg))
+    except Exception as e:
+        logging.error(f"GOODBYE 消息发送失败: {str(e)}")
+    handle_goodbye_message(goodbye_msg)
+
+async def on_vad_end():
+    """本地VAD检测到语音结束（自动模式） - 等同于松开空格键"""
+    if key_state != "press":
+        return
+    print("🔇 检测到语音结束")
+    logging.info("VAD检测到语音结束，自动停止监听")
+    await on_space_key_release()
+
+def build_hello_message(frame_duration=60):
+    """构建HELLO消息（上行音频参数）"""
+    return {
         "type": "hello",
         "version": 3,
         "transport": "udp",
@@ -842,83 +4511,1275 @@ def send_hello_message():
             "format": "opus",
             "sample_rate": 16000,
             "channels": 1,
-            "frame_duration": 60
+            "frame_duration": frame_duration
         }
     }
+
+def build_listen_message(session_id, state, mode, text=None):
+    """构建LISTEN消息（state为detect时text为唤醒词）"""
+    msg = {
+        "session_id": session_id,
+        "type": "listen",
+        "state": state,
+        "mode": mode
+    }
+    if text is not None:
+        msg["text"] = text
+    return msg
+
+def build_goodbye_message(session_id):
+    """构建GOODBYE消息"""
+    return {"session_id": session_id, "type": "goodbye"}
+
+def build_abort_message(session_id, reason=None):
+    """构建ABORT消息（打断TTS播放）"""
+    msg = {"session_id": session_id, "type": "abort"}
+    if reason:
+        msg["reason"] = reason
+    return msg
+
+def send_hello_message():
+    """发送HELLO消息建立会话（按链路质量选择本会话的上行帧时长和码率）"""
+    global uplink_params, hello_sent_at
+
+    uplink_params = link_controller.decide(encoder_profile()["bitrate"], UPLINK_FRAME_DURATION)
     try:
-        mqtt_client.publish(mqtt_info['publish_topic'], json.dumps(hello_msg))
+        mark_turn("hello_sent")
+        hello_sent_at = time.monotonic()
+        mqtt_client.publish(mqtt_info['publish_topic'],
+                            json.dumps(build_hello_message(uplink_params["frame_duration"])))
         logging.info("HELLO 消息已发送")
     except Exception as e:
         logging.error(f"HELLO 消息发送失败: {str(e)}")
 
 def send_listen_message(state):
     """发送LISTEN消息控制录音状态"""
-    if aes_opus_info['session_id']:
-        msg = {
-            "session_id": aes_opus_info['session_id'],
-            "type": "listen",
-            "state": state,
-            "mode": "manual"
-        }
+    global listen_state
+
+    session = audio_session
+    if session is not None:
+        listen_state = state
+        msg = build_listen_message(session.session_id, state, LISTEN_MODE)
         try:
             mqtt_client.publish(mqtt_info['publish_topic'], json.dumps(msg))
             logging.info(f"LISTEN 消息已发送，状态: {state}")
         except Exception as e:
             logging.error(f"LISTEN 消息发送失败: {str(e)}")
 
+def send_wake_word_message(name):
+    """发送listen detect消息：本轮监听由唤醒词触发（不改变监听状态）"""
+    session = audio_session
+    if session is None:
+        return
+    try:
+        mqtt_client.publish(mqtt_info['publish_topic'],
+                            json.dumps(build_listen_message(session.session_id, "detect", LISTEN_MODE, name)))
+        logging.info(f"唤醒词消息已发送: {name}")
+    except Exception as e:
+        logging.error(f"唤醒词消息发送失败: {str(e)}")
+
+def send_abort_message(reason=None):
+    """发送ABORT消息打断服务端TTS，无会话时返回False"""
+    session = audio_session
+    if session is None:
+        return False
+    try:
+        mqtt_client.publish(mqtt_info['publish_topic'],
+                            json.dumps(build_abort_message(session.session_id, reason)))
+        logging.info("ABORT 消息已发送")
+    except Exception as e:
+        logging.error(f"ABORT 消息发送失败: {str(e)}")
+    return True
+
+# ============================================================================
+# 本地控制接口
+# ============================================================================
+
+def control_listen_start(request):
+    global key_press_pending
+    # key_state在排队的按下处理执行时才更新，同一次写入中的多条命令之间不会让出事件循环
+    if key_state == "press" or key_press_pending:
+        return {"ok": False, "error": "已在监听中"}
+    key_press_pending = True
+    schedule_key_action(on_space_key_press, request["received_at"])
+    return {"ok": True}
+
+def control_listen_stop(request):
+    if key_state != "press" and not key_press_pending:
+        return {"ok": False, "error": "当前未在监听"}
+    schedule_key_action(on_space_key_release)
+    return {"ok": True}
+
+def control_abort(request):
+    if not interrupt_speaking(request.get("reason")):
+        return {"ok": False, "error": "当前没有正在播放的TTS"}
+    return {"ok": True}
+
+def control_status(request):
+    return {
+        "ok": True,
+        "mqtt_connected": bool(mqtt_client and mqtt_client.is_connected()),
+        "session_state": session_state,
+        "session_id": audio_session.session_id if audio_session is not None else None,
+        "key_state": key_state,
+        "listen_state": listen_state,
+        "tts_state": tts_state,
+        "listen_mode": LISTEN_MODE,
+        "turns": turn_count,
+        "link": link_controller.decision,
+    }
+
+def control_metrics(request):
+    return {"ok": True, "metrics": metrics.snapshot()}
+
+# 控制命令 -> 处理函数（在事件循环中执行，与按键共用同一套处理逻辑）
+CONTROL_COMMANDS = {
+    'listen_start': control_listen_start,
+    'listen_stop': control_listen_stop,
+    'abort': control_abort,
+    'status': control_status,
+    'metrics': control_metrics,
+}
+
+def handle_control_request(line):
+    """处理一行JSON控制命令，返回回复字典"""
+    received_at = time.monotonic()
+    try:
+        request = json.loads(line)
+        handler = CONTROL_COMMANDS[request["cmd"]]
+    except (ValueError, TypeError, KeyError):
+        return {"ok": False, "error": f"无效命令，可用命令: {', '.join(CONTROL_COMMANDS)}"}
+    request["received_at"] = received_at
+    try:
+        reply = handler(request)
+    except Exception as e:
+        logging.error(f"控制命令处理错误: {str(e)}")
+        reply = {"ok": False, "error": str(e)}
+    if "id" in request:
+        reply["id"] = request["id"]
+    return reply
+
+async def handle_control_client(reader, writer):
+    """
+    控制接口连接：每行一个JSON命令，每个命令回复一行JSON
+
+    命令直接在事件循环中分派到按键处理逻辑，不经过线程切换。
+    """
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            reply = handle_control_request(line)
+            writer.write(json.dumps(reply, ensure_ascii=False).encode('utf-8') + b'\n')
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def start_control_server(path):
+    """在Unix域套接字上启动控制接口（其他进程如ROS节点、唤醒词服务可触发监听）"""
+    try:
+        if os.path.exists(path):
+            # 仍有实例在监听时不抢占，只清理上次运行残留的套接字文件
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(path)
+                except ConnectionRefusedError:
+                    os.unlink(path)
+                else:
+                    raise OSError(errno.EADDRINUSE, f"已有客户端在使用控制接口 {path}")
+        server = await asyncio.start_unix_server(handle_control_client, path=path)
+    except OSError as e:
+        print(f"❌ 控制接口启动失败: {str(e)}")
+        logging.error(f"控制接口启动失败: {str(e)}")
+        return None
+    print(f"🎛️  控制接口: {path}")
+    return server
+
+def send_control_command(path, cmd):
+    """向运行中的客户端发送一条控制命令并返回回复（命令行 --control 使用）"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps({"cmd": cmd}).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline())
+
+# ============================================================================
+# 性能基准测试
+# ============================================================================
+
+def benchmark_uplink(iterations=20000, payload_size=120):
+    """
+    上行组包微基准：对比逐帧hex解析+新建Cipher的旧路径与复用包构建器的新路径
+
+    Args:
+        iterations: 每种路径的组包次数
+        payload_size: 模拟Opus帧的字节数（16kHz/60ms语音帧典型值约100~150字节）
+    """
+    key = SAMPLE_HELLO['udp']['key']
+    nonce = SAMPLE_HELLO['udp']['nonce']
+    payload = os.urandom(payload_size)
+
+    def legacy_build(sequence):
+        new_nonce = (nonce[0:4] + format(len(payload), '04x') +
+                     nonce[8:24] + format(sequence, '08x'))
+        encrypted = aes_ctr_encrypt(bytes.fromhex(key), bytes.fromhex(new_nonce), payload)
+        return bytes.fromhex(new_nonce) + encrypted
+
+    builder = UplinkPacketBuilder(key, nonce)
+
+    # 两条路径输出必须逐字节一致
+    if bytes(builder.build(payload, 1)) != legacy_build(1):
+        print("❌ 包构建器输出与旧路径不一致")
+        return
+
+    results = {}
+    for name, build in (("旧路径 (hex+Cipher)", legacy_build),
+                        ("包构建器", lambda sequence: builder.build(payload, sequence))):
+        start = time.perf_counter()
+        for sequence in range(1, iterations + 1):
+            build(sequence)
+        results[name] = (time.perf_counter() - start) / iterations * 1e6
+
+    print(f"📊 上行组包基准 ({iterations} 次, 负载 {payload_size} 字节)")
+    for name, cost in results.items():
+        print(f"   {name}: {cost:.2f} µs/包")
+    legacy_cost, builder_cost = results.values()
+    print(f"   加速比: {legacy_cost / builder_cost:.2f}x")
+
+def synthesize_speech_pcm(frames):
+    """合成frames帧16kHz测试信号：带包络的谐波加噪声，近似浊音语音"""
+    t = np.arange(frames * CAPTURE_FRAME_SIZE) / 16000
+    envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 3 * t)
+    signal = (np.sin(2 * np.pi * 220 * t) + 0.5 * np.sin(2 * np.pi * 660 * t) +
+              0.25 * np.sin(2 * np.pi * 1320 * t)) * envelope
+    signal += np.random.default_rng(0).normal(0, 0.02, len(t))
+    return (signal * 6000).astype(np.int16).tobytes()
+
+def benchmark_encoder(iterations=20000):
+    """
+    上行编码基准：各编码配置每帧编码的CPU耗时与输出码率
+
+    Args:
+        iterations: 编码帧数上限（每种配置最多编码1000帧合成语音）
+    """
+    frames = max(1, min(iterations, 1000))
+    frame_bytes = CAPTURE_FRAME_SIZE * 2
+    frame_ms = CAPTURE_FRAME_SIZE * 1000 / 16000
+    pcm = synthesize_speech_pcm(frames)
+
+    print(f"📊 上行编码基准 ({frames} 帧 {frame_ms:.0f}ms 合成语音, 单位: 每帧CPU耗时)")
+    print(f"   {ljust_display('配置', 10)}{rjust_display('应用', 8)}{rjust_display('复杂度', 8)}{'FEC':>5}"
+          f"{rjust_display('µs/帧', 10)}{rjust_display('占帧时长', 11)}{'kbps':>9}")
+    for name, profile in ENCODER_PROFILES.items():
+        encoder = OpusUplinkEncoder(profile, adaptive=False)
+        total_bytes = 0
+        for i in range(frames):
+            total_bytes += len(encoder.encode(pcm[i * frame_bytes:(i + 1) * frame_bytes],
+                                              CAPTURE_FRAME_SIZE))
+        cost_us = encoder.cpu_seconds / frames * 1e6
+        kbps = total_bytes * 8 / (frames * frame_ms)
+        print(f"   {ljust_display(name, 10)}{profile['application']:>8}{profile['complexity']:>8}"
+              f"{'开' if profile['fec'] else '关':>4}{cost_us:>10.0f}"
+              f"{cost_us / (frame_ms * 1000):>11.2%}{kbps:>9.1f}")
+
+def benchmark_dsp(iterations=20000):
+    """
+    采集预处理基准：20/40/60ms帧的每帧耗时分位数、超出CPU预算的帧数和处理前后电平
+
+    测试信号为带直流偏置、电平偏低的合成语音，每隔一秒插入一秒只有底噪的静音；
+    电平取后半段（AGC收敛后）统计。
+
+    Args:
+        iterations: 处理的60ms音频帧数上限（最多1000帧）
+    """
+    frames = max(1, min(iterations, 1000))
+    speech = np.frombuffer(synthesize_speech_pcm(frames), dtype=np.int16).astype(np.float64)
+    t = np.arange(speech.size) / 16000
+    signal = (np.where(t % 2 < 1, speech * 0.1, 0) + 1500 +
+              np.random.default_rng(1).normal(0, 30, speech.size))
+    pcm = np.clip(signal, -32768, 32767).astype(np.int16)
+
+    # 电平统计区间：后半段的语音段，以及避开噪声门保持时间和下一段起音所在帧的静音段
+    settled = t >= t[-1] / 2
+    speech_mask = settled & (t % 2 < 1)
+    silence_mask = settled & (t % 2 >= 1.5) & (t % 2 < 1.9)
+
+    def level_db(samples, mask):
+        samples = samples[mask].astype(np.float64)
+        if not samples.size:
+            return float('nan')
+        samples -= samples.mean()
+        return 10 * math.log10(np.mean(samples * samples) / 32768.0 ** 2 + 1e-12)
+
+    print(f"📊 采集预处理基准 ({t[-1]:.0f}s 合成语音, CPU预算 {DSP_CPU_BUDGET:.0%} 帧时长)")
+    for frame_ms in (20, 40, 60):
+        frame_size = frame_ms * 16
+        count = pcm.size // frame_size
+        processor = CaptureProcessor(cpu_budget=DSP_CPU_BUDGET)
+        processor.budget.RETRY_INTERVAL = 0  # 基准中偶发超时后立即恢复处理
+        histogram = LatencyHistogram(window=count)
+        out = np.zeros_like(pcm)
+        for index in range(count):
+            frame = pcm[index * frame_size:(index + 1) * frame_size].tobytes()
+            start = time.perf_counter()
+            processed = processor.process(frame)
+            histogram.observe((time.perf_counter() - start) * 1000)
+            out[index * frame_size:(index + 1) * frame_size] = np.frombuffer(processed, dtype=np.int16)
+        p50, p95, p99 = (histogram.percentile(p) for p in (50, 95, 99))
+        print(f"   {frame_ms}ms帧: p50 {p50:.3f}ms  p95 {p95:.3f}ms  p99 {p99:.3f}ms  "
+              f"(p99占帧时长 {p99 / frame_ms:.2%}, 超预算 {processor.budget.overruns} 帧, "
+              f"直通 {processor.budget.bypasses} 次)")
+        print(f"         语音 {level_db(pcm, speech_mask):.1f} → {level_db(out, speech_mask):.1f} dBFS, "
+              f"静音 {level_db(pcm, silence_mask):.1f} → {level_db(out, silence_mask):.1f} dBFS, "
+              f"直流 {pcm.mean():.0f} → {out[settled].mean():.1f}, AGC增益 {processor.gain_db:.1f} dB")
+
+def synthesize_echo_scene(seconds):
+    """
+    合成回声消除测试场景（16kHz）：远端语音、经模拟回声路径的麦克风信号和近端语音
+
+    回声路径为8ms延迟加指数衰减的随机冲激响应；后半段加入与远端不相关的近端语音（双讲）。
+
+    Returns:
+        (远端PCM, 麦克风PCM, 近端语音采样)：近端语音用于评估双讲时的近端保真度
+    """
+    count = seconds * 16000
+    rng = np.random.default_rng(2)
+    far = np.frombuffer(synthesize_speech_pcm(count // CAPTURE_FRAME_SIZE + 1),
+                        dtype=np.int16)[:count].astype(np.float64)
+    t = np.arange(count) / 16000
+
+    delay = int(0.008 * 16000)
+    decay = np.exp(-np.arange(int(0.06 * 16000)) / (0.015 * 16000))
+    impulse = np.concatenate((np.zeros(delay), rng.normal(0, 1, decay.size) * decay))
+    impulse *= 0.5 / np.sqrt(np.sum(impulse ** 2))
+    echo = np.convolve(far, impulse)[:count]
+
+    # 近端语音：带限噪声按4Hz音节包络调制
+    spectrum = np.fft.rfft(rng.normal(0, 1, count))
+    freqs = np.fft.rfftfreq(count, 1 / 16000)
+    spectrum[(freqs < 200) | (freqs > 3500)] = 0
+    near = np.fft.irfft(spectrum, count)
+    near *= np.maximum(0, np.sin(2 * np.pi * 4 * t)) * (t >= seconds / 2)
+    near *= 2000 / np.sqrt(np.mean(near[t >= seconds / 2] ** 2))
+
+    mic = echo + near + rng.normal(0, 10, count)
+    as_pcm = lambda x: np.clip(x, -32768, 32767).astype(np.int16).tobytes()
+    return as_pcm(far), as_pcm(mic), near
+
+def benchmark_aec(iterations=20000, far_path=None, near_path=None, output_path=None):
+    """
+    回声消除基准：每帧耗时分位数、CPU预算占比、ERLE和双讲时的近端保真度
+
+    远端参考（扬声器播放的音频）和麦克风录音按相同起点逐帧送入，参考信号经EchoReference
+    按时间戳对齐，与运行时的路径一致。未指定文件时使用合成场景（前半段远端单讲，后半段双讲）。
+
+    Args:
+        iterations: 合成场景的60ms帧数上限（最多1000帧）
+        far_path: 远端参考录音（WAV或16kHz裸PCM）
+        near_path: 同步录制的麦克风录音（WAV或16kHz裸PCM）
+        output_path: 回声消除后的输出文件（可选）
+    """
+    near_speech = None
+    if far_path and near_path:
+        far_pcm = load_pcm_file(far_path, 16000)
+        mic_pcm = load_pcm_file(near_path, 16000)
+        source_name = f"{far_path} + {near_path}"
+    else:
+        seconds = max(2, min(iterations, 1000) * CAPTURE_FRAME_SIZE // 16000)
+        far_pcm, mic_pcm, near_speech = synthesize_echo_scene(seconds)
+        source_name = "合成场景"
+    frame_bytes = CAPTURE_FRAME_SIZE * 2
+    frames = min(len(far_pcm), len(mic_pcm)) // frame_bytes
+    if not frames:
+        print("❌ 输入音频不足一帧")
+        return
+
+    reference = EchoReference()
+    canceller = EchoCanceller(reference, AEC_TAIL_MS, AEC_REFERENCE_LEAD_MS, AEC_CPU_BUDGET)
+    canceller.budget.RETRY_INTERVAL = 0  # 基准中偶发超时后立即恢复处理
+    histogram = LatencyHistogram(window=frames)
+    writer = PcmFileWriter(output_path, 16000, time.monotonic()) if output_path else None
+    out = np.zeros(frames * CAPTURE_FRAME_SIZE)
+    try:
+        for index in range(frames):
+            chunk = slice(index * frame_bytes, (index + 1) * frame_bytes)
+            capture_time = index * CAPTURE_FRAME_SIZE / 16000
+            reference.write(far_pcm[chunk], 16000, capture_time)
+            start = time.perf_counter()
+            processed = canceller.process(mic_pcm[chunk], capture_time)
+            histogram.observe((time.perf_counter() - start) * 1000)
+            out[index * CAPTURE_FRAME_SIZE:(index + 1) * CAPTURE_FRAME_SIZE] = np.frombuffer(
+                processed, dtype=np.int16)
+            if writer:
+                writer.write(processed)
+    finally:
+        if writer:
+            writer.close()
+
+    frame_ms = CAPTURE_FRAME_SIZE * 1000 / 16000
+    mic = np.frombuffer(mic_pcm[:frames * frame_bytes], dtype=np.int16).astype(np.float64)
+    energy_db = lambda x: 10 * math.log10(np.mean(x * x) + 1e-9)
+    p50, p95, p99 = (histogram.percentile(p) for p in (50, 95, 99))
+    stats = canceller.stats()
+    print(f"📊 回声消除基准 ({frames} 帧 × {frame_ms:.0f}ms, 输入: {source_name})")
+    print(f"   配置: 块长 {EchoCanceller.BLOCK_SIZE * 1000 // 16000}ms, 尾长 {AEC_TAIL_MS}ms "
+          f"({stats['partitions']} 段), 参考提前 {AEC_REFERENCE_LEAD_MS}ms")
+    print(f"   每帧耗时: p50 {p50:.3f}ms  p95 {p95:.3f}ms  p99 {p99:.3f}ms  "
+          f"(p99占帧时长 {p99 / frame_ms:.1%}, 预算 {AEC_CPU_BUDGET:.0%}, "
+          f"超预算 {stats['overruns']} 帧, 直通 {stats['bypasses']} 次)")
+
+    half = out.size // 2
+    if near_speech is None:
+        print(f"   整体回声衰减: {energy_db(mic) - energy_db(out):.1f} dB (运行时ERLE估计 {stats['erle_db']} dB)")
+        return
+    # 合成场景：前半段后一半（已收敛）的ERLE；后半段双讲时近端语音与其余成分的能量比
+    settled = slice(half // 2, half)
+    near_speech = near_speech[:out.size]
+    double_talk = slice(half, out.size)
+    before = energy_db(near_speech[double_talk]) - energy_db(mic[double_talk] - near_speech[double_talk])
+    after = energy_db(near_speech[double_talk]) - energy_db(out[double_talk] - near_speech[double_talk])
+    print(f"   远端单讲ERLE: {energy_db(mic[settled]) - energy_db(out[settled]):.1f} dB")
+    print(f"   双讲近端信回比: {before:.1f} → {after:.1f} dB "
+          f"(双讲判决 {stats['double_talk_blocks']} 块, 重置 {stats['resets']} 次)")
+
+# 合成唤醒词与干扰词用的音节: (相对基频, (F1, F2)共振峰/Hz, 时长/秒)
+WAKE_WORD_SYLLABLES = ((1.0, (300, 2300), 0.20), (1.1, (750, 1200), 0.22),
+                       (0.95, (350, 1900), 0.20), (0.85, (450, 1500), 0.26))
+DISTRACTOR_SYLLABLES = ((1.0, (300, 2300), 0.20), (1.1, (750, 1200), 0.22), (0.9, (600, 900), 0.22),
+                        (1.05, (280, 800), 0.18), (1.0, (500, 1800), 0.24), (0.9, (350, 1900), 0.20),
+                        (1.2, (650, 1700), 0.20), (0.8, (400, 1000), 0.26))
+# 合成场景的最短时长（秒）；相邻两段唤醒词之间最多插入的干扰词数
+WAKE_SCENE_MIN_SECONDS = 30
+WAKE_SCENE_MAX_DISTRACTORS = 2
+
+def synthesize_syllables(syllables, rng, tempo=1.0, pitch=1.0):
+    """
+    按音节合成类语音信号（16kHz浮点，峰值约1）：滑动基频的谐波经两个共振峰加权，
+    每个音节带起止包络，音节间留30ms间隙
+    """
+    pieces = []
+    harmonics = np.arange(1, 30)[:, None]
+    for f0_scale, (f1, f2), duration in syllables:
+        n = int(duration / tempo * 16000)
+        f0 = 130.0 * pitch * f0_scale * np.linspace(1.08, 0.92, n) * (1 + rng.normal(0, 0.01))
+        phase = 2 * np.pi * np.cumsum(f0) / 16000
+        frequencies = harmonics * f0
+        weights = (np.exp(-((frequencies - f1) / 120.0) ** 2) +
+                   0.6 * np.exp(-((frequencies - f2) / 200.0) ** 2) + 0.03)
+        weights[frequencies > 7000] = 0.0
+        voiced = (weights * np.sin(harmonics * phase)).sum(axis=0)
+        envelope = np.sin(np.pi * np.arange(n) / n) ** 0.5
+        pieces.append(voiced / (np.abs(voiced).max() + 1e-9) * envelope)
+        pieces.append(np.zeros(int(0.03 * 16000)))
+    return np.concatenate(pieces)
+
+def synthesize_wake_word_scene(seconds, rng):
+    """
+    合成唤醒词基准场景：3段唤醒词模板，以及一段含随机语速/音高/音量的唤醒词和干扰词、
+    叠加底噪的测试音频。第一段总是唤醒词，之后连续干扰词不超过WAKE_SCENE_MAX_DISTRACTORS段，
+    场景中至少有一段唤醒词（时长不足以放下一段时返回空spans）
+
+    Returns:
+        (templates, pcm, spans): 模板PCM列表、测试音频PCM、唤醒词在测试音频中的 (起, 止) 秒
+    """
+    def render(syllables):
+        return synthesize_syllables(syllables, rng, tempo=rng.uniform(0.85, 1.15),
+                                    pitch=rng.uniform(0.9, 1.1)) * 10 ** (rng.uniform(-26, -14) / 20)
+
+    templates = []
+    for _ in range(3):
+        signal = np.concatenate((np.zeros(4000), render(WAKE_WORD_SYLLABLES), np.zeros(4000)))
+        signal += rng.normal(0, 10 ** (-60 / 20), signal.size)
+        templates.append((np.clip(signal, -1, 1) * 32767).astype(np.int16).tobytes())
+
+    signal = rng.normal(0, 10 ** (-50 / 20), int(seconds * 16000))
+    spans = []
+    position = 1.0
+    distractors = 0
+    while True:
+        if not spans or distractors >= WAKE_SCENE_MAX_DISTRACTORS or rng.random() < 0.35:
+            word = render(WAKE_WORD_SYLLABLES)
+            is_wake = True
+        else:
+            # 干扰词：随机3~5个音节，部分与唤醒词的前两个音节相同
+            count = int(rng.integers(3, 6))
+            picks = rng.choice(len(DISTRACTOR_SYLLABLES), count)
+            word = render([DISTRACTOR_SYLLABLES[i] for i in picks])
+            is_wake = False
+        start = int(position * 16000)
+        if start + word.size > signal.size:
+            break
+        signal[start:start + word.size] += word
+        if is_wake:
+            spans.append((position, position + word.size / 16000))
+            distractors = 0
+        else:
+            distractors += 1
+        position += word.size / 16000 + rng.uniform(1.0, 2.5)
+    return templates, (np.clip(signal, -1, 1) * 32767).astype(np.int16), spans
+
+def benchmark_wake_word(iterations=20000, template_paths=None, input_path=None):
+    """
+    唤醒词基准：常驻检测的每帧耗时、占单核CPU比例、内存占用，以及检出率和误唤醒次数
+
+    未指定模板时使用合成的唤醒词和干扰词；指定 --wake-template 时用录音模板检测
+    --input-file 中的音频，只列出触发时刻。CPU分别统计整段音频和纯静音输入
+    （常驻运行时的主要情形）。
+
+    Args:
+        iterations: 处理的60ms音频帧数上限（最多1000帧；合成场景至少WAKE_SCENE_MIN_SECONDS秒）
+    """
+    frames = max(1, min(iterations, 1000))
+    rng = np.random.default_rng(3)
+    note = ""
+    if template_paths:
+        if not input_path:
+            print("❌ 使用录音模板时需要用 --input-file 指定测试音频")
+            return
+        templates = load_wake_word_templates(template_paths)
+        pcm = np.frombuffer(load_pcm_file(input_path, 16000), dtype=np.int16)
+        spans = None
+    else:
+        seconds = frames * CAPTURE_FRAME_SIZE / 16000
+        if seconds < WAKE_SCENE_MIN_SECONDS:
+            # 太短的场景放不下几段唤醒词，检出率没有意义
+            note = f", 合成场景按最短 {WAKE_SCENE_MIN_SECONDS}s 生成"
+            seconds = WAKE_SCENE_MIN_SECONDS
+        templates, pcm, spans = synthesize_wake_word_scene(seconds, rng)
+
+    count = pcm.size // CAPTURE_FRAME_SIZE
+    frames = [pcm[index * CAPTURE_FRAME_SIZE:(index + 1) * CAPTURE_FRAME_SIZE].tobytes()
+              for index in range(count)]
+
+    # 内存：tracemalloc会显著拖慢NumPy调用，单独跑一遍统计
+    tracemalloc.start()
+    detector = TemplateWakeWordDetector(templates, WAKE_WORD, WAKE_WORD_THRESHOLD)
+    state_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    for frame in frames:
+        detector.process(frame)
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    detector = TemplateWakeWordDetector(templates, WAKE_WORD, WAKE_WORD_THRESHOLD)
+    histogram = LatencyHistogram(window=count)
+    detections = []
+    cpu_start = time.process_time()
+    for index, frame in enumerate(frames):
+        start = time.perf_counter()
+        detection = detector.process(frame)
+        histogram.observe((time.perf_counter() - start) * 1000)
+        if detection is not None:
+            end = (index + 1) * CAPTURE_FRAME_SIZE / 16000 - detection["delay_ms"] / 1000
+            detections.append((end, detection))
+    cpu_seconds = time.process_time() - cpu_start
+    audio_seconds = count * CAPTURE_FRAME_SIZE / 16000
+
+    # 静音输入：只有能量门限计算
+    silence = bytes(CAPTURE_FRAME_SIZE * 2)
+    idle = TemplateWakeWordDetector(templates, WAKE_WORD, WAKE_WORD_THRESHOLD)
+    idle_start = time.process_time()
+    for _ in range(count):
+        idle.process(silence)
+    idle_seconds = time.process_time() - idle_start
+
+    p50, p95, p99 = (histogram.percentile(p) for p in (50, 95, 99))
+    stats = detector.stats()
+    print(f"📊 唤醒词基准 ({audio_seconds:.0f}s 音频, 模板 {len(templates)} 段共 {stats['template_frames']} 帧, "
+          f"阈值 {WAKE_WORD_THRESHOLD}{note})")
+    print(f"   每帧(60ms)耗时: p50 {p50:.3f}ms  p95 {p95:.3f}ms  p99 {p99:.3f}ms")
+    print(f"   占单核CPU: 整段 {cpu_seconds / audio_seconds:.2%} "
+          f"(有声特征帧占 {stats['active_hops'] * MfccExtractor.HOP / 16000 / audio_seconds:.0%}), "
+          f"纯静音 {idle_seconds / audio_seconds:.2%}")
+    print(f"   内存: 检测器状态 {state_bytes / 1024:.1f} KB, 处理时峰值 {peak_bytes / 1024:.1f} KB")
+
+    if spans is None:
+        for end, detection in detections:
+            print(f"   {end:7.2f}s  {detection['name']}  得分 {detection['score']:.3f}  "
+                  f"时长 {detection['duration_ms']}ms")
+        print(f"   共触发 {len(detections)} 次")
+        return
+
+    if not spans:
+        print(f"   ⚠️ 测试音频中没有唤醒词，不统计检出率（触发 {len(detections)} 次均为误唤醒）")
+        return
+
+    hits = set()
+    false_alarms = 0
+    delays = []
+    for end, detection in detections:
+        matched = [i for i, (s, e) in enumerate(spans) if s - 0.2 <= end <= e + 0.3]
+        if matched:
+            hits.add(matched[0])
+            delays.append(detection["delay_ms"])
+        else:
+            false_alarms += 1
+    print(f"   检出 {len(hits)}/{len(spans)}，误唤醒 {false_alarms} 次 "
+          f"({false_alarms / audio_seconds * 3600:.0f} 次/小时)，"
+          f"唤醒词结束→触发 平均 {np.mean(delays) if delays else 0:.0f}ms")
+
+def benchmark_pipeline(iterations=20000, input_path=None, output_path=None):
+    """
+    上行全链路基准：采集缓冲取帧 → 采集预处理（开启时） → Opus编码 → 组包加密 → 解密 → Opus解码，无需声卡
+
+    PCM经文件音频后端以最快速度写入采集环形缓冲区，按实际运行时的路径逐帧处理，
+    统计各阶段每帧耗时的分位数和整体吞吐（相对实时的倍数）。
+
+    Args:
+        iterations: 未指定输入文件时合成测试信号的帧数
+        input_path: WAV/裸PCM输入文件，默认使用合成的语音频段测试信号
+        output_path: 解码后PCM的输出文件（可选，用于回归比对）
+    """
+    frame_bytes = CAPTURE_FRAME_SIZE * 2
+    frame_ms = CAPTURE_FRAME_SIZE * 1000 / 16000
+
+    if input_path:
+        pcm = load_pcm_file(input_path, 16000)
+        source_name = input_path
+    else:
+        pcm = synthesize_speech_pcm(iterations)
+        source_name = "合成信号"
+    frames = len(pcm) // frame_bytes
+    if not frames:
+        print("❌ 输入音频不足一帧")
+        return
+
+    key = SAMPLE_HELLO['udp']['key']
+    builder = UplinkPacketBuilder(key, SAMPLE_HELLO['udp']['nonce'])
+    cipher = AesCtrCipher(bytes.fromhex(key))
+    processor = CaptureProcessor(cpu_budget=DSP_CPU_BUDGET) if CAPTURE_DSP else None
+    encoder = OpusUplinkEncoder(encoder_profile(), adaptive=False)
+    decoder = opuslib.Decoder(16000, 1)
+    writer = PcmFileWriter(output_path, 16000, time.monotonic()) if output_path else None
+
+    stages = ("预处理", "编码", "组包加密", "解密", "解码", "单帧合计")
+    histograms = {name: LatencyHistogram(window=frames) for name in stages}
+
+    ring = PcmRingBuffer(frame_bytes * CAPTURE_RING_FRAMES)
+
+    def mic_callback(in_data, frame_count, time_info, status):
+        ring.write(in_data, block=True)
+        return None, PA_CONTINUE
+
+    backend = FileAudioBackend(input_pcm=pcm, realtime=False)
+    stream = backend.open(format=PA_INT16, channels=1, rate=16000, input=True,
+                          frames_per_buffer=CAPTURE_FRAME_SIZE, stream_callback=mic_callback)
+    processed = 0
+    start = time.perf_counter()
+    try:
+        for sequence in range(1, frames + 1):
+            data = ring.read(frame_bytes, timeout=1)
+            if data is None:
+                break
+            t0 = time.perf_counter()
+            if processor is not None:
+                data = processor.process(data)
+            t1 = time.perf_counter()
+            encoded = encoder.encode(data, CAPTURE_FRAME_SIZE)
+            t2 = time.perf_counter()
+            packet = builder.build(encoded, sequence)
+            t3 = time.perf_counter()
+            payload = cipher.apply(packet[:16], packet[16:])
+            t4 = time.perf_counter()
+            decoded = decoder.decode(payload, CAPTURE_FRAME_SIZE)
+            t5 = time.perf_counter()
+
+            if payload != encoded:
+                print(f"❌ 第 {sequence} 帧解密结果与编码输出不一致")
+                return
+            for name, cost in zip(stages, (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4, t5 - t0)):
+                histograms[name].observe(cost * 1000)
+            if writer:
+                writer.write(decoded)
+            processed += 1
+    finally:
+        elapsed = time.perf_counter() - start
+        ring.close()
+        stream.close()
+        if writer:
+            writer.close()
+
+    print(f"📊 上行全链路基准 ({processed} 帧 × {frame_ms:.0f}ms, 输入: {source_name})")
+    for name in stages:
+        histogram = histograms[name]
+        p50, p95, p99 = (histogram.percentile(p) for p in (50, 95, 99))
+        print(f"   {name}: p50 {p50:.3f}ms  p95 {p95:.3f}ms  p99 {p99:.3f}ms")
+    print(f"   吞吐: {processed / elapsed:.0f} 帧/秒 (实时的 {processed * frame_ms / 1000 / elapsed:.1f} 倍)")
+    if ring.underflows:
+        print(f"   采集缓冲欠载: {ring.underflows} 次")
+
+# 基准测试名称 -> 入口函数（接收命令行参数）
+BENCHMARKS = {
+    "uplink": lambda args: benchmark_uplink(args.iterations),
+    "pipeline": lambda args: benchmark_pipeline(args.iterations, args.input_file, args.output_file),
+    "encoder": lambda args: benchmark_encoder(args.iterations),
+    "dsp": lambda args: benchmark_dsp(args.iterations),
+    "aec": lambda args: benchmark_aec(args.iterations, args.far_file, args.input_file, args.output_file),
+    "wake": lambda args: benchmark_wake_word(args.iterations, args.wake_template, args.input_file),
+}
+
+# ============================================================================
+# 多设备压测
+# ============================================================================
+
+def virtual_mac_address(index):
+    """由本机MAC派生第index台虚拟设备的MAC（保留前3字节，后3字节为设备序号）"""
+    prefix = device_mac_address().split(':')[:3]
+    return ':'.join(prefix + [f"{(index >> shift) & 0xFF:02x}" for shift in (16, 8, 0)])
+
+class VirtualDevice:
+    """
+    压测用虚拟设备
+
+    每台设备持有独立的MQTT连接、链路质量控制器(LinkQualityController)、上行编码器和UDP socket，
+    每轮按hello回复建立会话(AudioSession)，与客户端发送线程走同一套会话状态：协商的上行帧时长和码率、
+    上行序列号和组包、下行收包统计和解密。不打开音频设备：上行按协商的帧长实时编码同一段PCM，
+    下行只解密并统计丢包。
+    MQTT网络循环在设备自己的网络线程中运行，线程CPU包含设备线程、网络线程和下行接收线程。
+    """
+
+    # TTS结束后等待在途下行包的时间（秒）
+    DRAIN_TIME = 0.2
+
+    def __init__(self, index, pcm, aggregate):
+        self.mac = virtual_mac_address(index)
+        self.pcm = pcm
+        self.aggregate = aggregate
+        self.latency = LatencyStore()
+        self.link = LinkQualityController(announce=False)
+        self.encoder = None
+        self.client = None
+        self.info = None
+        self.uplink = None
+        self.session = None
+        self.turn = {}
+        self.error = None
+        self.cpu_seconds = 0.0
+        self.network_cpu_seconds = 0.0
+        self.receive_cpu_seconds = 0.0
+        self.connected = threading.Event()
+        self.hello_received = threading.Event()
+        self.tts_stopped = threading.Event()
+        self._network = None
+        self._receiving = False
+        self._downlink_range = (None, None)
+        self.stats = {"turns": 0, "failed": 0, "uplink_packets": 0, "downlink_packets": 0,
+                      "expected": 0, "lost": 0, "decrypt_errors": 0}
+
+    @property
+    def total_cpu_seconds(self):
+        return self.cpu_seconds + self.network_cpu_seconds + self.receive_cpu_seconds
+
+    def mark(self, stage):
+        self.turn.setdefault(stage, time.monotonic())
+
+    def publish(self, message):
+        self.client.publish(self.info['publish_topic'], json.dumps(message))
+
+    def connect(self):
+        """获取OTA配置并建立MQTT连接"""
+        self.info = fetch_ota_config(self.mac)
+        self.client = create_mqtt_client(self.info)
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.client.connect(*mqtt_endpoint(self.info), 60)
+        # 不用loop_start：自己的网络线程才能统计MQTT收发和消息回调的CPU
+        self._network = threading.Thread(target=self._network_loop, daemon=True)
+        self._network.start()
+        if not self.connected.wait(10):
+            raise TimeoutError("MQTT连接超时")
+
+    def _network_loop(self):
+        """MQTT网络线程：disconnect()发出DISCONNECT后loop_forever返回"""
+        cpu_start = time.thread_time()
+        try:
+            self.client.loop_forever()
+        except Exception as e:
+            logging.error(f"虚拟设备 {self.mac} MQTT网络循环异常: {str(e)}")
+        finally:
+            self.network_cpu_seconds += time.thread_time() - cpu_start
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            client.subscribe(self.info['subscribe_topic'], qos=0)
+            self.connected.set()
+
+    def _on_message(self, client, userdata, msg):
+        try:
+            message = json.loads(msg.payload)
+        except ValueError:
+            return
+        message_type = message.get('type')
+        if message_type == 'hello':
+            self.session = AudioSession(message, self.uplink)
+            self.mark("hello_received")
+            if "hello_sent" in self.turn:
+                self.link.observe_rtt((self.turn["hello_received"] - self.turn["hello_sent"]) * 1000)
+            self.hello_received.set()
+        elif message_type == 'stt':
+            self.mark("stt")
+        elif message_type == 'llm':
+            self.mark("first_llm")
+        elif message_type == 'tts' and message.get('state') == 'start':
+            self.mark("tts_start")
+            if self.session is not None:
+                self.session.receive_stats.restart_stream()
+        elif message_type == 'tts' and message.get('state') == 'stop':
+            # 本地测试服务会附带本段下行的首尾序列号，用于统计开头和末尾的丢包
+            self._downlink_range = (message.get('first_sequence'), message.get('last_sequence'))
+            self.tts_stopped.set()
+        elif message_type == 'goodbye':
+            self.tts_stopped.set()
+
+    def _receive(self, sock, session):
+        """下行接收线程：过滤重复/过期包并统计丢包，解密"""
+        cpu_start = time.thread_time()
+        while self._receiving:
+            try:
+                data = sock.recv(4096)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if len(data) <= 16 or session.accept(data, time.monotonic()) is None:
+                continue
+            self.mark("first_downlink")
+            self.stats["downlink_packets"] += 1
+            try:
+                session.decrypt(data)
+            except Exception:
+                self.stats["decrypt_errors"] += 1
+        self.receive_cpu_seconds += time.thread_time() - cpu_start
+
+    def run_turn(self, timeout):
+        """
+        完成一轮交互：hello → 按协商的帧长实时编码并上行整段音频 → listen stop → 等待TTS结束 → goodbye
+
+        Returns:
+            bool: 本轮是否在超时前完成
+        """
+        self.turn = {"key_press": time.monotonic()}
+        self.hello_received.clear()
+        self.tts_stopped.clear()
+        self._downlink_range = (None, None)
+        self.session = None
+        self.uplink = self.link.decide(encoder_profile()["bitrate"], UPLINK_FRAME_DURATION)
+        self.mark("hello_sent")
+        self.publish(build_hello_message(self.uplink["frame_duration"]))
+        if not self.hello_received.wait(HELLO_TIMEOUT):
+            return False
+
+        session = self.session
+        session.attach_encoder(self.encoder)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(0.2)
+        sock.connect(session.address)
+        self._receiving = True
+        receiver = threading.Thread(target=self._receive, args=(sock, session), daemon=True)
+        receiver.start()
+
+        completed = False
+        try:
+            self.publish(build_listen_message(session.session_id, "start", "manual"))
+            frame_size = session.uplink_frame_size
+            frame_bytes = frame_size * 2
+            deadline = time.monotonic()
+            for offset in range(0, len(self.pcm) - frame_bytes + 1, frame_bytes):
+                encoded_data = self.encoder.encode(self.pcm[offset:offset + frame_bytes], frame_size)
+                if not (SILENCE_MODE == "dtx" and len(encoded_data) <= 2):
+                    sock.send(session.packet(encoded_data))
+                    self.mark("first_uplink")
+                    self.stats["uplink_packets"] += 1
+                deadline += frame_size / 16000
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            self.mark("listen_stop")
+            self.publish(build_listen_message(session.session_id, "stop", "manual"))
+            completed = self.tts_stopped.wait(timeout)
+            time.sleep(self.DRAIN_TIME)
+        finally:
+            self._receiving = False
+            receiver.join()
+            sock.close()
+            self.encoder.session = None
+            self.publish(build_goodbye_message(session.session_id))
+
+        if None not in self._downlink_range:
+            session.receive_stats.finish(*self._downlink_range)
+        stats = session.receive_stats.stats()
+        self.link.observe_downlink(stats)
+        self.stats["expected"] += stats["expected"]
+        self.stats["lost"] += stats["lost"]
+        record_turn(self.turn, self.latency, self.aggregate)
+        return completed
+
+    def run(self, turns, timeout, pause, stop_event):
+        """设备线程入口"""
+        cpu_start = time.thread_time()
+        try:
+            self.encoder = create_uplink_encoder()
+            self.connect()
+            for _ in range(turns):
+                if stop_event.is_set():
+                    break
+                try:
+                    completed = self.run_turn(timeout)
+                except Exception as e:
+                    logging.error(f"虚拟设备 {self.mac} 交互失败: {str(e)}")
+                    completed = False
+                self.stats["turns" if completed else "failed"] += 1
+                stop_event.wait(pause)
+        except Exception as e:
+            self.error = str(e)
+            logging.error(f"虚拟设备 {self.mac} 运行失败: {str(e)}")
+        finally:
+            self.cpu_seconds += time.thread_time() - cpu_start
+            if self.client:
+                # 先disconnect让网络线程发出DISCONNECT，再等网络线程退出
+                self.client.disconnect()
+                if self._network is not None:
+                    self._network.join(5)
+
+def run_load_test(count, turns=3, utterance_ms=2000, input_path=None, ramp_ms=100,
+                  pause=1.0, timeout=30):
+    """
+    多设备压测：在一个进程内模拟count台设备并发进行语音交互
+
+    所有设备共用同一段上行PCM（合成信号或输入文件），各自按协商的帧长实时编码发送；
+    结束后输出每台设备和汇总的延迟分位数、下行丢包率以及CPU开销。
+
+    Args:
+        count: 虚拟设备数
+        turns: 每台设备的交互轮数
+        utterance_ms: 未指定输入文件时合成上行音频的时长
+        input_path: WAV/裸PCM上行音频文件
+        ramp_ms: 相邻设备的启动间隔，避免同时建连
+        pause: 每轮之间的间隔（秒）
+        timeout: listen stop后等待TTS结束的超时（秒）
+    """
+    frame_ms = CAPTURE_FRAME_SIZE * 1000 // 16000
+    pcm = (load_pcm_file(input_path, 16000) if input_path
+           else synthesize_speech_pcm(max(1, utterance_ms // frame_ms)))
+
+    aggregate = LatencyStore()
+    devices = [VirtualDevice(index + 1, pcm, aggregate) for index in range(count)]
+    stop_event = threading.Event()
+    threads = []
+
+    print(f"🚦 压测开始: {count} 台虚拟设备 × {turns} 轮，每轮上行 {len(pcm) // 32}ms 音频")
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    wall_start = time.monotonic()
+    try:
+        for device in devices:
+            thread = threading.Thread(target=device.run, args=(turns, timeout, pause, stop_event),
+                                      daemon=True)
+            thread.start()
+            threads.append(thread)
+            time.sleep(ramp_ms / 1000)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        print("\n🛑 中断压测，等待本轮结束...")
+        stop_event.set()
+        for thread in threads:
+            thread.join(timeout)
+    wall = time.monotonic() - wall_start
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (usage_end.ru_utime - usage_start.ru_utime) + (usage_end.ru_stime - usage_start.ru_stime)
+
+    def loss_rate(stats):
+        return stats["lost"] / stats["expected"] * 100 if stats["expected"] else 0.0
+
+    def p50(device, segment):
+        entry = device.latency.snapshot().get(segment)
+        return f"{entry[1]:.0f}" if entry else "-"
+
+    print("📋 每台设备 (延迟为p50, 单位ms)")
+    columns = (("设备MAC", 19), ("成功", 6), ("失败", 6), ("上行包", 8), ("下行包", 8),
+               ("丢包率", 9), ("hello往返", 11), ("停止→TTS", 10), ("线程CPU/s", 11))
+    print("   " + "".join(ljust_display(name, width) if i == 0 else rjust_display(name, width)
+                          for i, (name, width) in enumerate(columns)))
+    for device in devices:
+        stats = device.stats
+        print(f"   {device.mac:<19}{stats['turns']:>6}{stats['failed']:>6}"
+              f"{stats['uplink_packets']:>8}{stats['downlink_packets']:>8}"
+              f"{loss_rate(stats):>8.2f}%{p50(device, 'hello往返'):>11}"
+              f"{p50(device, '停止→TTS开始'):>10}{device.total_cpu_seconds:>11.2f}"
+              + (f"  ❌ {device.error}" if device.error else ""))
+
+    totals = {key: sum(device.stats[key] for device in devices) for key in devices[0].stats}
+    print_latency_summary(aggregate, "压测汇总延迟", totals["turns"] + totals["failed"])
+    print(f"   成功 {totals['turns']} 轮，失败 {totals['failed']} 轮，"
+          f"下行丢包率 {loss_rate(totals):.2f}%，解密失败 {totals['decrypt_errors']} 次")
+    print(f"   进程CPU {cpu:.2f}s / 耗时 {wall:.1f}s (单核占用 {cpu / wall * 100:.1f}%，"
+          f"每台设备 {cpu / wall * 100 / count:.2f}%)")
+
 # ============================================================================
 # 主程序入口
 # ============================================================================
 
-def run():
-    """主程序运行函数"""
-    global audio, running, keyboard_thread
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="小智AI语音助手 - RDK系列")
+    parser.add_argument("--benchmark", choices=sorted(BENCHMARKS),
+                        help="运行指定的性能基准测试后退出")
+    parser.add_argument("--iterations", type=int, default=20000,
+                        help="基准测试迭代次数 (默认: 20000)")
+    parser.add_argument("--ota-url", default=OTA_VERSION_URL,
+                        help="OTA配置接口地址，可指向本地测试服务 (默认: 官方服务器)")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="启动分析：MQTT就绪后打印各启动阶段（含延迟导入）的耗时")
+    parser.add_argument("--ota-cache-ttl", type=int, default=OTA_CACHE_TTL,
+                        help=f"OTA配置缓存有效期/秒，有效期内启动直接使用缓存并在后台刷新，0表示不使用缓存 (默认: {OTA_CACHE_TTL})")
+    parser.add_argument("--ota-cache-file", default=OTA_CACHE_FILE,
+                        help=f"OTA配置缓存文件 (默认: {OTA_CACHE_FILE})")
+    parser.add_argument("--load-test", type=int, metavar="N",
+                        help="多设备压测：模拟N台虚拟设备并发交互，输出延迟、丢包和CPU统计后退出")
+    parser.add_argument("--load-turns", type=int, default=3,
+                        help="压测时每台设备的交互轮数 (默认: 3)")
+    parser.add_argument("--load-utterance-ms", type=int, default=2000,
+                        help="压测时合成上行音频的时长/毫秒，指定 --input-file 时使用文件音频 (默认: 2000)")
+    parser.add_argument("--load-ramp-ms", type=int, default=100,
+                        help="压测时相邻虚拟设备的启动间隔/毫秒 (默认: 100)")
+    parser.add_argument("--jitter-min-depth", type=int, default=JITTER_MIN_DEPTH,
+                        help=f"下行抖动缓冲最小深度/帧 (默认: {JITTER_MIN_DEPTH})")
+    parser.add_argument("--jitter-max-depth", type=int, default=JITTER_MAX_DEPTH,
+                        help=f"下行抖动缓冲最大深度/帧 (默认: {JITTER_MAX_DEPTH})")
+    parser.add_argument("--wake-engine", choices=sorted(WAKE_WORD_ENGINES),
+                        help="开启本地唤醒词，说出唤醒词等同按下空格键 (默认: 关闭)")
+    parser.add_argument("--wake-word", default=WAKE_WORD,
+                        help=f"唤醒词文本，随listen detect消息发送给服务器 (默认: {WAKE_WORD})")
+    parser.add_argument("--wake-template", action="append", metavar="PATH",
+                        help="template引擎的唤醒词录音 (WAV或16kHz裸PCM)，可重复指定多段")
+    parser.add_argument("--wake-threshold", type=float, default=WAKE_WORD_THRESHOLD,
+                        help=f"template引擎的触发阈值（平均余弦距离，越小越严格） (默认: {WAKE_WORD_THRESHOLD})")
+    parser.add_argument("--prewarm", action="store_true",
+                        help="预热模式：启动后即在后台建立会话并保持，按键后立即开始上行")
+    parser.add_argument("--preroll-ms", type=int, default=PREROLL_MS,
+                        help="预录缓冲时长/毫秒：持续采集并缓存最近的已编码音频，监听开始时先补发 (默认: 0 关闭)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Prometheus指标服务端口，抓取地址 http://<设备IP>:<端口>/metrics (默认: 0 关闭)")
+    parser.add_argument("--control-socket", nargs="?", const=DEFAULT_CONTROL_SOCKET,
+                        help=f"启用Unix域套接字JSON控制接口 (默认路径: {DEFAULT_CONTROL_SOCKET})")
+    parser.add_argument("--control", choices=sorted(CONTROL_COMMANDS),
+                        help="向运行中的客户端发送一条控制命令，打印回复后退出")
+    parser.add_argument("--audio-backend", choices=["pyaudio", "file"], default=AUDIO_BACKEND,
+                        help="音频后端: pyaudio 使用声卡; file 从文件读取麦克风输入并把下行PCM写入文件")
+    parser.add_argument("--input-file",
+                        help="文件音频后端的麦克风输入 (WAV或16kHz 16位单声道裸PCM)，不指定时输入静音")
+    parser.add_argument("--output-file",
+                        help="文件音频后端的下行PCM输出 (.wav或裸PCM)，同时生成 .timestamps.csv 时间戳文件")
+    parser.add_argument("--far-file",
+                        help="--benchmark aec 的远端参考录音 (WAV或16kHz裸PCM)，与 --input-file 的麦克风录音同步录制")
+    parser.add_argument("--input-pace", choices=["realtime", "fast"], default=AUDIO_INPUT_PACE,
+                        help="文件输入节奏: realtime 按实时节奏; fast 尽快读取 (默认: realtime)")
+    parser.add_argument("--listen-mode", choices=["manual", "auto", "realtime"], default=LISTEN_MODE,
+                        help="监听模式: manual 按住空格说话; auto 按一次空格，本地VAD检测到语音结束后自动停止; "
+                             "realtime 全双工连续对话，播放期间继续采集（回声消除），说话即可打断，再按一次结束")
+    parser.add_argument("--aec", choices=["auto", "on", "off"], default=AEC_MODE,
+                        help="回声消除: auto 仅在 realtime 模式下开启 (默认: auto)")
+    parser.add_argument("--aec-tail-ms", type=int, default=AEC_TAIL_MS,
+                        help=f"回声消除覆盖的回声尾长/毫秒，越长越耗CPU (默认: {AEC_TAIL_MS})")
+    parser.add_argument("--vad-silence-ms", type=int, default=VAD_SILENCE_MS,
+                        help=f"自动模式下判定语音结束的尾部静音时长/毫秒 (默认: {VAD_SILENCE_MS})")
+    parser.add_argument("--silence-mode", choices=["off", "skip", "dtx"],
+                        help="静音帧处理: off 全部发送; skip 跳过静音帧; dtx Opus DTX编码 "
+                             "(默认: auto模式为skip，manual模式为off)")
+    parser.add_argument("--capture-dsp", action="store_true",
+                        help="开启编码前的采集预处理：高通去直流、自动增益和噪声门，超出CPU预算时自动直通")
+    parser.add_argument("--frame-duration", choices=["auto", "20", "40", "60"], default="auto",
+                        help="上行帧时长/毫秒: auto 按链路质量（RTT、丢包、抖动）为每个会话选择 (默认: auto)")
+    parser.add_argument("--encoder-profile", choices=list(ENCODER_PROFILES), default=ENCODER_PROFILE,
+                        help="上行Opus编码配置: voip 语音+FEC; lossy 高丢包网络; low_cpu 低复杂度; "
+                             "audio 原默认参数 (默认: voip)")
+    parser.add_argument("--opus-bitrate", type=int, help="覆盖编码配置的码率/bps")
+    parser.add_argument("--opus-complexity", type=int, choices=range(11), metavar="0-10",
+                        help="覆盖编码配置的复杂度")
+    parser.add_argument("--opus-loss-perc", type=int, help="覆盖编码配置的预期丢包率/%%")
+    parser.add_argument("--no-encoder-adapt", action="store_true",
+                        help="关闭按丢包率和CPU余量自适应调整编码参数")
+    parser.add_argument("--key-release-timeout", type=float, default=KEY_RELEASE_TIMEOUT, metavar="SECONDS",
+                        help="终端按键：按住空格的自动重复停止超过该时长即结束录音，需大于终端自动重复延迟 "
+                             "(默认: 0 关闭，输入其他任意键结束录音)")
+    parser.add_argument("--ptt-input", choices=["terminal", "evdev", "gpio"], default=PTT_INPUT,
+                        help="按键输入: terminal 终端空格键; evdev 输入设备按键(有真实松开事件); gpio 按钮 (默认: terminal)")
+    parser.add_argument("--evdev-device",
+                        help="evdev输入设备，如 /dev/input/event0 (默认: 自动选择键盘)")
+    parser.add_argument("--evdev-key", type=int, default=EVDEV_KEY_CODE,
+                        help=f"evdev按键码 (默认: {EVDEV_KEY_CODE}，即KEY_SPACE)")
+    parser.add_argument("--gpio-pin", type=int,
+                        help="GPIO按钮的线号 (libgpiod) 或全局GPIO编号 (sysfs)")
+    parser.add_argument("--gpio-chip", default=GPIO_CHIP,
+                        help=f"GPIO控制器字符设备 (默认: {GPIO_CHIP})")
+    parser.add_argument("--gpio-active-high", action="store_true",
+                        help="按钮按下为高电平 (默认: 按下接地、低电平有效)")
+    return parser.parse_args()
+
+def apply_args(args):
+    """将命令行参数应用到全局配置"""
+    global OTA_VERSION_URL, OTA_CACHE_TTL, OTA_CACHE_FILE, JITTER_MIN_DEPTH, JITTER_MAX_DEPTH, LISTEN_MODE, SILENCE_MODE, VAD_SILENCE_MS
+    global PREWARM, PREROLL_MS, METRICS_PORT, PROFILE_STARTUP, CONTROL_SOCKET
+    global AUDIO_BACKEND, AUDIO_INPUT_FILE, AUDIO_OUTPUT_FILE, AUDIO_INPUT_PACE
+    global KEY_RELEASE_TIMEOUT, PTT_INPUT, EVDEV_DEVICE, EVDEV_KEY_CODE, GPIO_PIN, GPIO_CHIP, GPIO_ACTIVE_LOW
+    global ENCODER_PROFILE, OPUS_BITRATE, OPUS_COMPLEXITY, OPUS_LOSS_PERC, ENCODER_ADAPT
+    global UPLINK_FRAME_DURATION, CAPTURE_DSP, AEC_MODE, AEC_TAIL_MS
+    global WAKE_WORD_ENGINE, WAKE_WORD, WAKE_WORD_TEMPLATES, WAKE_WORD_THRESHOLD
+
+    OTA_VERSION_URL = args.ota_url
+    OTA_CACHE_TTL = max(0, args.ota_cache_ttl)
+    OTA_CACHE_FILE = args.ota_cache_file
+    JITTER_MIN_DEPTH = max(1, args.jitter_min_depth)
+    JITTER_MAX_DEPTH = max(JITTER_MIN_DEPTH, args.jitter_max_depth)
+    LISTEN_MODE = args.listen_mode
+    WAKE_WORD_ENGINE = args.wake_engine
+    WAKE_WORD = args.wake_word
+    WAKE_WORD_TEMPLATES = args.wake_template or []
+    WAKE_WORD_THRESHOLD = args.wake_threshold
+    if WAKE_WORD_ENGINE and LISTEN_MODE == "manual":
+        # 唤醒后没有松开按键的动作，由本地VAD结束监听
+        LISTEN_MODE = "auto"
+    SILENCE_MODE = args.silence_mode or ("skip" if LISTEN_MODE == "auto" else "off")
+    VAD_SILENCE_MS = args.vad_silence_ms
+    PREWARM = args.prewarm
+    PROFILE_STARTUP = args.profile_startup
+    PREROLL_MS = max(0, args.preroll_ms)
+    METRICS_PORT = args.metrics_port
+    CONTROL_SOCKET = args.control_socket
+    AUDIO_BACKEND = args.audio_backend
+    AUDIO_INPUT_FILE = args.input_file
+    AUDIO_OUTPUT_FILE = args.output_file
+    AUDIO_INPUT_PACE = args.input_pace
+    ENCODER_PROFILE = args.encoder_profile
+    OPUS_BITRATE = args.opus_bitrate
+    OPUS_COMPLEXITY = args.opus_complexity
+    OPUS_LOSS_PERC = args.opus_loss_perc
+    ENCODER_ADAPT = not args.no_encoder_adapt
+    UPLINK_FRAME_DURATION = None if args.frame_duration == "auto" else int(args.frame_duration)
+    CAPTURE_DSP = args.capture_dsp
+    AEC_MODE = args.aec
+    AEC_TAIL_MS = args.aec_tail_ms
+    KEY_RELEASE_TIMEOUT = max(0.0, args.key_release_timeout)
+    PTT_INPUT = args.ptt_input
+    EVDEV_DEVICE = args.evdev_device
+    EVDEV_KEY_CODE = args.evdev_key
+    GPIO_PIN = args.gpio_pin
+    GPIO_CHIP = args.gpio_chip
+    GPIO_ACTIVE_LOW = not args.gpio_active_high
+
+def on_sigint():
+    """Ctrl+C：请求退出，由主协程完成清理"""
+    print("\n🛑 中断退出")
+    request_shutdown()
+
+async def stop_audio_transport():
+    """关闭UDP传输并等待播放阶段退役（退出时使用）"""
+    if udp_transport is None:
+        return
+    receiver = udp_transport.get_protocol()
+    close_audio_transport()
+    # connection_lost在下一轮事件循环中执行
+    await asyncio.sleep(0)
+    if receiver.retired is not None:
+        await receiver.retired
+
+async def main():
+    """
+    主协程：UDP收包、MQTT网络读写、心跳、会话超时和键盘输入都在同一个事件循环中处理
+
+    只有麦克风采集编码（常驻发送线程）、声卡回调和阻塞的HTTP/连接调用在线程中运行，
+    空闲时没有任何轮询；退出时按固定顺序清理资源。
+    """
+    global audio, running, send_audio_thread, event_loop, shutdown_event, heartbeat_timer
+    global message_queue, audio_ready, echo_reference, wake_word_detector
+
+    main_started = time.monotonic()
+    startup_profiler.record("解释器启动与模块导入", startup_profiler.origin, main_started)
+    event_loop = asyncio.get_running_loop()
+    shutdown_event = asyncio.Event()
+    audio_ready = asyncio.Event()
+    message_queue = asyncio.Queue()
+    dispatcher = event_loop.create_task(dispatch_mqtt_messages())
+    event_loop.add_signal_handler(signal.SIGINT, on_sigint)
+    ptt_input = None
+    control_server = None
 
     try:
         # 显示程序信息
         print_banner()
-        print(f"🏷️  设备MAC地址: {MAC_ADDR}")
 
-        # 获取并显示wlan0 IP地址
-        wlan0_ip = get_wlan0_ip()
+        # 相互独立的启动阶段并行执行：音频初始化、设备信息、TLS上下文
+        print("🚀 初始化音频...")
+        if AUDIO_BACKEND == "file":
+            print(f"🗂️  文件音频后端: 输入 {AUDIO_INPUT_FILE or '静音'}，"
+                  f"输出 {AUDIO_OUTPUT_FILE or '丢弃'}")
+        audio_init = event_loop.create_task(startup_profiler.run("音频初始化", create_audio_backend))
+        # 编解码和VAD用到的模块在后台预先导入，不阻塞就绪
+        event_loop.run_in_executor(None, preload_modules, 'opuslib', 'np')
+        tls_init = event_loop.create_task(startup_profiler.run("TLS上下文", get_mqtt_tls_context))
+        mac_address, wlan0_ip = await startup_profiler.run("设备信息", get_device_info)
+
+        # 显示MAC和wlan0 IP地址
+        print(f"🏷️  设备MAC地址: {mac_address}")
         if wlan0_ip == '127.0.0.1':
             print(f"⚠️  wlan0未连接，使用: {wlan0_ip}")
         else:
             print(f"📡 wlan0 IP地址: {wlan0_ip}")
 
-        # 初始化音频系统
-        print("🚀 初始化音频...")
-        with ALSAErrorSuppressor():
-            audio = pyaudio.PyAudio()
+        # 启动指标服务
+        if METRICS_PORT:
+            start_metrics_server(METRICS_PORT)
 
-        # 获取服务器配置
+        # 获取服务器配置（与音频初始化并行）
         print("🌐 获取配置...")
-        get_ota_version()
+        await startup_profiler.wait("获取配置", get_ota_version())
+        if not mqtt_info:
+            return
 
         # 连接MQTT服务
         print("📡 连接服务...")
-        setup_mqtt()
+        await tls_init
+        await setup_mqtt()
 
-        # 启动心跳线程
+        # 启动心跳定时器
         print("💓 启动心跳...")
-        threading.Thread(target=send_heartbeat, daemon=True).start()
+        heartbeat_timer = event_loop.call_later(HEARTBEAT_INTERVAL, send_heartbeat)
 
         # 启动键盘监听
         print("⌨️  启动监听...")
         init_terminal()
-        keyboard_thread = threading.Thread(target=keyboard_listener, daemon=True)
-        keyboard_thread.start()
+        start_keyboard_listener()
+        ptt_input = create_ptt_input()
+        if ptt_input is not None:
+            ptt_input.start()
+        if CONTROL_SOCKET:
+            control_server = await start_control_server(CONTROL_SOCKET)
+
+        # 等待音频初始化完成后启动常驻音频发送线程
+        audio = await audio_init
+        audio_ready.set()
+        check_startup_ready()
+        if aec_enabled():
+            echo_reference = EchoReference()
+            print(f"🔁 回声消除已开启 (尾长 {AEC_TAIL_MS}ms)")
+        wake_word_detector = create_wake_word_detector()
+        if wake_word_detector is not None:
+            print(f"👂 唤醒词已开启: 「{WAKE_WORD}」({WAKE_WORD_ENGINE})")
+        send_audio_thread = threading.Thread(target=send_audio, daemon=True)
+        send_audio_thread.start()
 
         print("✨ 启动完成!")
         print("=" * 60)
 
-        # 主循环
-        try:
-            while running:
-                time.sleep(0.1)
-        except KeyboardInterrupt:
-            print("\n🛑 中断退出")
-            running = False
+        # 等待退出请求
+        await shutdown_event.wait()
 
     except Exception as e:
         print(f"❌ 运行错误: {str(e)}")
@@ -927,31 +5788,54 @@ def run():
         # 清理资源
         print("\n🧹 清理资源...")
         running = False
+        session_ready.set()
+
+        # 1. 停止定时器、消息分发和键盘输入
+        for timer in (heartbeat_timer, idle_timer, key_release_timer):
+            if timer is not None:
+                timer.cancel()
+        dispatcher.cancel()
+        if ota_refresh_task is not None:
+            ota_refresh_task.cancel()
+        event_loop.remove_reader(sys.stdin.fileno())
+        if ptt_input is not None:
+            try:
+                ptt_input.close()
+            except Exception as e:
+                logging.warning(f"按键输入关闭异常: {str(e)}")
+        if control_server is not None:
+            control_server.close()
+            try:
+                os.unlink(CONTROL_SOCKET)
+            except OSError:
+                pass
 
-        # 1. 先停止MQTT（防止重连）
+        # 2. 停止MQTT（running已清除，不会重连）
         if mqtt_client:
             try:
-                mqtt_client.loop_stop()
                 mqtt_client.disconnect()
+                # 等待事件循环写出DISCONNECT报文
+                for _ in range(20):
+                    if mqtt_client.socket() is None:
+                        break
+                    await asyncio.sleep(0.05)
+                mqtt_bridge.close()
                 logging.info("MQTT连接已关闭")
             except Exception as e:
                 logging.warning(f"MQTT关闭异常: {str(e)}")
 
-        # 2. 等待音频线程结束
-        if send_audio_thread and send_audio_thread.is_alive():
-            send_audio_thread.join(timeout=2)
-        if recv_audio_thread and recv_audio_thread.is_alive():
-            recv_audio_thread.join(timeout=2)
+        # 3. 关闭UDP传输，停止播放
+        try:
+            await stop_audio_transport()
+            logging.info("UDP连接已关闭")
+        except Exception as e:
+            logging.warning(f"UDP关闭异常: {str(e)}")
 
-        # 3. 关闭UDP socket
-        if udp_socket:
-            try:
-                udp_socket.close()
-                logging.info("UDP连接已关闭")
-            except Exception as e:
-                logging.warning(f"UDP关闭异常: {str(e)}")
+        # 4. 等待发送线程结束
+        if send_audio_thread and send_audio_thread.is_alive():
+            await event_loop.run_in_executor(None, send_audio_thread.join, 2)
 
-        # 4. 终止音频系统
+        # 5. 终止音频系统
         if audio:
             try:
                 audio.terminate()
@@ -959,11 +5843,37 @@ def run():
             except Exception as e:
                 logging.warning(f"音频系统终止异常: {str(e)}")
 
-        # 5. 恢复终端设置
+        # 6. 恢复终端设置
         restore_terminal()
 
+        # 7. 输出本次运行的延迟统计
+        finish_turn()
+        if turn_count:
+            print_latency_summary()
+        print_message_latency_summary()
+
         logging.info("资源清理完成")
         print("👋 程序退出")
 
+def run():
+    """主程序运行函数"""
+    asyncio.run(main())
+
 if __name__ == "__main__":
-    run()
+    args = parse_args()
+    apply_args(args)
+    if args.control:
+        try:
+            reply = send_control_command(CONTROL_SOCKET or DEFAULT_CONTROL_SOCKET, args.control)
+        except OSError as e:
+            print(f"❌ 无法连接控制接口: {str(e)}")
+            sys.exit(1)
+        print(json.dumps(reply, ensure_ascii=False, indent=2))
+        sys.exit(0 if reply.get("ok") else 1)
+    elif args.benchmark:
+        BENCHMARKS[args.benchmark](args)
+    elif args.load_test:
+        run_load_test(args.load_test, args.load_turns, args.load_utterance_ms,
+                      args.input_file, args.load_ramp_ms)
+    else:
+        run()
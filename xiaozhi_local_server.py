@@ -0,0 +1,590 @@
+#!/usr/bin/python
+# -*- coding: UTF-8 -*-
+
+"""
+小智本地测试服务 - 离线端到端基准
+=====================================
+
+在本机模拟小智服务端，客户端无需连接 api.tenclass.net 即可完成完整的语音交互，
+用于在离线的Linux机器上得到可复现的端到端延迟和吞吐数据。
+
+提供三部分服务:
+- OTA HTTP接口: 返回指向本服务的MQTT配置
+- MQTT Broker (TLS, MQTT 3.1.1子集): 处理 hello/listen/abort/goodbye，
+  下发 hello/stt/llm/tts 消息
+- UDP音频服务: 与客户端相同的AES-128-CTR + 16字节nonce分帧；
+  收到 listen stop 后回放(echo)本轮上行音频，或下发合成的提示音(tone)；
+  realtime 监听模式下按上行音频能量断句，每句结束即应答，说话时打断正在下发的TTS
+
+使用方法:
+1. 启动服务: python xiaozhi_local_server.py
+2. 启动客户端: python xiaozhi-in-rdk.py --ota-url http://127.0.0.1:8000/xiaozhi/ota/
+   无声卡时可配合 --audio-backend file --input-file <录音.wav> --output-file <输出.wav>
+
+可选参数用于模拟服务端处理延迟、下行丢包和网络抖动，见 --help。
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import random
+import ssl
+import struct
+import tempfile
+import time
+import uuid
+
+import numpy as np
+import opuslib
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('XIAOZHI_LOCAL')
+
+# 下行音频参数（与官方服务端一致）
+DOWNLINK_SAMPLE_RATE = 24000
+FRAME_DURATION = 60
+FRAME_DURATIONS = (20, 40, 60)
+
+# MQTT控制报文类型
+MQTT_CONNECT = 1
+MQTT_PUBLISH = 3
+MQTT_PUBACK = 4
+MQTT_SUBSCRIBE = 8
+MQTT_PINGREQ = 12
+MQTT_DISCONNECT = 14
+
+# ============================================================================
+# 工具函数
+# ============================================================================
+
+def create_tls_context():
+    """生成临时自签名证书并创建服务端TLS上下文（客户端不校验证书）"""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "xiaozhi-local")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=365))
+            .sign(key, hashes.SHA256()))
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    with tempfile.TemporaryDirectory() as directory:
+        cert_path = os.path.join(directory, "cert.pem")
+        key_path = os.path.join(directory, "key.pem")
+        with open(cert_path, "wb") as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+        with open(key_path, "wb") as f:
+            f.write(key.private_bytes(serialization.Encoding.PEM,
+                                      serialization.PrivateFormat.TraditionalOpenSSL,
+                                      serialization.NoEncryption()))
+        context.load_cert_chain(cert_path, key_path)
+    return context
+
+def aes_ctr(key, nonce, data):
+    """AES-CTR加解密（对称）"""
+    cipher = Cipher(algorithms.AES(key), modes.CTR(nonce))
+    encryptor = cipher.encryptor()
+    return encryptor.update(data) + encryptor.finalize()
+
+def synthesize_tone_frames(duration_ms, frame_duration=FRAME_DURATION):
+    """合成带淡入淡出的双音提示音并编码为24kHz、帧时长frame_duration的Opus帧"""
+    frame_size = DOWNLINK_SAMPLE_RATE * frame_duration // 1000
+    frames = max(1, duration_ms // frame_duration)
+    t = np.arange(frames * frame_size) / DOWNLINK_SAMPLE_RATE
+    envelope = np.minimum(1.0, np.minimum(t, t[-1] - t) / 0.05)
+    signal = (np.sin(2 * np.pi * 523.25 * t) + 0.5 * np.sin(2 * np.pi * 784 * t)) * envelope
+    pcm = (signal * 8000).astype(np.int16).tobytes()
+
+    encoder = opuslib.Encoder(DOWNLINK_SAMPLE_RATE, 1, opuslib.APPLICATION_AUDIO)
+    frame_bytes = frame_size * 2
+    return [encoder.encode(pcm[i:i + frame_bytes], frame_size)
+            for i in range(0, len(pcm), frame_bytes)]
+
+# ============================================================================
+# OTA HTTP接口
+# ============================================================================
+
+class OtaServer:
+    """最小化的HTTP服务，对任意POST请求返回MQTT配置"""
+
+    def __init__(self, config):
+        self.config = config
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            if length:
+                await reader.readexactly(length)
+
+            device_id = headers.get('device-id', 'unknown')
+            body = json.dumps(self.build_response(device_id)).encode('utf-8')
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: application/json\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                         b'Connection: close\r\n\r\n' + body)
+            await writer.drain()
+            logger.info(f"OTA请求: {request_line.decode('latin-1').strip()} (设备 {device_id})")
+        except Exception as e:
+            logger.warning(f"OTA请求处理失败: {e}")
+        finally:
+            writer.close()
+
+    def build_response(self, device_id):
+        # 同一设备每次获得相同的client_id，与云端行为一致，客户端缓存的配置保持有效
+        client_id = f"GID_local@@@{device_id.replace(':', '_')}@@@{uuid.uuid5(uuid.NAMESPACE_OID, device_id).hex[:8]}"
+        return {
+            "mqtt": {
+                "endpoint": f"{self.config.host}:{self.config.mqtt_port}",
+                "client_id": client_id,
+                "username": "local",
+                "password": "local",
+                "publish_topic": "device-server",
+                "subscribe_topic": f"devices/p2p/{device_id.replace(':', '_')}",
+            },
+            "server_time": {
+                "timestamp": int(time.time() * 1000),
+                "timezone_offset": 480,
+            },
+            "firmware": {"version": "1.1.0-rdk", "url": ""},
+        }
+
+# ============================================================================
+# 语音会话
+# ============================================================================
+
+class UplinkSpeechDetector:
+    """realtime模式的服务端断句：解码上行Opus帧，按能量判断一句话的开始和结束"""
+
+    THRESHOLD_DB = -45.0
+    START_MS = 120  # 连续有声多久算开始说话
+    END_MS = 600  # 说话后连续静音多久算一句结束
+    MAX_FRAME_SIZE = 960  # 16kHz/60ms
+
+    def __init__(self):
+        self.decoder = opuslib.Decoder(16000, 1)
+        self.speaking = False
+        self._voiced_ms = 0
+        self._silence_ms = 0
+
+    def process(self, frame):
+        """
+        处理一帧上行Opus音频
+
+        Returns:
+            'start'（开始说话）、'end'（一句结束）或 None
+        """
+        try:
+            pcm = self.decoder.decode(frame, self.MAX_FRAME_SIZE)
+        except Exception:
+            return None
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float64)
+        if not samples.size:
+            return None
+        frame_ms = samples.size * 1000 // 16000
+        level_db = 10 * np.log10(np.mean(samples * samples) / 32768.0 ** 2 + 1e-12)
+
+        if level_db > self.THRESHOLD_DB:
+            self._voiced_ms += frame_ms
+            self._silence_ms = 0
+            if not self.speaking and self._voiced_ms >= self.START_MS:
+                self.speaking = True
+                return 'start'
+        else:
+            self._voiced_ms = 0
+            self._silence_ms += frame_ms
+            if self.speaking and self._silence_ms >= self.END_MS:
+                self.speaking = False
+                return 'end'
+        return None
+
+class VoiceSession:
+    """一个MQTT连接上的语音会话：密钥、UDP地址、本轮上行帧和TTS下发任务"""
+
+    REALTIME_PREROLL_MS = 300  # realtime模式下保留的起音前音频
+
+    def __init__(self, server, connection, frame_duration=FRAME_DURATION):
+        self.server = server
+        self.connection = connection
+        # 沿用客户端hello协商的帧时长（回放模式下行帧即上行帧）
+        self.frame_duration = frame_duration
+        self.session_id = uuid.uuid4().hex
+        self.key = os.urandom(16)
+        self.connection_id = os.urandom(4)
+        self.nonce = b'\x01\x00\x00\x00' + self.connection_id + bytes(8)
+        self.udp_addr = None
+        self.listening = False
+        self.uplink_frames = []
+        self.last_uplink_sequence = 0
+        # 下行序列号在会话内连续递增（不随每段TTS重置），客户端据此丢弃被打断语音的迟到包
+        self.downlink_sequence = 0
+        self.tts_task = None
+        self.listen_stop_time = None
+        self.detector = None  # realtime监听模式的断句器
+
+    def hello_reply(self):
+        return {
+            "type": "hello",
+            "version": 3,
+            "session_id": self.session_id,
+            "transport": "udp",
+            "udp": {
+                "server": self.server.config.host,
+                "port": self.server.config.udp_port,
+                "encryption": "aes-128-ctr",
+                "key": self.key.hex(),
+                "nonce": self.nonce.hex(),
+            },
+            "audio_params": {
+                "format": "opus",
+                "sample_rate": DOWNLINK_SAMPLE_RATE,
+                "channels": 1,
+                "frame_duration": self.frame_duration,
+            },
+        }
+
+    def on_uplink(self, data, addr):
+        """UDP上行包：解密并缓存本轮音频"""
+        self.udp_addr = addr
+        sequence = struct.unpack_from('>I', data, 12)[0]
+        if sequence <= self.last_uplink_sequence:
+            return
+        self.last_uplink_sequence = sequence
+        # UDP可能先于MQTT的listen start到达，不按监听状态过滤，listen stop时整体取走
+        frame = aes_ctr(self.key, data[:16], data[16:])
+        self.uplink_frames.append(frame)
+        if self.detector is not None and self.listening:
+            self.on_realtime_frame(frame)
+
+    def on_realtime_frame(self, frame):
+        """realtime模式：说话时打断TTS，一句结束即应答"""
+        preroll = max(1, self.REALTIME_PREROLL_MS // self.frame_duration)
+        event = self.detector.process(frame)
+        if event == 'start':
+            del self.uplink_frames[:-preroll]
+            if self.cancel_tts():
+                logger.info(f"会话 {self.session_id[:8]}: 检测到说话，打断TTS")
+        elif event == 'end':
+            self.cancel_tts()
+            self.listen_stop_time = time.monotonic()
+            frames, self.uplink_frames = self.uplink_frames, []
+            self.tts_task = asyncio.ensure_future(self.respond(frames))
+        elif not self.detector.speaking:
+            # 未在说话时只保留起音前的音频
+            del self.uplink_frames[:-preroll]
+
+    def on_listen(self, message):
+        state = message.get('state')
+        if state == 'start':
+            self.cancel_tts()
+            self.listening = True
+            self.detector = UplinkSpeechDetector() if message.get('mode') == 'realtime' else None
+        elif state == 'detect':
+            logger.info(f"会话 {self.session_id[:8]}: 唤醒词 {message.get('text')}")
+        elif state == 'stop' and self.detector is not None:
+            # 全双工对话结束，不再应答
+            self.listening = False
+            self.detector = None
+            self.uplink_frames = []
+        elif state == 'stop' and self.listening:
+            self.listening = False
+            self.listen_stop_time = time.monotonic()
+            frames, self.uplink_frames = self.uplink_frames, []
+            self.tts_task = asyncio.ensure_future(self.respond(frames))
+
+    def cancel_tts(self):
+        if self.tts_task and not self.tts_task.done():
+            self.tts_task.cancel()
+            self.tts_task = None
+            return True
+        return False
+
+    async def respond(self, frames):
+        """一轮应答: stt → llm → tts start → 音频帧 → tts stop"""
+        config = self.server.config
+        first_sequence = self.downlink_sequence + 1
+        try:
+            if config.response_delay_ms:
+                await asyncio.sleep(config.response_delay_ms / 1000)
+
+            self.send({"type": "stt",
+                       "text": f"本地测试: 收到 {len(frames)} 帧上行音频 ({len(frames) * self.frame_duration}ms)"})
+            self.send({"type": "llm", "text": "😊", "emotion": "happy"})
+            self.send({"type": "tts", "state": "start"})
+
+            if config.mode == "echo" and frames:
+                # Opus帧与采样率无关，客户端可直接按24kHz解码回放上行音频
+                reply = frames
+                text = "回放本轮录音"
+            else:
+                reply = self.server.tone_frames(self.frame_duration)
+                text = "本地测试提示音"
+            self.send({"type": "tts", "state": "sentence_start", "text": text})
+            await self.stream(reply, len(frames))
+            self.send(self.tts_stop_message(first_sequence))
+        except asyncio.CancelledError:
+            self.send(self.tts_stop_message(first_sequence))
+            raise
+
+    def tts_stop_message(self, first_sequence):
+        """tts stop，附带本段下行的首尾序列号（扩展字段，客户端忽略，压测据此统计开头和末尾的丢包）"""
+        return {"type": "tts", "state": "stop",
+                "first_sequence": first_sequence, "last_sequence": self.downlink_sequence}
+
+    async def stream(self, frames, uplink_count):
+        """按实时节奏下发加密音频帧，可模拟丢包和抖动"""
+        config = self.server.config
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        sent = dropped = 0
+        for index, frame in enumerate(frames):
+            if self.udp_addr is None:
+                logger.warning("尚未收到上行包，无法确定客户端UDP地址")
+                return
+            self.downlink_sequence += 1
+            nonce = (b'\x01\x00' + struct.pack('>H', len(frame)) + self.connection_id +
+                     struct.pack('>II', index * self.frame_duration, self.downlink_sequence))
+            packet = nonce + aes_ctr(self.key, nonce, frame)
+
+            if config.loss_rate and random.random() < config.loss_rate:
+                dropped += 1
+            elif config.jitter_ms:
+                loop.call_later(random.uniform(0, config.jitter_ms) / 1000,
+                                self.server.udp_send, packet, self.udp_addr)
+            else:
+                self.server.udp_send(packet, self.udp_addr)
+            sent += 1
+            if index == 0:
+                logger.info(f"listen stop → 首个下行包: "
+                            f"{(time.monotonic() - self.listen_stop_time) * 1000:.1f}ms")
+
+            delay = start + (index + 1) * self.frame_duration / 1000 - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        logger.info(f"会话 {self.session_id[:8]}: 上行 {uplink_count} 帧，"
+                    f"下行 {sent} 帧（模拟丢弃 {dropped} 帧）")
+
+    def send(self, message):
+        message.setdefault("session_id", self.session_id)
+        self.connection.publish(message)
+
+    def close(self):
+        self.cancel_tts()
+
+# ============================================================================
+# MQTT Broker
+# ============================================================================
+
+def encode_remaining_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+def read_utf8(data, offset):
+    length = struct.unpack_from('>H', data, offset)[0]
+    return data[offset + 2:offset + 2 + length].decode('utf-8'), offset + 2 + length
+
+class MqttConnection:
+    """
+    单个设备的MQTT连接
+
+    只实现客户端用到的报文: CONNECT/PUBLISH/PUBACK/SUBSCRIBE/PINGREQ/DISCONNECT。
+    设备发布的JSON消息直接交给服务端逻辑处理，不做主题路由。
+    """
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.client_id = None
+        self.topic = None
+        self.session = None
+
+    async def read_packet(self):
+        header = await self.reader.readexactly(1)
+        multiplier, length = 1, 0
+        while True:
+            byte = (await self.reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        body = await self.reader.readexactly(length) if length else b''
+        return header[0] >> 4, header[0] & 0x0F, body
+
+    def write_packet(self, packet_type, flags, body):
+        self.writer.write(bytes([packet_type << 4 | flags]) + encode_remaining_length(len(body)) + body)
+
+    def publish(self, message):
+        payload = json.dumps(message, ensure_ascii=False).encode('utf-8')
+        topic = (self.topic or "devices/p2p/local").encode('utf-8')
+        self.write_packet(MQTT_PUBLISH, 0, struct.pack('>H', len(topic)) + topic + payload)
+
+    async def serve(self):
+        try:
+            while True:
+                packet_type, flags, body = await self.read_packet()
+                if packet_type == MQTT_CONNECT:
+                    _, offset = read_utf8(body, 0)
+                    self.client_id, _ = read_utf8(body, offset + 4)
+                    self.write_packet(2, 0, b'\x00\x00')  # CONNACK
+                    logger.info(f"MQTT连接: {self.client_id}")
+                elif packet_type == MQTT_SUBSCRIBE:
+                    packet_id = body[:2]
+                    topic, offset = read_utf8(body, 2)
+                    self.topic = topic
+                    self.write_packet(9, 0, packet_id + b'\x00')  # SUBACK
+                elif packet_type == MQTT_PUBLISH:
+                    qos = (flags >> 1) & 0x03
+                    _, offset = read_utf8(body, 0)
+                    if qos:
+                        self.write_packet(MQTT_PUBACK, 0, body[offset:offset + 2])
+                        offset += 2
+                    self.on_message(json.loads(body[offset:]))
+                elif packet_type == MQTT_PINGREQ:
+                    self.write_packet(13, 0, b'')  # PINGRESP
+                elif packet_type == MQTT_DISCONNECT:
+                    break
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        except Exception as e:
+            logger.warning(f"MQTT连接异常 ({self.client_id}): {e}")
+        finally:
+            self.close_session()
+            self.writer.close()
+            logger.info(f"MQTT断开: {self.client_id}")
+
+    def on_message(self, message):
+        message_type = message.get('type')
+        if message_type == 'hello':
+            self.close_session()
+            frame_duration = message.get('audio_params', {}).get('frame_duration')
+            if frame_duration not in FRAME_DURATIONS:
+                frame_duration = FRAME_DURATION
+            self.session = VoiceSession(self.server, self, frame_duration)
+            self.server.sessions[self.session.connection_id] = self.session
+            self.publish(self.session.hello_reply())
+            logger.info(f"新会话 {self.session.session_id[:8]} ({self.client_id}, "
+                        f"帧时长 {frame_duration}ms)")
+        elif self.session is None or message.get('session_id') not in (None, self.session.session_id):
+            return
+        elif message_type == 'listen':
+            self.session.on_listen(message)
+        elif message_type == 'abort':
+            if self.session.cancel_tts():
+                logger.info(f"会话 {self.session.session_id[:8]}: TTS被打断")
+        elif message_type == 'goodbye':
+            self.close_session()
+
+    def close_session(self):
+        if self.session is not None:
+            self.session.close()
+            self.server.sessions.pop(self.session.connection_id, None)
+            self.session = None
+
+# ============================================================================
+# UDP音频服务
+# ============================================================================
+
+class UdpAudioProtocol(asyncio.DatagramProtocol):
+    """按nonce中的连接ID（第4~8字节）把上行包分发给会话"""
+
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        if len(data) <= 16:
+            return
+        session = self.server.sessions.get(data[4:8])
+        if session is not None:
+            session.on_uplink(data, addr)
+
+class LocalServer:
+    """本地测试服务：OTA + MQTT + UDP"""
+
+    def __init__(self, config):
+        self.config = config
+        self.sessions = {}
+        self.transport = None
+        self._tone_frames = {}
+
+    def tone_frames(self, frame_duration):
+        """按帧时长缓存的提示音帧"""
+        if frame_duration not in self._tone_frames:
+            self._tone_frames[frame_duration] = synthesize_tone_frames(self.config.tone_ms, frame_duration)
+        return self._tone_frames[frame_duration]
+
+    def udp_send(self, packet, addr):
+        if self.transport is not None:
+            self.transport.sendto(packet, addr)
+
+    async def handle_mqtt(self, reader, writer):
+        await MqttConnection(self, reader, writer).serve()
+
+    async def run(self):
+        config = self.config
+        loop = asyncio.get_running_loop()
+
+        ota = OtaServer(config)
+        await asyncio.start_server(ota.handle, config.bind, config.ota_port)
+        await asyncio.start_server(self.handle_mqtt, config.bind, config.mqtt_port,
+                                   ssl=create_tls_context())
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: UdpAudioProtocol(self), local_addr=(config.bind, config.udp_port))
+
+        logger.info(f"OTA:  http://{config.host}:{config.ota_port}/xiaozhi/ota/")
+        logger.info(f"MQTT: {config.host}:{config.mqtt_port} (TLS)")
+        logger.info(f"UDP:  {config.host}:{config.udp_port} (应答模式: {config.mode})")
+        await asyncio.Event().wait()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="小智本地测试服务 (OTA + MQTT + UDP)")
+    parser.add_argument("--bind", default="0.0.0.0", help="监听地址 (默认: 0.0.0.0)")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="下发给客户端的服务地址 (默认: 127.0.0.1)")
+    parser.add_argument("--ota-port", type=int, default=8000, help="OTA HTTP端口 (默认: 8000)")
+    parser.add_argument("--mqtt-port", type=int, default=8883, help="MQTT TLS端口 (默认: 8883)")
+    parser.add_argument("--udp-port", type=int, default=8884, help="UDP音频端口 (默认: 8884)")
+    parser.add_argument("--mode", choices=["echo", "tone"], default="echo",
+                        help="应答音频: echo 回放本轮上行录音; tone 合成提示音 (默认: echo)")
+    parser.add_argument("--tone-ms", type=int, default=1500, help="提示音时长/毫秒 (默认: 1500)")
+    parser.add_argument("--response-delay-ms", type=int, default=0,
+                        help="模拟服务端处理耗时: listen stop 到发送stt的延迟/毫秒 (默认: 0)")
+    parser.add_argument("--loss-rate", type=float, default=0.0,
+                        help="模拟下行丢包率 0~1 (默认: 0)")
+    parser.add_argument("--jitter-ms", type=int, default=0,
+                        help="模拟下行网络抖动：每包随机延迟 0~N 毫秒，可能乱序 (默认: 0)")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(LocalServer(parse_args()).run())
+    except KeyboardInterrupt:
+        logger.info("本地测试服务已停止")